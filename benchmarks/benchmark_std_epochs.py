@@ -0,0 +1,126 @@
+"""
+Benchmark of the per-epoch STD calculation (get_std_epochs in STD_meg_qc.py).
+
+Compares the old way (get_data for every epoch and every channel separately)
+with the current one (one get_data for all epochs and channels, one np.std)
+on synthetic 306-channel data (102 magnetometers, 204 gradiometers, like Elekta/MEGIN Triux).
+
+Run from the root of the repository:
+    python benchmarks/benchmark_std_epochs.py
+    python benchmarks/benchmark_std_epochs.py --n_epochs 600
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import mne
+
+sys.path.append(os.path.join('.'))
+
+from meg_qc.calculation.metrics.STD_meg_qc import get_std_epochs
+
+
+def make_synthetic_epochs(n_epochs: int, n_times: int, sfreq: float = 1000, seed: int = 0):
+
+    """
+    Make synthetic epochs with 102 magnetometers and 204 gradiometers filled with random noise.
+
+    Parameters
+    ----------
+    n_epochs : int
+        Number of epochs.
+    n_times : int
+        Number of samples in each epoch.
+    sfreq : float
+        Sampling frequency.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    epochs : mne.EpochsArray
+        Synthetic epochs.
+
+    """
+
+    ch_names = []
+    ch_types = []
+    for i in range(102):
+        ch_names += ['MEG%04d' % (i*10+1), 'MEG%04d' % (i*10+2), 'MEG%04d' % (i*10+3)]
+        ch_types += ['mag', 'grad', 'grad']
+
+    info = mne.create_info(ch_names, sfreq, ch_types)
+
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((n_epochs, len(ch_names), n_times)) * 1e-12
+
+    return mne.EpochsArray(data, info, verbose=False)
+
+
+def get_std_epochs_loop(channels: list, epochs_mg: mne.Epochs):
+
+    """
+    Old implementation of get_std_epochs: get_data for every epoch and every channel.
+    Kept here only for comparison.
+
+    """
+
+    dict_ep = {}
+
+    for ep in range(0, len(epochs_mg)):
+        std_epoch=[]
+        for ch_name in channels:
+            data_ch_epoch=epochs_mg[ep].get_data(picks=ch_name)[0][0]
+            std_ch_ep = np.std(data_ch_epoch)
+            std_epoch.append(np.float64(std_ch_ep))
+
+        dict_ep[ep] = std_epoch
+
+    return pd.DataFrame(dict_ep, index=channels)
+
+
+def run_benchmark(n_epochs: int, n_times: int):
+
+    """
+    Time both implementations for magnetometers and gradiometers and check that the results are the same.
+
+    Parameters
+    ----------
+    n_epochs : int
+        Number of epochs.
+    n_times : int
+        Number of samples in each epoch.
+
+    """
+
+    epochs = make_synthetic_epochs(n_epochs, n_times)
+
+    for m_or_g in ['mag', 'grad']:
+        channels = [epochs.ch_names[i] for i in mne.pick_types(epochs.info, meg=m_or_g)]
+        epochs_mg = epochs.copy().pick(channels)
+
+        start_time = time.time()
+        df_loop = get_std_epochs_loop(channels, epochs_mg)
+        time_loop = time.time() - start_time
+
+        start_time = time.time()
+        df_vectorised = get_std_epochs(channels, epochs_mg)
+        time_vectorised = time.time() - start_time
+
+        pd.testing.assert_frame_equal(df_loop, df_vectorised)
+
+        print('%s: %d channels x %d epochs. Loop: %.2f s, vectorised: %.3f s, speed-up: %.0fx. Results are identical.' % (m_or_g, len(channels), n_epochs, time_loop, time_vectorised, time_loop/time_vectorised))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of per-epoch STD calculation on synthetic 306-channel data.')
+    parser.add_argument('--n_epochs', type=int, default=100, help='Number of epochs. Default: 100')
+    parser.add_argument('--n_times', type=int, default=1001, help='Number of samples in each epoch. Default: 1001 (1 second at 1 kHz)')
+    args = parser.parse_args()
+
+    run_benchmark(args.n_epochs, args.n_times)
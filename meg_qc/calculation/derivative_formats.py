@@ -0,0 +1,713 @@
+import os
+import re
+import json
+import tempfile
+import mne
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow # needed by pandas for both parquet and feather files
+except ImportError:
+    pyarrow = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+# Columnar binary formats for data frame derivatives and their file extensions:
+BINARY_DF_FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+
+# Formats of the container holding all derivatives of one data file and their file extensions:
+CONTAINER_FORMATS = {'hdf5': '.h5', 'zarr': '.zarr'}
+
+# desc entity of the container file:
+CONTAINER_DESC = 'MEGqc'
+
+# Max number of values in one chunk of a dataset in the container:
+CONTAINER_CHUNK_SIZE = 2**16
+
+
+def binary_df_available():
+
+    """
+    Check if data frame derivatives can be written/read in a columnar binary format (pyarrow is installed).
+
+    Returns
+    -------
+    bool
+        True if pyarrow can be used.
+
+    """
+
+    return pyarrow is not None
+
+
+def check_binary_df_format(binary_df_format: str):
+
+    """
+    Check the binary format setting from the config file.
+
+    Parameters
+    ----------
+    binary_df_format : str
+        'parquet', 'feather' or None (only tsv files are written).
+
+    Returns
+    -------
+    binary_df_format : str
+        Same format, or None if no binary files should be written or if they can not be written (pyarrow is not installed).
+
+    """
+
+    if not binary_df_format:
+        return None
+
+    if binary_df_format not in BINARY_DF_FORMATS:
+        raise ValueError('binary_df_format must be one of ' + ', '.join(BINARY_DF_FORMATS) + ' or left blank, got: ' + str(binary_df_format))
+
+    if not binary_df_available():
+        print('___MEGqc___: ', 'binary_df_format is set to ' + binary_df_format + ', but pyarrow is not installed. Only tsv derivatives will be written. Install pyarrow to get ' + binary_df_format + ' files.')
+        return None
+
+    return binary_df_format
+
+
+def df_for_binary(df: pd.DataFrame):
+
+    """
+    Prepare a data frame derivative to be written into a binary file, so that it reads back the same way as its tsv file:
+    index becomes the first column (pd.read_csv calls it 'Unnamed: 0'), column names are strings,
+    empty columns are float (NaN) and columns with values of mixed types are strings.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame derivative.
+
+    Returns
+    -------
+    df_out : pd.DataFrame
+        Data frame ready to be written with to_parquet() or to_feather().
+
+    """
+
+    index_name = df.index.name if df.index.name is not None else 'Unnamed: 0'
+    df_out = df.reset_index(names=index_name)
+    df_out.columns = [str(column) for column in df_out.columns]
+
+    for column in df_out.columns[df_out.dtypes == object]:
+        values = df_out[column]
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred == 'empty':
+            df_out[column] = np.nan
+        elif inferred.startswith('mixed') and inferred != 'mixed-integer-float':
+            df_out[column] = values.where(values.isna(), values.astype(str))
+
+    return df_out
+
+
+def write_df_binary(df: pd.DataFrame, file_path: str, binary_df_format: str):
+
+    """
+    Write data frame derivative into a columnar binary file.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame derivative.
+    file_path : str
+        Path of the file to write.
+    binary_df_format : str
+        'parquet' or 'feather'
+
+    """
+
+    df_out = df_for_binary(df)
+
+    if binary_df_format == 'parquet':
+        df_out.to_parquet(file_path, index=False)
+    elif binary_df_format == 'feather':
+        df_out.to_feather(file_path)
+    else:
+        raise ValueError('Unknown binary format of data frame derivative: ' + str(binary_df_format))
+
+
+def container_available(container_format: str):
+
+    """
+    Check if the library needed for the container format is installed.
+
+    Parameters
+    ----------
+    container_format : str
+        'hdf5' (needs h5py) or 'zarr' (needs zarr).
+
+    Returns
+    -------
+    bool
+        True if the container format can be used.
+
+    """
+
+    if container_format == 'hdf5':
+        return h5py is not None
+    if container_format == 'zarr':
+        return zarr is not None
+    return False
+
+
+def check_container_format(container_format: str):
+
+    """
+    Check the derivative container setting from the config file.
+
+    Parameters
+    ----------
+    container_format : str
+        'hdf5', 'zarr' or None (every derivative is written into its own file).
+
+    Returns
+    -------
+    container_format : str
+        Same format, or None if no container should be written or if it can not be written (library is not installed).
+
+    """
+
+    if not container_format:
+        return None
+
+    if container_format not in CONTAINER_FORMATS:
+        raise ValueError('derivative_container must be one of ' + ', '.join(CONTAINER_FORMATS) + ' or left blank, got: ' + str(container_format))
+
+    if not container_available(container_format):
+        library = 'h5py' if container_format == 'hdf5' else 'zarr'
+        print('___MEGqc___: ', 'derivative_container is set to ' + container_format + ', but ' + library + ' is not installed. Every derivative will be written into its own file. Install ' + library + ' to get ' + container_format + ' containers.')
+        return None
+
+    return container_format
+
+
+def _container_format_of(path: str):
+
+    """Get the container format from the file extension of the container."""
+
+    for container_format, extension in CONTAINER_FORMATS.items():
+        if path.endswith(extension):
+            return container_format
+
+    raise ValueError('Not a derivative container: ' + str(path))
+
+
+def _open_container(path: str, mode: str):
+
+    """Open hdf5 file or zarr group of the container, mode as in h5py.File: 'r' or 'w'."""
+
+    container_format = _container_format_of(path)
+
+    if not container_available(container_format):
+        raise ImportError('Reading ' + path + ' needs ' + ('h5py' if container_format == 'hdf5' else 'zarr') + ' installed.')
+
+    if container_format == 'hdf5':
+        return h5py.File(path, mode)
+
+    return zarr.open_group(path, mode=mode)
+
+
+def _write_array(group, name: str, values: np.ndarray, container_format: str):
+
+    """Write 1D array into the group as a chunked (and for hdf5 compressed) dataset."""
+
+    values = np.asarray(values)
+    chunks = (max(min(len(values), CONTAINER_CHUNK_SIZE), 1),)
+
+    if container_format == 'hdf5':
+        if len(values) == 0:
+            group.create_dataset(name, data=values)
+        else:
+            group.create_dataset(name, data=values, chunks=chunks, compression='gzip', shuffle=True)
+    elif hasattr(group, 'create_array'):
+        # zarr 3: create_dataset is deprecated. zarr compresses chunks by default
+        group.create_array(name, data=values, chunks=chunks)
+    else:
+        # zarr 2
+        group.create_dataset(name, data=values, chunks=chunks)
+
+
+def _read_array(group, name: str):
+
+    """Read the whole dataset of the group into memory."""
+
+    return np.asarray(group[name][...])
+
+
+def _encode_strings(values: pd.Series):
+
+    """Encode a column of strings as utf-8 bytes of all values one after another and the offsets of every value."""
+
+    encoded = [str(value).encode('utf-8') for value in values]
+    byte_values = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    offsets = np.concatenate(([0], np.cumsum([len(value) for value in encoded], dtype=np.int64)))
+
+    return byte_values, offsets
+
+
+def _decode_strings(byte_values: np.ndarray, offsets: np.ndarray):
+
+    """Reverse _encode_strings()."""
+
+    all_bytes = byte_values.tobytes()
+
+    return [all_bytes[start:stop].decode('utf-8') for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def _write_df_group(group, df: pd.DataFrame, container_format: str):
+
+    """
+    Write data frame derivative into the group: every column is a separate dataset 'c0', 'c1', ...
+    Numeric columns are written as they are, other columns as utf-8 strings (bytes + offsets + mask of empty cells).
+    """
+
+    df_out = df_for_binary(df)
+
+    column_kinds = []
+    for col_n, column in enumerate(df_out.columns):
+        values = df_out[column]
+        if values.dtype == object:
+            values = values.infer_objects()
+
+        if values.dtype.kind in 'biuf':
+            _write_array(group, 'c' + str(col_n), values.to_numpy(), container_format)
+            column_kinds.append('bool' if values.dtype.kind == 'b' else 'number')
+        else:
+            is_null = values.isna().to_numpy()
+            byte_values, offsets = _encode_strings(values.where(~is_null, ''))
+            _write_array(group, 'c' + str(col_n), byte_values, container_format)
+            _write_array(group, 'c' + str(col_n) + '_offsets', offsets, container_format)
+            _write_array(group, 'c' + str(col_n) + '_null', is_null.astype(np.uint8), container_format)
+            column_kinds.append('str')
+
+    group.attrs['columns'] = json.dumps(list(df_out.columns))
+    group.attrs['column_kinds'] = json.dumps(column_kinds)
+
+
+def _read_df_group(group):
+
+    """Reverse _write_df_group(): read the data frame the way pd.read_csv reads its tsv file."""
+
+    columns = json.loads(group.attrs['columns'])
+    column_kinds = json.loads(group.attrs['column_kinds'])
+
+    df_dict = {}
+    for col_n, (column, column_kind) in enumerate(zip(columns, column_kinds)):
+        if column_kind == 'str':
+            values = np.array(_decode_strings(_read_array(group, 'c' + str(col_n)), _read_array(group, 'c' + str(col_n) + '_offsets')), dtype=object)
+            values[_read_array(group, 'c' + str(col_n) + '_null').astype(bool)] = np.nan
+            df_dict[column] = values
+        elif column_kind == 'bool':
+            df_dict[column] = _read_array(group, 'c' + str(col_n)).astype(bool)
+        else:
+            df_dict[column] = _read_array(group, 'c' + str(col_n))
+
+    return pd.DataFrame(df_dict, columns=columns)
+
+
+def _info_to_bytes(info: mne.Info):
+
+    """Get the content of the fif file mne.io.write_info() would write."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, 'info.fif')
+        mne.io.write_info(tmp_path, info)
+        with open(tmp_path, 'rb') as file_wrapper:
+            return file_wrapper.read()
+
+
+def _bytes_to_info(info_bytes: bytes):
+
+    """Reverse _info_to_bytes()."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, 'info.fif')
+        with open(tmp_path, 'wb') as file_wrapper:
+            file_wrapper.write(info_bytes)
+        return mne.io.read_info(tmp_path, verbose='ERROR')
+
+
+def write_derivative_container(derivs: list, file_path: str, container_format: str):
+
+    """
+    Write the derivatives of one data file into one chunked container file instead of a separate file for every derivative.
+    Every derivative is a group named as the derivative (same as the desc entity of its separate file).
+    Data frames are stored column by column, so one column or one derivative can be read without reading the rest.
+
+    Parameters
+    ----------
+    derivs : list
+        List of QC_derivative objects with content_type 'df', 'json' or 'info'.
+    file_path : str
+        Path of the container to write (.h5 file or .zarr folder).
+    container_format : str
+        'hdf5' or 'zarr'
+
+    """
+
+    if container_format not in CONTAINER_FORMATS:
+        raise ValueError('Unknown derivative container format: ' + str(container_format))
+
+    store = _open_container(file_path, 'w')
+
+    try:
+        for deriv in derivs:
+            group = store.create_group(deriv.name)
+            group.attrs['content_type'] = deriv.content_type
+
+            if deriv.content_type == 'df':
+                _write_df_group(group, deriv.content, container_format)
+            elif deriv.content_type == 'json':
+                _write_array(group, 'json', np.frombuffer(json.dumps(deriv.content, indent=4).encode('utf-8'), dtype=np.uint8), container_format)
+            elif deriv.content_type == 'info':
+                _write_array(group, 'fif', np.frombuffer(_info_to_bytes(deriv.content), dtype=np.uint8), container_format)
+            else:
+                raise ValueError('Derivative ' + deriv.name + ' of type ' + str(deriv.content_type) + ' can not be written into a container.')
+    finally:
+        if hasattr(store, 'close'):
+            store.close()
+
+
+class DerivativeContainer:
+
+    """
+    Read access to the derivatives of one data file written by write_derivative_container().
+    Only the derivative (and for data frames - the columns) which is asked for is read from disk.
+
+    Use as a context manager:
+
+        with DerivativeContainer(path) as container:
+            df = container.read_df('STDs')
+
+    Parameters
+    ----------
+    path : str
+        Path of the container (.h5 file or .zarr folder).
+
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._store = _open_container(path, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, name: str):
+        return name in self._store
+
+    def close(self):
+        if hasattr(self._store, 'close'):
+            self._store.close()
+
+    def names(self):
+
+        """Names of all derivatives in the container."""
+
+        return sorted(self._store.keys())
+
+    def content_type(self, name: str):
+
+        """Content type of the derivative: 'df', 'json' or 'info'."""
+
+        return str(self._store[name].attrs['content_type'])
+
+    def read_df(self, name: str, columns: list = None):
+
+        """
+        Read data frame derivative, same as pd.read_csv(tsv_path, sep='\\t') of its tsv file would give.
+        If columns are given, only these columns are read.
+        """
+
+        group = self._store[name]
+        df = _read_df_group(group) if columns is None else _read_df_group(_ColumnsView(group, columns))
+
+        return df
+
+    def read_json(self, name: str):
+
+        """Read json derivative as dict."""
+
+        return json.loads(_read_array(self._store[name], 'json').tobytes().decode('utf-8'))
+
+    def read_info(self, name: str):
+
+        """Read info derivative as mne.Info."""
+
+        return _bytes_to_info(_read_array(self._store[name], 'fif').tobytes())
+
+
+class _ColumnsView:
+
+    """Part of the data frame group with only the selected columns, so that only they are read by _read_df_group()."""
+
+    def __init__(self, group, columns: list):
+
+        all_columns = json.loads(group.attrs['columns'])
+        column_kinds = json.loads(group.attrs['column_kinds'])
+        missing = [column for column in columns if column not in all_columns]
+        if missing:
+            raise ValueError('Columns not found in the derivative: ' + ', '.join(missing))
+
+        col_ns = [all_columns.index(column) for column in columns]
+        self._group = group
+        self._datasets = {}
+        for new_n, col_n in enumerate(col_ns):
+            for ending in ('', '_offsets', '_null'):
+                if 'c' + str(col_n) + ending in group:
+                    self._datasets['c' + str(new_n) + ending] = 'c' + str(col_n) + ending
+        self.attrs = {'columns': json.dumps(list(columns)), 'column_kinds': json.dumps([column_kinds[col_n] for col_n in col_ns])}
+
+    def __getitem__(self, name: str):
+        return self._group[self._datasets[name]]
+
+
+def container_member_paths(container_path: str):
+
+    """
+    Get paths of all derivatives inside the container. The path of a derivative is the container path + the file name
+    the derivative would have as a separate file, for example:
+    .../sub-009_task-deduction_desc-MEGqc_meg.h5/sub-009_task-deduction_desc-STDs_meg.tsv
+
+    These paths can be given to read_derivative_df(), read_derivative_json() and read_derivative_info() as normal file paths.
+
+    Parameters
+    ----------
+    container_path : str
+        Path of the container.
+
+    Returns
+    -------
+    member_paths : dict
+        Derivative name: path of the derivative.
+
+    """
+
+    extensions = {'df': '.tsv', 'json': '.json', 'info': '.fif'}
+    container_name = os.path.basename(container_path)
+    container_base = os.path.splitext(container_name)[0]
+
+    member_paths = {}
+    with DerivativeContainer(container_path) as container:
+        for name in container.names():
+            member_name = container_base.replace('desc-' + CONTAINER_DESC + '_', 'desc-' + name + '_') + extensions.get(container.content_type(name), '')
+            member_paths[name] = os.path.join(container_path, member_name)
+
+    return member_paths
+
+
+def find_container(f_path: str):
+
+    """
+    Find the container written for the same data file as the given derivative file (for example SimpleMetrics json).
+
+    Parameters
+    ----------
+    f_path : str
+        Path of any derivative file of the data file.
+
+    Returns
+    -------
+    container_path : str
+        Path of the container or None if there is none.
+
+    """
+
+    folder, f_name = os.path.split(f_path)
+    container_base = re.sub(r'desc-[^_]+_', 'desc-' + CONTAINER_DESC + '_', os.path.splitext(f_name)[0])
+
+    for extension in CONTAINER_FORMATS.values():
+        container_path = os.path.join(folder, container_base + extension)
+        if os.path.exists(container_path):
+            return container_path
+
+    return None
+
+
+def _split_container_member(f_path: str):
+
+    """If the path points to a derivative inside a container, give container path and derivative name, otherwise None."""
+
+    container_path, member_name = os.path.split(f_path)
+
+    if os.path.splitext(container_path)[1] not in CONTAINER_FORMATS.values() or not os.path.exists(container_path):
+        return None
+
+    # derivative names can contain '_', so take the name as the part between the entities of the container name:
+    prefix, suffix = os.path.splitext(os.path.basename(container_path))[0].split('desc-' + CONTAINER_DESC)
+    member_base = os.path.splitext(member_name)[0]
+    if not member_base.startswith(prefix + 'desc-') or not member_base.endswith(suffix):
+        raise ValueError('Derivative ' + member_name + ' does not belong to the container ' + container_path)
+
+    return container_path, member_base[len(prefix + 'desc-'):len(member_base) - len(suffix)]
+
+
+def derivative_exists(f_path: str):
+
+    """
+    Check if the derivative exists, as a separate file or inside a container.
+
+    Parameters
+    ----------
+    f_path : str
+        Path of the derivative file or of the derivative inside a container (see container_member_paths()).
+
+    Returns
+    -------
+    bool
+        True if the derivative exists.
+
+    """
+
+    member = _split_container_member(f_path)
+    if member is None:
+        return os.path.isfile(f_path)
+
+    with DerivativeContainer(member[0]) as container:
+        return member[1] in container
+
+
+def read_derivative_json(f_path: str):
+
+    """
+    Read json derivative, from a separate file or from a container.
+
+    Parameters
+    ----------
+    f_path : str
+        Path of the json file or of the derivative inside a container (see container_member_paths()).
+
+    Returns
+    -------
+    dict
+        Content of the json derivative.
+
+    """
+
+    member = _split_container_member(f_path)
+    if member is None:
+        with open(f_path, 'r') as file_wrapper:
+            return json.load(file_wrapper)
+
+    with DerivativeContainer(member[0]) as container:
+        return container.read_json(member[1])
+
+
+def read_derivative_info(f_path: str):
+
+    """
+    Read info derivative, from a separate fif file or from a container.
+
+    Parameters
+    ----------
+    f_path : str
+        Path of the fif file or of the derivative inside a container (see container_member_paths()).
+
+    Returns
+    -------
+    mne.Info
+        Info of the data file.
+
+    """
+
+    member = _split_container_member(f_path)
+    if member is None:
+        return mne.io.read_info(f_path)
+
+    with DerivativeContainer(member[0]) as container:
+        return container.read_info(member[1])
+
+
+def is_fresh_binary_df(binary_path: str, tsv_path: str):
+
+    """
+    Check if the binary file of a data frame derivative can be read instead of its tsv file.
+    Binary file is written right after the tsv file. If the tsv file is newer, the binary file was left
+    from an earlier run (for example, with binary_df_format blank or set to another format) and has old results.
+
+    Parameters
+    ----------
+    binary_path : str
+        Path of the parquet or feather file.
+    tsv_path : str
+        Path of the tsv file of the same derivative.
+
+    Returns
+    -------
+    bool
+        True if the binary file exists and is not older than the tsv file (or there is no tsv file).
+
+    """
+
+    if not os.path.isfile(binary_path):
+        return False
+
+    if not os.path.isfile(tsv_path):
+        return True
+
+    return os.path.getmtime(binary_path) >= os.path.getmtime(tsv_path)
+
+
+def _apply_dtype(df: pd.DataFrame, dtype: dict):
+
+    """Set column types given as in pd.read_csv for a data frame read from a binary file, empty cells stay NaN."""
+
+    for column, column_type in (dtype or {}).items():
+        column = df.columns[column] if isinstance(column, int) else column
+        values = df[column]
+        df[column] = values.where(values.isna(), values.astype(column_type)) #empty cells stay NaN, like in read_csv
+
+    return df
+
+
+def read_derivative_df(f_path: str, dtype: dict = None):
+
+    """
+    Read a data frame derivative. If the path points inside a derivative container, the derivative is read from the container.
+    If a parquet or feather file with the same name is next to the tsv file (and pyarrow is installed) and it is not older
+    than the tsv file, it is read instead of parsing the tsv file. Otherwise the tsv file is read.
+
+    Parameters
+    ----------
+    f_path : str
+        Path to the tsv file of the derivative or of the derivative inside a container (see container_member_paths()).
+    dtype : dict
+        Types of the columns (by column number or name) as in pd.read_csv, for example {6: str}. Default: None.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Data frame with the derivative, same as pd.read_csv(f_path, sep='\t') would give.
+
+    """
+
+    member = _split_container_member(f_path)
+    if member is not None:
+        with DerivativeContainer(member[0]) as container:
+            return _apply_dtype(container.read_df(member[1]), dtype)
+
+    if binary_df_available():
+        file_base = os.path.splitext(f_path)[0]
+        for binary_df_format, extension in BINARY_DF_FORMATS.items():
+            if is_fresh_binary_df(file_base + extension, f_path):
+                df = pd.read_parquet(file_base + extension) if binary_df_format == 'parquet' else pd.read_feather(file_base + extension)
+                return _apply_dtype(df, dtype)
+
+    return pd.read_csv(f_path, sep='\t', dtype=dtype)
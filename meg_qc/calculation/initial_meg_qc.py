@@ -1,5 +1,6 @@
 import os
 import mne
+import tempfile
 import configparser
 import numpy as np
 import pandas as pd
@@ -7,7 +8,8 @@ import random
 import copy
 import warnings
 from typing import List
-from meg_qc.calculation.objects import QC_derivative, MEG_channel
+from meg_qc.calculation.objects import QC_derivative, MEG_channel, ChannelTable
+from meg_qc.calculation.signal_store import SignalStore
 
 
 def get_all_config_params(config_file_path: str):
@@ -80,7 +82,13 @@ def get_all_config_params(config_file_path: str):
             'plot_interactive_time_series': default_section.getboolean('plot_interactive_time_series'),
             'plot_interactive_time_series_average': default_section.getboolean('plot_interactive_time_series_average'),
             'crop_tmin': tmin,
-            'crop_tmax': tmax})
+            'crop_tmax': tmax,
+            'metrics_n_threads': default_section.getint('metrics_n_threads', fallback=1),
+            'cache_results': default_section.getboolean('cache_results', fallback=False),
+            'binary_df_format': default_section.get('binary_df_format', fallback='').strip().lower() or None,
+            'derivative_container': default_section.get('derivative_container', fallback='').strip().lower() or None,
+            'write_queue_size': default_section.getint('write_queue_size', fallback=2),
+            'memmap_dir': default_section.get('memmap_dir', fallback='') or None})
         all_qc_params['default'] = default_params
 
         filtering_section = config['Filtering']
@@ -141,7 +149,9 @@ def get_all_config_params(config_file_path: str):
         all_qc_params['PSD'] = dict({
         'freq_min': freq_min,
         'freq_max': freq_max,
-        'psd_step_size': psd_section.getfloat('psd_step_size')})
+        'psd_step_size': psd_section.getfloat('psd_step_size'),
+        'n_jobs': psd_section.getint('n_jobs', fallback=-1),
+        'block_seconds': psd_section.getfloat('block_seconds', fallback=0)})
 
 
         ptp_manual_section = config['PTP_manual']
@@ -153,7 +163,8 @@ def get_all_config_params(config_file_path: str):
         'ptp_bottom_limit': ptp_manual_section.getfloat('ptp_bottom_limit'),
         'std_lvl': ptp_manual_section.getfloat('std_lvl'),
         'noisy_channel_multiplier': ptp_manual_section.getfloat('noisy_channel_multiplier'),
-        'flat_multiplier': ptp_manual_section.getfloat('flat_multiplier')})
+        'flat_multiplier': ptp_manual_section.getfloat('flat_multiplier'),
+        'n_jobs': ptp_manual_section.getint('n_jobs', fallback=1)})
 
 
         ptp_mne_section = config['PTP_auto']
@@ -259,10 +270,56 @@ def get_internal_config_params(config_file_name: str):
     
     return internal_qc_params
 
+def stim_data_to_events(stim_data: np.ndarray, ch_names: List, sfreq: float):
+
+    """
+    Encode stimulus channels as runs of the same value: one row per value change per channel 
+    (the first row of every channel is the value at the start of the data).
+    The full channels can be reconstructed from it as step functions.
+
+    Parameters
+    ----------
+    stim_data : np.ndarray
+        Data of the stimulus channels, shape (n_channels, n_times).
+    ch_names : List
+        Names of the stimulus channels.
+    sfreq : float
+        Sampling frequency.
+
+    Returns
+    -------
+    stim_df : pd.DataFrame
+        Data frame with columns: onset (s), duration (s), channel, value, sample (onset in samples).
+
+    """
+
+    stim_data = np.asarray(stim_data)
+    n_times = stim_data.shape[1]
+
+    # a run starts at the first sample and wherever the value changes:
+    run_start = np.ones(stim_data.shape, dtype=bool)
+    run_start[:, 1:] = stim_data[:, 1:] != stim_data[:, :-1]
+    ch_idx, start = np.nonzero(run_start)
+
+    # run ends where the next run of the same channel starts, last run of the channel - at the end of the data:
+    end = np.append(start[1:], n_times)
+    end[np.append(ch_idx[1:] != ch_idx[:-1], True)] = n_times
+
+    stim_df = pd.DataFrame({
+        'onset': start / sfreq,
+        'duration': (end - start) / sfreq,
+        'channel': np.array(ch_names, dtype=object)[ch_idx],
+        'value': stim_data[ch_idx, start],
+        'sample': start})
+
+    return stim_df
+
+
 def stim_data_to_df(raw: mne.io.Raw):
 
     """
     Extract stimulus data from MEG data and put it into a pandas DataFrame.
+    Channels are not saved sample by sample, but as runs of the same value with onset and duration (see stim_data_to_events()).
 
     Parameters
     ----------
@@ -280,11 +337,10 @@ def stim_data_to_df(raw: mne.io.Raw):
     stim_channel_names = [raw.info['ch_names'][ch] for ch in stim_channels]
 
     # Extract data for stimulus channels
-    stim_data, times = raw[stim_channels, :]
+    stim_data = raw.get_data(picks=stim_channels) if len(stim_channels) > 0 else np.empty((0, raw.n_times))
 
-    # Create a DataFrame with the stimulus data
-    stim_df = pd.DataFrame(stim_data.T, columns=stim_channel_names)
-    stim_df['time'] = times
+    # Create a DataFrame with the stimulus events
+    stim_df = stim_data_to_events(stim_data, stim_channel_names, raw.info['sfreq'])
 
     #save df as QC_derivative object
     stim_deriv = [QC_derivative(stim_df, 'stimulus', 'df')]
@@ -292,28 +348,28 @@ def stim_data_to_df(raw: mne.io.Raw):
     return stim_deriv
 
 
-def Epoch_meg(epoching_params, data: mne.io.Raw):
+def find_epoching_events(epoching_params, data: mne.io.Raw):
 
     """
-    Epoch MEG data based on the parameters provided in the config file.
+    Find events for epoching MEG data based on the parameters provided in the config file.
+    Filtering of MEG channels does not change the stimulus channels, so the events can be found
+    on the unfiltered data before any filtered version is made.
     
     Parameters
     ----------
     epoching_params : dict
         Dictionary with parameters for epoching.
     data : mne.io.Raw
-        MEG data to be epoched.
+        MEG data to find events in.
         
     Returns
     -------
-    dict_epochs_mg : dict
-        Dictionary with epochs for each channel type: mag, grad.
+    events : np.ndarray or None
+        Events array as returned by mne.find_events or None if no events were found.
 
     """
 
     event_dur = epoching_params['event_dur']
-    epoch_tmin = epoching_params['epoch_tmin']
-    epoch_tmax = epoching_params['epoch_tmax']
     stim_channel = epoching_params['stim_channel']
 
     if stim_channel is None:
@@ -323,31 +379,67 @@ def Epoch_meg(epoching_params, data: mne.io.Raw):
             stim_channel.append(data.info['chs'][ch]['ch_name'])
     print('___MEGqc___: ', 'Stimulus channels detected:', stim_channel)
 
-    picks_magn = data.copy().pick('mag').ch_names if 'mag' in data else None
-    picks_grad = data.copy().pick('grad').ch_names if 'grad' in data else None
-
     if not stim_channel:
         print('___MEGqc___: ', 'No stimulus channel detected. Setting stimulus channel to None to allow mne to detect events autamtically.')
         stim_channel = None
         #here for info on how None is handled by mne: https://mne.tools/stable/generated/mne.find_events.html
         #even if stim is None, mne will check once more when creating events.
 
-
-    epochs_grad, epochs_mag = None, None
-
     try:
         events = mne.find_events(data, stim_channel=stim_channel, min_duration=event_dur)
 
         if len(events) < 1:
             print('___MEGqc___: ', 'No events with set minimum duration were found using all stimulus channels. No epoching can be done. Try different event duration in config file.')
-        else:
-            print('___MEGqc___: ', 'Events found:', len(events))
-            epochs_mag = mne.Epochs(data, events, picks=picks_magn, tmin=epoch_tmin, tmax=epoch_tmax, preload=True, baseline = None, event_repeated=epoching_params['event_repeated'])
-            epochs_grad = mne.Epochs(data, events, picks=picks_grad, tmin=epoch_tmin, tmax=epoch_tmax, preload=True, baseline = None, event_repeated=epoching_params['event_repeated'])
+            return None
+        
+        print('___MEGqc___: ', 'Events found:', len(events))
+        return events
 
     except: #case when we use stim_channel=None, mne checks once more,  finds no other stim ch and no events and throws error:
         print('___MEGqc___: ', 'No stim channels detected, no events found.')
-        pass #go to returning empty dict
+        return None
+
+
+def Epoch_meg(epoching_params, data: mne.io.Raw, events: np.ndarray = None):
+
+    """
+    Epoch MEG data based on the parameters provided in the config file.
+    
+    Parameters
+    ----------
+    epoching_params : dict
+        Dictionary with parameters for epoching.
+    data : mne.io.Raw
+        MEG data to be epoched.
+    events : np.ndarray
+        Events to epoch around (see find_epoching_events). If None, they are found in the data.
+        
+    Returns
+    -------
+    dict_epochs_mg : dict
+        Dictionary with epochs for each channel type: mag, grad.
+
+    """
+
+    epoch_tmin = epoching_params['epoch_tmin']
+    epoch_tmax = epoching_params['epoch_tmax']
+
+    if events is None:
+        events = find_epoching_events(epoching_params, data)
+
+    epochs_grad, epochs_mag = None, None
+
+    if events is not None:
+        #only names are needed here, no need to copy the data:
+        picks_magn = [data.ch_names[i] for i in mne.pick_types(data.info, meg='mag')] if 'mag' in data else None
+        picks_grad = [data.ch_names[i] for i in mne.pick_types(data.info, meg='grad')] if 'grad' in data else None
+
+        try:
+            epochs_mag = mne.Epochs(data, events, picks=picks_magn, tmin=epoch_tmin, tmax=epoch_tmax, preload=True, baseline = None, event_repeated=epoching_params['event_repeated'])
+            epochs_grad = mne.Epochs(data, events, picks=picks_grad, tmin=epoch_tmin, tmax=epoch_tmax, preload=True, baseline = None, event_repeated=epoching_params['event_repeated'])
+        except Exception as e:
+            print('___MEGqc___: ', 'Could not epoch the data: ', e)
+            epochs_grad, epochs_mag = None, None
         
     
     dict_epochs_mg = {
@@ -357,7 +449,6 @@ def Epoch_meg(epoching_params, data: mne.io.Raw):
     return dict_epochs_mg
 
 
-
 def check_chosen_ch_types(m_or_g_chosen: List, channels_objs: dict):
     
     """
@@ -466,7 +557,7 @@ def change_ch_type_CTF(raw, channels):
     return channels, raw
 
 
-def load_data(file_path):
+def load_data(file_path, preload_ctf: bool = True):
 
     """
     Load MEG data from a file. It can be a CTF data or a FIF file.
@@ -475,6 +566,8 @@ def load_data(file_path):
     ----------
     file_path : str
         Path to the fif file with MEG data.
+    preload_ctf : bool
+        Load CTF data into memory right away. Set to False if the data will be loaded later (like into memory mapped file).
 
     Returns
     -------
@@ -492,7 +585,7 @@ def load_data(file_path):
     if os.path.isdir(file_path) and file_path.endswith('.ds'):
         # It's a CTF data directory
         print("___MEGqc___: ", "Loading CTF data...")
-        raw = mne.io.read_raw_ctf(file_path, preload=True)
+        raw = mne.io.read_raw_ctf(file_path, preload=preload_ctf)
         meg_system = 'CTF'
 
     elif os.path.isfile(file_path) and file_path.endswith('.fif'):
@@ -512,6 +605,43 @@ def load_data(file_path):
     return raw, shielding_str, meg_system
 
 
+def make_memmap_copy(raw: mne.io.Raw, memmap_dir: str, block_seconds: int = 60):
+
+    """
+    Copy the data into a memory mapped file on disk instead of memory.
+    The data is read (from the file or from the other loaded Raw) block by block, 
+    so the whole recording is never held in memory at once.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        MEG data, loaded or not.
+    memmap_dir : str
+        Directory to create the memory mapped file in.
+    block_seconds : int
+        Length of the data block copied at once, in seconds.
+
+    Returns
+    -------
+    raw_memmap : mne.io.RawArray
+        Copy of the data backed by the memory mapped file. All MNE functions (filter, resample, etc) work on it as usual.
+
+    """
+
+    file_descriptor, memmap_path = tempfile.mkstemp(suffix='.dat', dir=memmap_dir)
+    os.close(file_descriptor)
+
+    data = np.memmap(memmap_path, mode='w+', dtype=np.float64, shape=(len(raw.ch_names), raw.n_times))
+    block = int(block_seconds*raw.info['sfreq'])
+    for start in range(0, raw.n_times, block):
+        data[:, start:start+block] = raw.get_data(start=start, stop=min(start+block, raw.n_times))
+
+    raw_memmap = mne.io.RawArray(data, raw.info, first_samp=raw.first_samp, verbose=False)
+    raw_memmap.set_annotations(raw.annotations)
+
+    return raw_memmap
+
+
 def add_3d_ch_locations(raw, channels_objs):
 
     """
@@ -832,7 +962,7 @@ def sort_channels_by_lobe(channels_objs: dict):
 
 
 
-def initial_processing(default_settings: dict, filtering_settings: dict, epoching_params:dict, file_path: str):
+def initial_processing(default_settings: dict, filtering_settings: dict, epoching_params:dict, file_path: str, memmap_dir: str = None):
 
     """
     Here all the initial actions needed to analyse MEG data are done: 
@@ -840,8 +970,7 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
     - read fif file,
     - separate mags and grads names into 2 lists,
     - crop the data if needed,
-    - filter and downsample the data,
-    - epoch the data.
+    - prepare filtered, downsampled and epoched versions of the data (made when needed).
 
     Parameters
     ----------
@@ -853,24 +982,24 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
         Dictionary with parameters for epoching.
     file_path : str
         Path to the fif file with MEG data.
+    memmap_dir : str
+        Directory for memory mapped files. If given, the data (and the filtered/resampled versions) 
+        is not loaded into memory, but into files in this directory. None: data is loaded into memory.
 
     Returns
     -------
-    dict_epochs_mg : dict
-        Dictionary with epochs for each channel type: mag, grad.
-    chs_by_lobe : dict
-        Dictionary with channel objects for each channel type: mag, grad. And by lobe. Each obj hold info about the channel name, 
-        lobe area and color code, locations and (in the future) pther info, like: if it has noise of any sort.
+    meg_system : str
+        Which MEG system the data was recorded with: 'Triux' or 'CTF'.
+    data_store : SignalStore
+        Shared store with versions of the data: 'raw_cropped' (cropped MEG data), 
+        'raw_cropped_filtered' (filtered and cropped), 'raw_cropped_filtered_resampled' (filtered, cropped and resampled)
+        and 'epochs' (dictionary with epochs for each channel type: mag, grad). 
+        Everything except 'raw_cropped' is made only when a metric asks for it.
+    channel_table : ChannelTable
+        Table with all channels (sorted by channel type and lobe): name, type, lobe area and color code, system, locations.
+        Metrics add their results to it.
     channels : dict
         Dictionary with channel names for each channel type: mag, grad.
-    raw_crop_filtered : mne.io.Raw
-        Filtered and cropped MEG data.
-    raw_crop_filtered_resampled : mne.io.Raw
-        Filtered, cropped and resampled MEG data.
-    raw_cropped : mne.io.Raw
-        Cropped MEG data.
-    raw : mne.io.Raw
-        MEG data.
     info_derivs : list
         List with QC_derivative objects with MNE info object.
     shielding_str : str
@@ -893,7 +1022,7 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
 
     print('___MEGqc___: ', 'Reading data from file:', file_path)
 
-    raw, shielding_str, meg_system = load_data(file_path)
+    raw, shielding_str, meg_system = load_data(file_path, preload_ctf = memmap_dir is None)
 
     # Working with channels:
     channels = choose_channels(raw)
@@ -917,6 +1046,9 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
     chs_by_lobe = sort_channels_by_lobe(channels_objs)
     print('___MEGqc___: ', 'Channels sorted by lobe.')
 
+    #Table of all channels in the same order, metrics add their results to it:
+    channel_table = ChannelTable.from_chs_by_lobe(chs_by_lobe)
+
     info = raw.info
     info_derivs = [QC_derivative(content = info, name = 'RawInfo', content_type = 'info', fig_order=-1)]
 
@@ -925,44 +1057,58 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
     tmax=default_settings['crop_tmax']
     if tmax is None or tmax > tmax_possible: 
         tmax = tmax_possible 
-    raw_cropped = raw.copy().crop(tmin=default_settings['crop_tmin'], tmax=tmax)
-    #When resampling for plotting, cropping or anything else you don't need permanent in raw inside any functions - always do raw_new=raw.copy() not just raw_new=raw. The last command doesn't create a new object, the whole raw will be changed and this will also be passed to other functions even if you don't return the raw.
+    raw_cropped = raw.crop(tmin=default_settings['crop_tmin'], tmax=tmax)
+    if memmap_dir is not None:
+        #data is not loaded yet, so only the cropped part is read into the memory mapped file:
+        raw_cropped = make_memmap_copy(raw_cropped, memmap_dir)
+    #Cropped in place: the uncropped data is not used anywhere further, so no need to keep a copy of it.
+    #Other versions of the data (filtered, resampled, epoched) are not made here, but added to the data store.
+    #They are made from raw_cropped only when some metric asks for them for the first time (see SignalStore).
 
     stim_deriv = stim_data_to_df(raw_cropped)
 
+    data_store = SignalStore()
+    data_store.add_signal('raw_cropped', raw_cropped)
+
     #Data filtering:
-    raw_cropped_filtered = raw_cropped.copy()
     if filtering_settings['apply_filtering'] is True:
-        raw_cropped.load_data() #Data has to be loaded into mememory before filetering:
-        raw_cropped_filtered = raw_cropped.copy()
 
         #if filtering_settings['h_freq'] is higher than the Nyquist frequency, set it to Nyquist frequency:
-        if filtering_settings['h_freq'] > raw_cropped_filtered.info['sfreq']/2 - 1:
-            filtering_settings['h_freq'] = raw_cropped_filtered.info['sfreq']/2 - 1
+        if filtering_settings['h_freq'] > raw_cropped.info['sfreq']/2 - 1:
+            filtering_settings['h_freq'] = raw_cropped.info['sfreq']/2 - 1
             print('___MEGqc___: ', 'High frequency for filtering is higher than Nyquist frequency. High frequency was set to Nyquist frequency:', filtering_settings['h_freq'])
-        raw_cropped_filtered.filter(l_freq=filtering_settings['l_freq'], h_freq=filtering_settings['h_freq'], picks='meg', method=filtering_settings['method'], iir_params=None)
-        print('___MEGqc___: ', 'Data filtered from', filtering_settings['l_freq'], 'to', filtering_settings['h_freq'], 'Hz.')
+
+        def filter_data(raw_cropped):
+            if memmap_dir is None:
+                raw_cropped.load_data() #Data has to be loaded into mememory before filetering:
+                raw_cropped_filtered = raw_cropped.copy()
+            else:
+                raw_cropped_filtered = make_memmap_copy(raw_cropped, memmap_dir) #filtered in place in the file
+            raw_cropped_filtered.filter(l_freq=filtering_settings['l_freq'], h_freq=filtering_settings['h_freq'], picks='meg', method=filtering_settings['method'], iir_params=None)
+            print('___MEGqc___: ', 'Data filtered from', filtering_settings['l_freq'], 'to', filtering_settings['h_freq'], 'Hz.')
+            return raw_cropped_filtered
         
         if filtering_settings['downsample_to_hz'] is False:
-            raw_cropped_filtered_resampled = raw_cropped_filtered.copy()
+            resample_to = None
             resample_str = 'Data not resampled. '
-            print('___MEGqc___: ', resample_str)
         elif filtering_settings['downsample_to_hz'] >= filtering_settings['h_freq']*5:
-            raw_cropped_filtered_resampled = raw_cropped_filtered.copy().resample(sfreq=filtering_settings['downsample_to_hz'])
+            resample_to = filtering_settings['downsample_to_hz']
             resample_str = 'Data resampled to ' + str(filtering_settings['downsample_to_hz']) + ' Hz. '
-            print('___MEGqc___: ', resample_str)
         else:
-            raw_cropped_filtered_resampled = raw_cropped_filtered.copy().resample(sfreq=filtering_settings['h_freq']*5)
+            resample_to = filtering_settings['h_freq']*5
             #frequency to resample is 5 times higher than the maximum chosen frequency of the function
             resample_str = 'Chosen "downsample_to_hz" value set was too low, it must be at least 5 time higher than the highest filer frequency. Data resampled to ' + str(filtering_settings['h_freq']*5) + ' Hz. '
-            print('___MEGqc___: ', resample_str)
-
+        print('___MEGqc___: ', resample_str)
             
     else:
         print('___MEGqc___: ', 'Data not filtered.')
+
+        def filter_data(raw_cropped):
+            return raw_cropped
+
         #And downsample:
         if filtering_settings['downsample_to_hz'] is not False:
-            raw_cropped_filtered_resampled = raw_cropped_filtered.copy().resample(sfreq=filtering_settings['downsample_to_hz'])
+            resample_to = filtering_settings['downsample_to_hz']
             if filtering_settings['downsample_to_hz'] < 500:
                 resample_str = 'Data resampled to ' + str(filtering_settings['downsample_to_hz']) + ' Hz. Keep in mind: resampling to less than 500Hz is not recommended, since it might result in high frequency data loss (for example of the CHPI coils signal. '
                 print('___MEGqc___: ', resample_str)
@@ -970,76 +1116,71 @@ def initial_processing(default_settings: dict, filtering_settings: dict, epochin
                 resample_str = 'Data resampled to ' + str(filtering_settings['downsample_to_hz']) + ' Hz. '
                 print('___MEGqc___: ', resample_str)
         else:
-            raw_cropped_filtered_resampled = raw_cropped_filtered.copy()
+            resample_to = None
             resample_str = 'Data not resampled. '
             print('___MEGqc___: ', resample_str)
 
+    def resample_data(raw_cropped_filtered):
+        if resample_to is None or resample_to == raw_cropped_filtered.info['sfreq']:
+            return raw_cropped_filtered #nothing to change, share the same data
+        if memmap_dir is None:
+            return raw_cropped_filtered.copy().load_data().resample(sfreq=resample_to)
+        #resample only reads the data of the parent, so the file is shared instead of copied. 
+        #Resampled data is made in memory by MNE, then moved into the file:
+        raw_shared = mne.io.RawArray(raw_cropped_filtered._data, raw_cropped_filtered.info, first_samp=raw_cropped_filtered.first_samp, verbose=False)
+        raw_shared.set_annotations(raw_cropped_filtered.annotations)
+        return make_memmap_copy(raw_shared.resample(sfreq=resample_to), memmap_dir)
+
+    data_store.add_lazy_signal('raw_cropped_filtered', filter_data, parent='raw_cropped')
+    data_store.add_lazy_signal('raw_cropped_filtered_resampled', resample_data, parent='raw_cropped_filtered')
+
         
     #Apply epoching: USE NON RESAMPLED DATA. Or should we resample after epoching? 
     # Since sampling freq is 1kHz and resampling is 500Hz, it s not that much of a win...
 
-    dict_epochs_mg = Epoch_meg(epoching_params, data=raw_cropped_filtered)
+    #Events are found right away (stimulus channels are not filtered), so we know if epoching is possible
+    #before the filtered data is made:
+    events = find_epoching_events(epoching_params, data=raw_cropped)
+
+    def epoch_data(raw_cropped_filtered):
+        if events is None:
+            return {'mag': None, 'grad': None}
+        return Epoch_meg(epoching_params, data=raw_cropped_filtered, events=events)
+
+    data_store.add_lazy_signal('epochs', epoch_data, parent='raw_cropped_filtered')
+
     epoching_str = ''
-    if dict_epochs_mg['mag'] is None and dict_epochs_mg['grad'] is None:
+    if events is None:
         epoching_str = ''' <p>No epoching could be done in this data set: no events found. Quality measurement were only performed on the entire time series. If this was not expected, try: 1) checking the presence of stimulus channel in the data set, 2) setting stimulus channel explicitly in config file, 3) setting different event duration in config file.</p><br></br>'''
 
 
     resample_str = '<p>' + resample_str + '</p>'
 
-    #Extract chs_by_lobe into a data frame
-    sensors_derivs = chs_dict_to_csv(chs_by_lobe,  file_name_prefix = 'Sensors')
+    #Extract channel table into a data frame
+    sensors_derivs = channel_table_to_csv(channel_table,  file_name_prefix = 'Sensors')
 
-    return meg_system, dict_epochs_mg, chs_by_lobe, channels, raw_cropped_filtered, raw_cropped_filtered_resampled, raw_cropped, raw, info_derivs, stim_deriv, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str
+    return meg_system, data_store, channel_table, channels, info_derivs, stim_deriv, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str
 
 
-def chs_dict_to_csv(chs_by_lobe: dict, file_name_prefix: str):
+def channel_table_to_csv(channel_table: ChannelTable, file_name_prefix: str):
 
     """
-    Convert dictionary with channels objects to a data frame and save it as a csv file.
+    Convert the channel table (with results of a metric) to a data frame to be saved as a csv file.
 
     Parameters
     ----------
-    chs_by_lobe : dict
-        Dictionary with channel objects for each channel type: mag, grad. And by lobe. Each obj hold info about the channel name, 
-        lobe area and color code, locations and (in the future) pther info, like: if it has noise of any sort.
+    channel_table : ChannelTable
+        Table with all channels and the results of the metric.
     file_name_prefix : str
         Prefix for the file name. Example: 'Sensors' will result in file name 'Sensors.csv'.
 
     Returns
     -------
     df_deriv : list
-        List with data frames with sensors info.
+        List with data frames with channels info.
 
     """
 
-    #Extract chs_by_lobe into a data frame
-    chs_by_lobe_df = {k1: {k2: pd.concat([channel.to_df() for channel in v2]) for k2, v2 in v1.items()} for k1, v1 in chs_by_lobe.items()}
-
-    its = []
-    for ch_type, content in chs_by_lobe_df.items():
-        for lobe, items in content.items():
-            its.append(items)
-
-    df_fin = pd.concat(its)
-
-    # if df already contains columns like 'STD epoch_' with numbers, 'STD epoch' needs to be removed from the data frame:
-    if 'STD epoch' in df_fin and any(col.startswith('STD epoch_') and col[10:].isdigit() for col in df_fin.columns):
-        # If there are, drop the 'STD epoch' column
-        df_fin = df_fin.drop(columns='STD epoch')
-    if 'PtP epoch' in df_fin and any(col.startswith('PtP epoch_') and col[10:].isdigit() for col in df_fin.columns):
-        # If there are, drop the 'PtP epoch' column
-        df_fin = df_fin.drop(columns='PtP epoch')
-    if 'PSD' in df_fin and any(col.startswith('PSD_') and col[4:].isdigit() for col in df_fin.columns):
-        # If there are, drop the 'STD epoch' column
-        df_fin = df_fin.drop(columns='PSD')
-    if 'ECG' in df_fin and any(col.startswith('ECG_') and col[4:].isdigit() for col in df_fin.columns):
-        # If there are, drop the 'STD epoch' column
-        df_fin = df_fin.drop(columns='ECG')
-    if 'EOG' in df_fin and any(col.startswith('EOG_') and col[4:].isdigit() for col in df_fin.columns):
-        # If there are, drop the 'STD epoch' column
-        df_fin = df_fin.drop(columns='EOG')
-
-
-    df_deriv = [QC_derivative(content = df_fin, name = file_name_prefix, content_type = 'df')]
-
-    return df_deriv
\ No newline at end of file
+    df_deriv = [QC_derivative(content = channel_table.to_df(), name = file_name_prefix, content_type = 'df')]
+
+    return df_deriv
@@ -6,7 +6,11 @@ import json
 import sys
 import mne
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Union
+from collections import deque
+from itertools import islice
 
 # Needed to import the modules without specifying the full path, for command line and jupyter notebook
 sys.path.append(os.path.join('.'))
@@ -23,6 +27,10 @@ sys.path.append(os.path.join('..', '..', '..', '..', 'meg_qc', 'calculation'))
 
 
 from meg_qc.calculation.initial_meg_qc import get_all_config_params, initial_processing, get_internal_config_params
+from meg_qc.calculation.qc_cache import get_file_hash, make_cache_key, load_cached_result, save_cached_result
+from meg_qc.calculation.signal_store import SignalStore, SpectrumCache
+from meg_qc.calculation.parallel_jobs import bounded_n_jobs
+from meg_qc.calculation.derivative_formats import check_binary_df_format, write_df_binary, BINARY_DF_FORMATS, check_container_format, write_derivative_container, CONTAINER_FORMATS, CONTAINER_DESC
 # from meg_qc.plotting.universal_html_report import make_joined_report, make_joined_report_mne
 from meg_qc.plotting.universal_plots import QC_derivative
 
@@ -486,7 +494,557 @@ def check_sub_list(sub_list: Union[List[str], str], dataset):
 
     return sub_list
 
-def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_path: str, ds_paths: Union[List[str], str], sub_list: Union[List[str], str] = 'all'):
+def run_metrics_dag(metric_tasks: dict, n_threads: int = 1):
+
+    """
+    Run QC metrics of one data file respecting the dependencies between them.
+
+    Metrics which dont depend on each other run concurrently in a pool of threads 
+    (most of the time is spent in numpy/scipy/mne which release the GIL). 
+    A metric is started as soon as all the metrics it depends on are finished.
+    
+    MNE objects are not thread safe (for example, reading data checks and updates raw.info), 
+    so 2 metrics which use the same data object (same Raw or Epochs) are never run at the same time.
+    With n_threads=1 metrics run one after another in the order they were added.
+
+    Parameters
+    ----------
+    metric_tasks : dict
+        Dictionary: metric name -> (function, list of metric names it depends on, list of names of data objects it uses).
+        The function gets the dictionary of results of already finished metrics as the only argument.
+        Metrics have to be added after the metrics they depend on.
+    n_threads : int
+        Number of threads to run the metrics in.
+
+    Returns
+    -------
+    metric_results : dict
+        Dictionary: metric name -> whatever the metric function returned.
+
+    """
+
+    for metric, (_, deps, _) in metric_tasks.items():
+        missing_deps = [dep for dep in deps if dep not in metric_tasks]
+        if missing_deps:
+            raise ValueError('Metric ' + metric + ' depends on metrics which are not going to be calculated: ' + str(missing_deps))
+
+    def run_metric(metric, results):
+        print('___MEGqc___: ', 'Starting ' + metric + '...')
+        start_time = time.time()
+        result = metric_tasks[metric][0](results)
+        print('___MEGqc___: ', 'Finished ' + metric + '. --- Execution %s seconds ---' % (time.time() - start_time))
+        return result
+
+    metric_results = {}
+
+    if n_threads <= 1 or len(metric_tasks) <= 1:
+        for metric in metric_tasks:
+            metric_results[metric] = run_metric(metric, metric_results)
+        return metric_results
+
+    pending = dict(metric_tasks)
+    running = {}
+    data_in_use = set()
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while pending or running:
+            # start every metric which has all dependencies finished and all its data free:
+            for metric, (_, deps, data_used) in list(pending.items()):
+                if all(dep in metric_results for dep in deps) and data_in_use.isdisjoint(data_used):
+                    del pending[metric]
+                    data_in_use.update(data_used)
+                    running[executor.submit(run_metric, metric, dict(metric_results))] = metric
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                metric = running.pop(future)
+                data_in_use.difference_update(metric_tasks[metric][2])
+                metric_results[metric] = future.result()
+
+    # keep the same order as metrics were given:
+    return {metric: metric_results[metric] for metric in metric_tasks}
+
+
+def get_cache_keys(data_file: str, all_qc_params: dict, internal_qc_params: dict, cache_dir: str):
+
+    """
+    Make cache keys for initial processing and every metric chosen in config for one data file.
+
+    Every key depends on the content of the data file, on the settings which change the data all metrics 
+    are calculated on (channel types, cropping, [Filtering], [Epoching]), on the config sections of the metric itself
+    and on the MEG QC version. Muscle also depends on PSD settings, since it uses noise frequencies found by PSD.
+
+    Parameters
+    ----------
+    data_file : str
+        Path to the data file (fif or ds).
+    all_qc_params : dict
+        Dictionary with all the parameters from the user config file.
+    internal_qc_params : dict
+        Dictionary with all the parameters from the internal config file.
+    cache_dir : str
+        Path to the cache directory.
+
+    Returns
+    -------
+    cache_keys : dict
+        Dictionary: 'Initial processing' or metric name -> cache key.
+
+    """
+
+    default_params = all_qc_params['default']
+    file_hash = get_file_hash(data_file, cache_dir)
+
+    data_settings = [{key: default_params[key] for key in ('m_or_g_chosen', 'crop_tmin', 'crop_tmax')}, all_qc_params['Filtering'], all_qc_params['Epoching']]
+
+    metric_settings = {'Initial processing': []}
+    if default_params['run_STD'] is True:
+        metric_settings['STD'] = [all_qc_params['STD']]
+    if default_params['run_PSD'] is True:
+        metric_settings['PSD'] = [all_qc_params['PSD'], internal_qc_params['PSD']]
+    if default_params['run_PTP_manual'] is True:
+        metric_settings['Peak-to-Peak manual'] = [all_qc_params['PTP_manual']]
+    if default_params['run_PTP_auto_mne'] is True:
+        metric_settings['Peak-to-Peak auto'] = [all_qc_params['PTP_auto']]
+    if default_params['run_ECG'] is True:
+        metric_settings['ECG'] = [all_qc_params['ECG'], internal_qc_params['ECG']]
+    if default_params['run_EOG'] is True:
+        metric_settings['EOG'] = [all_qc_params['EOG'], internal_qc_params['EOG']]
+    if default_params['run_Head'] is True:
+        metric_settings['Head movement calculation'] = [all_qc_params['Head']]
+    if default_params['run_Muscle'] is True:
+        metric_settings['Muscle artifacts calculation'] = [all_qc_params['Muscle'], all_qc_params['PSD'], internal_qc_params['PSD'], {'run_PSD': default_params['run_PSD']}]
+
+    cache_keys = {name: make_cache_key(file_hash, [name] + data_settings + settings) for name, settings in metric_settings.items()}
+
+    return cache_keys
+
+
+def save_metric_to_cache(result: tuple, cache_dir: str, key: str):
+
+    """
+    Save the output of a metric function into cache and give it back.
+    Raw data objects in the output are not saved (replaced by None): they are big and are not used after the metric is done.
+
+    Parameters
+    ----------
+    result : tuple
+        Whatever the metric function returned.
+    cache_dir : str
+        Path to the cache directory.
+    key : str
+        Cache key of this metric for this file.
+
+    Returns
+    -------
+    result : tuple
+        Same result as given.
+
+    """
+
+    save_cached_result(cache_dir, key, tuple(None if isinstance(output, mne.io.BaseRaw) else output for output in result))
+
+    return result
+
+
+def release_data_after(metric_func, results: dict, data_store, metric: str):
+
+    """
+    Run the metric function and release the data versions it used in the data store (even if the metric failed),
+    so the versions no other metric needs are dropped from memory right away.
+
+    Parameters
+    ----------
+    metric_func : Callable
+        Metric function, takes the results of already finished metrics.
+    results : dict
+        Results of already finished metrics.
+    data_store : SignalStore
+        Store with the data versions of this file.
+    metric : str
+        Name of the metric it was registered with in the data store.
+
+    Returns
+    -------
+    tuple
+        Whatever the metric function returned.
+
+    """
+
+    try:
+        return metric_func(results)
+    finally:
+        data_store.release(metric)
+
+
+def process_one_file(data_file: str, all_qc_params: dict, internal_qc_params: dict, cache_dir: str = None):
+
+    """
+    Run initial processing and all the QC metrics chosen in config on one data file.
+
+    This is the unit of work of the pipeline: it does not touch the ancpbids derivative objects,
+    only returns the calculated derivatives. This way it can be run either in the main process 
+    or in a worker process (see jobs in make_derivative_meg_qc).
+
+    Parameters
+    ----------
+    data_file : str
+        Path to the data file (fif or ds).
+    all_qc_params : dict
+        Dictionary with all the parameters from the user config file.
+    internal_qc_params : dict
+        Dictionary with all the parameters from the internal config file.
+    cache_dir : str
+        Path to the cache directory. Results found there are restored instead of calculated, 
+        new results are saved there. If all chosen metrics are in cache, the data is not even loaded.
+        None: no cache is used.
+
+    Returns
+    -------
+    QC_derivs : dict
+        Dictionary with sections of QC_derivative objects for this file.
+    avg_objects_ecg : List
+        List of Avg_artif objects for the ECG artifact (empty if ECG was not calculated).
+    avg_objects_eog : List
+        List of Avg_artif objects for the EOG artifact (empty if EOG was not calculated).
+
+    """
+
+    print('___MEGqc___: ', 'Processing file: ', data_file)
+
+    # Preassign strings with notes for the user to add to html report (in case some QC analysis was skipped):
+    shielding_str, m_or_g_skipped_str, epoching_str, ecg_str, eog_str, head_str, muscle_str, pp_manual_str, pp_auto_str, std_str, psd_str = '', '', '', '', '', '', '', '', '', '', ''
+
+    # Scratch directory for memory mapped data of this file, removed when the metrics are done:
+    memmap_dir = None
+    if all_qc_params['default']['memmap_dir'] is not None:
+        os.makedirs(all_qc_params['default']['memmap_dir'], exist_ok=True)
+        memmap_dir = tempfile.mkdtemp(prefix='MEGqc_', dir=all_qc_params['default']['memmap_dir'])
+
+    try:
+        cached_results = {}
+        if cache_dir is not None:
+            cache_keys = get_cache_keys(data_file, all_qc_params, internal_qc_params, cache_dir)
+            cached_results = {name: load_cached_result(cache_dir, key) for name, key in cache_keys.items()}
+            cached_results = {name: result for name, result in cached_results.items() if result is not None}
+
+        if cache_dir is not None and len(cached_results) == len(cache_keys):
+            # everything is in cache - no need to load the data:
+            print('___MEGqc___: ', 'All chosen metrics for this file are restored from cache.')
+            info_derivs, stim_deriv, sensors_derivs, shielding_str, epoching_str, m_or_g_skipped_str, lobes_color_coding_str, resample_str = cached_results['Initial processing']
+            data_store = SignalStore() # no data versions needed, nothing will be calculated
+
+        else:
+            print('___MEGqc___: ', 'Starting initial processing...')
+            start_time = time.time()
+
+            meg_system, data_store, channel_table, channels, info_derivs, stim_deriv, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str = initial_processing(default_settings=all_qc_params['default'], filtering_settings=all_qc_params['Filtering'], epoching_params=all_qc_params['Epoching'], file_path=data_file, memmap_dir=memmap_dir)
+    
+            # Commented out this, because it would cover the actual error while allowing to continue processing.
+            # I wanna see the actual error. Often it happens while reading raw and says: 
+            # file '...' does not start with a file id tag
+    
+            # try:
+            #     dict_epochs_mg, chs_by_lobe, channels, raw_cropped_filtered, raw_cropped_filtered_resampled, raw_cropped, raw, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str = initial_processing(default_settings=all_qc_params['default'], filtering_settings=all_qc_params['Filtering'], epoching_params=all_qc_params['Epoching'], file_path=data_file)
+            # except:
+            #     print('___MEGqc___: ', 'Could not process file ', data_file, '. Skipping it.')
+            #     #in case some file can not be processed, the pipeline will continue. To figure out the issue, run the file separately: raw=mne.io.read_raw_fif('.../filepath/...fif')
+            #     continue
+    
+            print('___MEGqc___: ', "Finished initial processing. --- Execution %s seconds ---" % (time.time() - start_time))
+
+            if cache_dir is not None:
+                save_cached_result(cache_dir, cache_keys['Initial processing'], (info_derivs, stim_deriv, sensors_derivs, shielding_str, epoching_str, m_or_g_skipped_str, lobes_color_coding_str, resample_str))
+
+        # QC measurements:
+
+        #predefine in case some metrics are not calculated:
+        noisy_freqs_global = None #if we run PSD, this will be properly defined. It is used as an input for Muscle and is supposed to represent powerline noise.
+        std_derivs, psd_derivs, pp_manual_derivs, pp_auto_derivs, ecg_derivs, eog_derivs, head_derivs, muscle_derivs = [],[],[],[],[], [],  [], []
+        simple_metrics_psd, simple_metrics_std, simple_metrics_pp_manual, simple_metrics_pp_auto, simple_metrics_ecg, simple_metrics_eog, simple_metrics_head, simple_metrics_muscle = [],[],[],[],[],[], [], []
+        avg_objects_ecg, avg_objects_eog = [], []
+
+
+        # Every metric is a task with the list of other metrics it needs the results of and the data objects it reads.
+        # All of them only read the data prepared in initial processing, except Muscle: 
+        # it takes noisy_freqs_global from PSD (if PSD is calculated).
+        metric_tasks = {}
+
+        # Spectra are shared: the spectrum of the same data with the same parameters is estimated only once per file:
+        psd_cache = SpectrumCache()
+
+        if all_qc_params['default']['run_STD'] is True:
+            metric_tasks['STD'] = (lambda results: STD_meg_qc(all_qc_params['STD'], channels, channel_table, data_store['epochs'], data_store['raw_cropped_filtered_resampled'], m_or_g_chosen), [], ['epochs', 'raw_cropped_filtered_resampled'])
+
+        if all_qc_params['default']['run_PSD'] is True:
+            metric_tasks['PSD'] = (lambda results: PSD_meg_qc(all_qc_params['PSD'], internal_qc_params['PSD'], channels, channel_table, data_store['raw_cropped_filtered'], m_or_g_chosen, helper_plots=False, psd_cache=psd_cache, data_variant='raw_cropped_filtered'), [], ['raw_cropped_filtered'])
+
+        if all_qc_params['default']['run_PTP_manual'] is True:
+            metric_tasks['Peak-to-Peak manual'] = (lambda results: PP_manual_meg_qc(all_qc_params['PTP_manual'], channels, channel_table, data_store['epochs'], data_store['raw_cropped_filtered_resampled'], m_or_g_chosen), [], ['epochs', 'raw_cropped_filtered_resampled'])
+
+        if all_qc_params['default']['run_PTP_auto_mne'] is True:
+            metric_tasks['Peak-to-Peak auto'] = (lambda results: PP_auto_meg_qc(all_qc_params['PTP_auto'], channels, data_store['raw_cropped_filtered_resampled'], m_or_g_chosen), [], ['raw_cropped_filtered_resampled'])
+
+        if all_qc_params['default']['run_ECG'] is True:
+            metric_tasks['ECG'] = (lambda results: ECG_meg_qc(all_qc_params['ECG'], internal_qc_params['ECG'], data_store['raw_cropped'], channels, channel_table, m_or_g_chosen), [], ['raw_cropped'])
+
+        if all_qc_params['default']['run_EOG'] is True:
+            metric_tasks['EOG'] = (lambda results: EOG_meg_qc(all_qc_params['EOG'], internal_qc_params['EOG'], data_store['raw_cropped'], channels, channel_table, m_or_g_chosen), [], ['raw_cropped'])
+
+        if all_qc_params['default']['run_Head'] is True:
+            metric_tasks['Head movement calculation'] = (lambda results: HEAD_movement_meg_qc(data_store['raw_cropped']), [], ['raw_cropped'])
+
+        if all_qc_params['default']['run_Muscle'] is True:
+            #noisy_freqs_global is supposed to represent powerline noise. If PSD is not calculated, Muscle gets None.
+            muscle_deps = ['PSD'] if 'PSD' in metric_tasks else []
+            metric_tasks['Muscle artifacts calculation'] = (lambda results: MUSCLE_meg_qc(all_qc_params['Muscle'], all_qc_params['PSD'], internal_qc_params['PSD'], channels, data_store['raw_cropped_filtered'], results['PSD'][3] if 'PSD' in results else None, m_or_g_chosen, attach_dummy = True, cut_dummy = True, psd_cache=psd_cache, data_variant='raw_cropped_filtered'), muscle_deps, ['raw_cropped_filtered'])
+
+        if cache_dir is not None:
+            for metric, (metric_func, deps, data_used) in metric_tasks.items():
+                if metric in cached_results:
+                    print('___MEGqc___: ', metric + ' restored from cache.')
+                    metric_tasks[metric] = (lambda results, cached=cached_results[metric]: cached, [], [])
+                else:
+                    metric_tasks[metric] = (lambda results, metric_func=metric_func, key=cache_keys[metric]: save_metric_to_cache(metric_func(results), cache_dir, key), deps, data_used)
+
+        # Data versions are kept in the store only while some metric still needs them:
+        for metric, (metric_func, deps, data_used) in metric_tasks.items():
+            data_store.register(metric, data_used)
+            metric_tasks[metric] = (lambda results, metric=metric, metric_func=metric_func: release_data_after(metric_func, results, data_store, metric), deps, data_used)
+
+        if all_qc_params['default']['metrics_n_threads'] > 1:
+            # make the versions before starting metrics in parallel, so none is made from the data another metric is reading:
+            data_store.build_registered()
+
+        metric_results = run_metrics_dag(metric_tasks, n_threads=all_qc_params['default']['metrics_n_threads'])
+    finally:
+        data_store = None # memory mapped files are closed when the data objects are gone
+        if memmap_dir is not None:
+            shutil.rmtree(memmap_dir, ignore_errors=True)
+
+    if 'STD' in metric_results:
+        std_derivs, simple_metrics_std, std_str = metric_results['STD']
+    if 'PSD' in metric_results:
+        psd_derivs, simple_metrics_psd, psd_str, noisy_freqs_global = metric_results['PSD']
+    if 'Peak-to-Peak manual' in metric_results:
+        pp_manual_derivs, simple_metrics_pp_manual, pp_manual_str = metric_results['Peak-to-Peak manual']
+    if 'Peak-to-Peak auto' in metric_results:
+        pp_auto_derivs, bad_channels, pp_auto_str = metric_results['Peak-to-Peak auto']
+    if 'ECG' in metric_results:
+        ecg_derivs, simple_metrics_ecg, ecg_str, avg_objects_ecg = metric_results['ECG']
+    if 'EOG' in metric_results:
+        eog_derivs, simple_metrics_eog, eog_str, avg_objects_eog = metric_results['EOG']
+    if 'Head movement calculation' in metric_results:
+        head_derivs, simple_metrics_head, head_str, df_head_pos, head_pos = metric_results['Head movement calculation']
+    if 'Muscle artifacts calculation' in metric_results:
+        muscle_derivs, simple_metrics_muscle, muscle_str, scores_muscle_all3, raw3 = metric_results['Muscle artifacts calculation']
+
+    
+    report_strings = {
+    'INITIAL_INFO': m_or_g_skipped_str+resample_str+epoching_str+shielding_str+lobes_color_coding_str,
+    'STD': std_str,
+    'PSD': psd_str,
+    'PTP_MANUAL': pp_manual_str,
+    'PTP_AUTO': pp_auto_str,
+    'ECG': ecg_str,
+    'EOG': eog_str,
+    'HEAD': head_str,
+    'MUSCLE': muscle_str,
+    'STIMULUS': 'If the data was cropped for this calculation, the stimulus data is also cropped.'}
+
+    # Save report strings as json to read it back in when plotting:
+    report_str_derivs=[QC_derivative(report_strings, 'ReportStrings', 'json')]
+    
+
+    QC_derivs={
+    'Raw info': info_derivs,
+    'Stimulus channels': stim_deriv,
+    'Report_strings': report_str_derivs,
+    'Sensors locations': sensors_derivs,
+    'Standard deviation of the data': std_derivs, 
+    'Frequency spectrum': psd_derivs, 
+    'Peak-to-Peak manual': pp_manual_derivs, 
+    'Peak-to-Peak auto from MNE': pp_auto_derivs, 
+    'ECG': ecg_derivs, 
+    'EOG': eog_derivs,
+    'Head movement artifacts': head_derivs,
+    'High frequency (Muscle) artifacts': muscle_derivs}
+
+    QC_simple={
+    'STD': simple_metrics_std, 
+    'PSD': simple_metrics_psd,
+    'PTP_MANUAL': simple_metrics_pp_manual, 
+    'PTP_AUTO': simple_metrics_pp_auto,
+    'ECG': simple_metrics_ecg, 
+    'EOG': simple_metrics_eog,
+    'HEAD': simple_metrics_head,
+    'MUSCLE': simple_metrics_muscle}  
+
+    #Collect all simple metrics into a dictionary and add to QC_derivs:
+    QC_derivs['Simple_metrics']=[QC_derivative(QC_simple, 'SimpleMetrics', 'json')]
+
+    return QC_derivs, avg_objects_ecg, avg_objects_eog
+
+
+def add_derivs_to_subject_folder(QC_derivs: dict, subject_folder, raw_entities, counter: int = 0, binary_df_format: str = None, container_format: str = None):
+
+    """
+    Register the derivatives of one data file as artifacts in the subject folder of the ancpbids derivative.
+    Only the content is attached here (as writer functions), the actual writing happens in ancpbids.write_derivative.
+
+    Parameters
+    ----------
+    QC_derivs : dict
+        Dictionary with sections of QC_derivative objects for one data file (output of process_one_file).
+    subject_folder : ancpbids folder
+        Folder of the subject inside the derivative.
+    raw_entities : ancpbids artifact
+        Raw data file the derivatives belong to, the BIDS entities are taken from it.
+    counter : int
+        Running count of created artifacts, only used for printing.
+    binary_df_format : str
+        'parquet' or 'feather': data frame derivatives are also written as binary files of this format, next to the tsv files.
+        None: only tsv files.
+    container_format : str
+        'hdf5' or 'zarr': all table, json and info derivatives are written into one container of this format (desc-MEGqc),
+        only SimpleMetrics json is still written as separate file. None: every derivative is written as separate file.
+
+    Returns
+    -------
+    counter : int
+        Updated count of created artifacts.
+
+    """
+
+    if container_format is not None:
+        container_derivs = [deriv for section in QC_derivs.values() if section for deriv in section if deriv.content_type in ('df', 'json', 'info')]
+
+        container_artifact = subject_folder.create_artifact(raw=raw_entities)
+        counter +=1
+        container_artifact.add_entity('desc', CONTAINER_DESC)
+        container_artifact.suffix = 'meg'
+        container_artifact.extension = CONTAINER_FORMATS[container_format]
+        container_artifact.content = lambda file_path, cont=container_derivs: write_derivative_container(cont, file_path, container_format)
+
+    #if there are any derivs calculated in this section:
+    for section in (section for section in QC_derivs.values() if section):
+        # loop over section where deriv.content_type is not 'matplotlib' or 'plotly' or 'report'
+        for deriv in (deriv for deriv in section if deriv.content_type != 'matplotlib' and deriv.content_type != 'plotly' and deriv.content_type != 'report'):
+
+            if container_format is not None and deriv.name != 'SimpleMetrics':
+                continue # already in the container. SimpleMetrics stays a separate file: plotting and summaries find the data files by it
+
+            # This is how you would save matplotlib, plotly and reports separately with ancpbids:
+
+            # print('___MEGqc___: ', 'writing deriv: ', d)
+            # print('___MEGqc___: ', deriv)
+
+            # if deriv.content_type == 'matplotlib':
+            #     continue
+            #     meg_artifact.extension = '.png'
+            #     meg_artifact.content = lambda file_path, cont=deriv.content: cont.savefig(file_path) 
+
+            # elif deriv.content_type == 'plotly':
+            #     continue
+            #     meg_artifact.content = lambda file_path, cont=deriv.content: cont.write_html(file_path)
+
+            # elif deriv.content_type == 'report':
+            #     def html_writer(file_path, cont=deriv.content):
+            #         with open(file_path, "w") as file:
+            #             file.write(cont)
+            #         #'with'command doesnt work in lambda
+            #     meg_artifact.content = html_writer # function pointer instead of lambda
+
+            meg_artifact = subject_folder.create_artifact(raw=raw_entities) #shell. empty derivative
+
+            counter +=1
+            print('___MEGqc___: ', 'counter of subject_folder.create_artifact', counter)
+
+            meg_artifact.add_entity('desc', deriv.name) #file name
+            meg_artifact.suffix = 'meg'
+            meg_artifact.extension = '.html'
+
+            if deriv.content_type == 'df':
+                meg_artifact.extension = '.tsv'
+                meg_artifact.content = lambda file_path, cont=deriv.content: cont.to_csv(file_path, sep='\t')
+
+                if binary_df_format is not None:
+                    # same table in columnar binary format, faster to read for plotting:
+                    binary_artifact = subject_folder.create_artifact(raw=raw_entities)
+                    binary_artifact.add_entity('desc', deriv.name)
+                    binary_artifact.suffix = 'meg'
+                    binary_artifact.extension = BINARY_DF_FORMATS[binary_df_format]
+                    binary_artifact.content = lambda file_path, cont=deriv.content: write_df_binary(cont, file_path, binary_df_format)
+
+            elif deriv.content_type == 'json':
+                meg_artifact.extension = '.json'
+                def json_writer(file_path, cont=deriv.content):
+                    with open(file_path, "w") as file_wrapper:
+                        json.dump(cont, file_wrapper, indent=4)
+                meg_artifact.content = json_writer # function pointer instead of lambda
+
+            elif deriv.content_type == 'info':
+                meg_artifact.extension = '.fif'
+                meg_artifact.content = lambda file_path, cont=deriv.content: mne.io.write_info(file_path, cont)
+
+            else:
+                print('___MEGqc___: ', meg_artifact.name)
+                meg_artifact.content = 'dummy text'
+                meg_artifact.extension = '.txt'
+            # problem with lambda explained:
+            # https://docs.python.org/3/faq/programming.html#why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
+
+    return counter
+
+
+def write_file_derivs(dataset, file_folder):
+
+    """
+    Write the artifacts of one data file to disk and release them (with them - the derivatives they hold).
+
+    Parameters
+    ----------
+    dataset : ancpbids object
+        The dataset the derivative belongs to.
+    file_folder : ancpbids folder
+        Subject folder with the artifacts of this data file only.
+
+    """
+
+    ancpbids.save_dataset(dataset, target_dir=dataset.get_absolute_path(), context_folder=file_folder)
+    file_folder.files.clear()
+
+
+def write_derivs_in_background(writer: ThreadPoolExecutor, pending_writes: list, dataset, file_folder, write_queue_size: int):
+
+    """
+    Write the derivatives of one data file to disk in the background writer thread, while the next data file is processed.
+    If more than write_queue_size data files are waiting to be written, wait until the oldest one is written:
+    the derivatives of written files are released, so the memory used for them stays bounded during the run.
+
+    Parameters
+    ----------
+    writer : ThreadPoolExecutor
+        Executor with 1 thread which writes the derivatives one data file after another.
+    pending_writes : list
+        Futures of the writes submitted before, oldest first. Updated in place.
+    dataset : ancpbids object
+        The dataset the derivative belongs to.
+    file_folder : ancpbids folder
+        Subject folder with the artifacts of this data file only. It must be detached from the derivative
+        (not in the folders of its parent), so that ancpbids.write_derivative at the end does not write it again.
+    write_queue_size : int
+        Max number of data files waiting to be written.
+
+    """
+
+    pending_writes.append(writer.submit(write_file_derivs, dataset, file_folder))
+
+    while len(pending_writes) > write_queue_size:
+        pending_writes.pop(0).result() # errors of writing are raised here
+
+
+def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_path: str, ds_paths: Union[List[str], str], sub_list: Union[List[str], str] = 'all', jobs: int = 1):
 
     """ 
     Main function of MEG QC:
@@ -508,6 +1066,9 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
         List of paths to the BIDS-conform data sets to run the QC on. Has to be list even if there is just one path.
     sub_list : list or str
         List of subjects to run the QC on. Can be 'all' or 1 subj like '009' or list of several subjects like ['009', '012'].
+    jobs : int
+        Number of worker processes. Every data file (of every subject) is processed in a separate worker, 
+        the derivatives are collected in the main process and written with ancpbids. Default 1: no parallel processing.
     """
 
     ds_paths = check_ds_paths(ds_paths)
@@ -545,6 +1106,12 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
         if all_qc_params is None:
             return
 
+        # Processes of PSD and PTP_manual are started inside every file job and every metric thread:
+        # the cores are divided between them, so that jobs x metrics_n_threads x n_jobs does not oversubscribe the CPU.
+        n_outer_workers = max(jobs, 1) * all_qc_params['default']['metrics_n_threads']
+        for metric in ['PSD', 'PTP_manual']:
+            all_qc_params[metric]['n_jobs'] = bounded_n_jobs(all_qc_params[metric]['n_jobs'], n_outer_workers)
+
         #entities = dataset.query_entities(dataset_path)
         #entities = query_entities(dataset, scope='raw')
 
@@ -570,6 +1137,20 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
         # print('___MEGqc___: ', 'entities', entities)
 
 
+        binary_df_format = check_binary_df_format(all_qc_params['default']['binary_df_format'])
+        container_format = check_container_format(all_qc_params['default']['derivative_container'])
+
+        write_queue_size = all_qc_params['default']['write_queue_size']
+        if write_queue_size < 0:
+            raise ValueError('write_queue_size must be 0 or positive, got: ' + str(write_queue_size))
+
+        # Results of previous runs are reused if the data file and the relevant settings did not change:
+        if all_qc_params['default']['cache_results'] is True:
+            cache_dir = os.path.join(derivatives_path, 'Meg_QC', '.cache')
+            os.makedirs(cache_dir, exist_ok=True)
+        else:
+            cache_dir = None
+
         sub_list = check_sub_list(sub_list, dataset)
 
         if reuse_config_file_path:
@@ -578,9 +1159,10 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
         avg_ecg=[]
         avg_eog=[]
         
-        raw=None #preassign in case no calculation will be successful
+        n_processed_files = 0 #count in case no calculation will be successful
 
         all_taken_raw_files = []
+        files_to_process = [] # (subject_folder, raw entities, data file) for every file of every subject
 
         for sub in sub_list: #[0:4]:
     
@@ -613,192 +1195,63 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
             #same as list_of_fifs, but return type is not filename, but dict
 
 
-            counter = 0
-
             for file_ind, data_file in enumerate(list_of_files): #[0:1]: #run over several data files
-
-                print('___MEGqc___: ', 'Processing file: ', data_file)
-
-                # Preassign strings with notes for the user to add to html report (in case some QC analysis was skipped):
-                shielding_str, m_or_g_skipped_str, epoching_str, ecg_str, eog_str, head_str, muscle_str, pp_manual_str, pp_auto_str, std_str, psd_str = '', '', '', '', '', '', '', '', '', '', ''
-    
-                print('___MEGqc___: ', 'Starting initial processing...')
-                start_time = time.time()
-
-                meg_system, dict_epochs_mg, chs_by_lobe, channels, raw_cropped_filtered, raw_cropped_filtered_resampled, raw_cropped, raw, info_derivs, stim_deriv, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str = initial_processing(default_settings=all_qc_params['default'], filtering_settings=all_qc_params['Filtering'], epoching_params=all_qc_params['Epoching'], file_path=data_file)
-                
-                # Commented out this, because it would cover the actual error while allowing to continue processing.
-                # I wanna see the actual error. Often it happens while reading raw and says: 
-                # file '...' does not start with a file id tag
-                
-                # try:
-                #     dict_epochs_mg, chs_by_lobe, channels, raw_cropped_filtered, raw_cropped_filtered_resampled, raw_cropped, raw, shielding_str, epoching_str, sensors_derivs, m_or_g_chosen, m_or_g_skipped_str, lobes_color_coding_str, resample_str = initial_processing(default_settings=all_qc_params['default'], filtering_settings=all_qc_params['Filtering'], epoching_params=all_qc_params['Epoching'], file_path=data_file)
-                # except:
-                #     print('___MEGqc___: ', 'Could not process file ', data_file, '. Skipping it.')
-                #     #in case some file can not be processed, the pipeline will continue. To figure out the issue, run the file separately: raw=mne.io.read_raw_fif('.../filepath/...fif')
-                #     continue
-                
-                print('___MEGqc___: ', "Finished initial processing. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                # QC measurements:
-
-                #predefine in case some metrics are not calculated:
-                noisy_freqs_global = None #if we run PSD, this will be properly defined. It is used as an input for Muscle and is supposed to represent powerline noise.
-                std_derivs, psd_derivs, pp_manual_derivs, pp_auto_derivs, ecg_derivs, eog_derivs, head_derivs, muscle_derivs = [],[],[],[],[], [],  [], []
-                simple_metrics_psd, simple_metrics_std, simple_metrics_pp_manual, simple_metrics_pp_auto, simple_metrics_ecg, simple_metrics_eog, simple_metrics_head, simple_metrics_muscle = [],[],[],[],[],[], [], []
-
-
-                if all_qc_params['default']['run_STD'] is True:
-                    print('___MEGqc___: ', 'Starting STD...')
-                    start_time = time.time()
-                    std_derivs, simple_metrics_std, std_str = STD_meg_qc(all_qc_params['STD'], channels, chs_by_lobe, dict_epochs_mg, raw_cropped_filtered_resampled, m_or_g_chosen)
-                    print('___MEGqc___: ', "Finished STD. --- Execution %s seconds ---" % (time.time() - start_time))
-    
-                if all_qc_params['default']['run_PSD'] is True:
-                    print('___MEGqc___: ', 'Starting PSD...')
-                    start_time = time.time()
-                    psd_derivs, simple_metrics_psd, psd_str, noisy_freqs_global = PSD_meg_qc(all_qc_params['PSD'], internal_qc_params['PSD'], channels, chs_by_lobe , raw_cropped_filtered, m_or_g_chosen, helper_plots=False)
-                    print('___MEGqc___: ', "Finished PSD. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                if all_qc_params['default']['run_PTP_manual'] is True:
-                    print('___MEGqc___: ', 'Starting Peak-to-Peak manual...')
-                    start_time = time.time()
-                    pp_manual_derivs, simple_metrics_pp_manual, pp_manual_str = PP_manual_meg_qc(all_qc_params['PTP_manual'], channels, chs_by_lobe, dict_epochs_mg, raw_cropped_filtered_resampled, m_or_g_chosen)
-                    print('___MEGqc___: ', "Finished Peak-to-Peak manual. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                if all_qc_params['default']['run_PTP_auto_mne'] is True:
-                    print('___MEGqc___: ', 'Starting Peak-to-Peak auto...')
-                    start_time = time.time()
-                    pp_auto_derivs, bad_channels, pp_auto_str = PP_auto_meg_qc(all_qc_params['PTP_auto'], channels, raw_cropped_filtered_resampled, m_or_g_chosen)
-                    print('___MEGqc___: ', "Finished Peak-to-Peak auto. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                if all_qc_params['default']['run_ECG'] is True:
-                    print('___MEGqc___: ', 'Starting ECG...')
-                    start_time = time.time()
-                    ecg_derivs, simple_metrics_ecg, ecg_str, avg_objects_ecg = ECG_meg_qc(all_qc_params['ECG'], internal_qc_params['ECG'], raw_cropped, channels, chs_by_lobe, m_or_g_chosen)
-                    print('___MEGqc___: ', "Finished ECG. --- Execution %s seconds ---" % (time.time() - start_time))
+                if write_queue_size > 0:
+                    # Separate folder object for every data file (same folder on disk), detached from the derivative:
+                    # it is written in the background as soon as the file is done and released after.
+                    file_folder = calculation_folder.create_folder(type_=schema.Subject, name='sub-'+sub)
+                    calculation_folder.folders[:] = [folder for folder in calculation_folder.folders if folder is not file_folder]
+                else:
+                    file_folder = subject_folder
+                files_to_process.append((file_folder, entities_per_file[file_ind], data_file))
+
+        # Run the QC on every file: either one after another in this process or in a pool of worker processes.
+        # Workers only calculate, the derivatives are given back here and registered in the same order as in serial run.
+        counter = 0
+
+        # Derivatives of every done file are written in the background, while the next file is processed:
+        writer = ThreadPoolExecutor(max_workers=1) if write_queue_size > 0 else None
+        pending_writes = []
+
+        if jobs > 1 and len(files_to_process) > 1:
+            print('___MEGqc___: ', 'Running QC on ', len(files_to_process), ' files in ', jobs, ' parallel jobs.')
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Only a window of files is submitted at a time and refilled as results are taken:
+                # results of all files submitted at once would wait in the main process, holding the derivatives of the whole dataset.
+                window = jobs + write_queue_size
+                files_left = iter(files_to_process)
+                submitted = deque((file_to_process, executor.submit(process_one_file, file_to_process[2], all_qc_params, internal_qc_params, cache_dir)) for file_to_process in islice(files_left, window))
+
+                while submitted:
+                    (subject_folder, raw_entities, data_file), future = submitted.popleft()
+                    QC_derivs, avg_objects_ecg, avg_objects_eog = future.result()
+                    del future
+
+                    next_file = next(files_left, None)
+                    if next_file is not None:
+                        submitted.append((next_file, executor.submit(process_one_file, next_file[2], all_qc_params, internal_qc_params, cache_dir)))
 
                     avg_ecg += avg_objects_ecg
-
-                if all_qc_params['default']['run_EOG'] is True:
-                    print('___MEGqc___: ', 'Starting EOG...')
-                    start_time = time.time()
-                    eog_derivs, simple_metrics_eog, eog_str, avg_objects_eog = EOG_meg_qc(all_qc_params['EOG'], internal_qc_params['EOG'], raw_cropped, channels, chs_by_lobe, m_or_g_chosen)
-                    print('___MEGqc___: ', "Finished EOG. --- Execution %s seconds ---" % (time.time() - start_time))
-
                     avg_eog += avg_objects_eog
+                    counter = add_derivs_to_subject_folder(QC_derivs, subject_folder, raw_entities, counter, binary_df_format, container_format)
+                    if writer is not None:
+                        write_derivs_in_background(writer, pending_writes, dataset, subject_folder, write_queue_size)
+                    n_processed_files += 1
+        else:
+            for subject_folder, raw_entities, data_file in files_to_process:
+                QC_derivs, avg_objects_ecg, avg_objects_eog = process_one_file(data_file, all_qc_params, internal_qc_params, cache_dir)
+                avg_ecg += avg_objects_ecg
+                avg_eog += avg_objects_eog
+                counter = add_derivs_to_subject_folder(QC_derivs, subject_folder, raw_entities, counter, binary_df_format, container_format)
+                if writer is not None:
+                    write_derivs_in_background(writer, pending_writes, dataset, subject_folder, write_queue_size)
+                n_processed_files += 1
 
-                if all_qc_params['default']['run_Head'] is True:
-                    print('___MEGqc___: ', 'Starting Head movement calculation...')
-                    head_derivs, simple_metrics_head, head_str, df_head_pos, head_pos = HEAD_movement_meg_qc(raw_cropped)
-                    print('___MEGqc___: ', "Finished Head movement calculation. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                if all_qc_params['default']['run_Muscle'] is True:
-                    print('___MEGqc___: ', 'Starting Muscle artifacts calculation...')
-                    muscle_derivs, simple_metrics_muscle, muscle_str, scores_muscle_all3, raw3 = MUSCLE_meg_qc(all_qc_params['Muscle'], all_qc_params['PSD'], internal_qc_params['PSD'], channels, raw_cropped_filtered, noisy_freqs_global, m_or_g_chosen, attach_dummy = True, cut_dummy = True)
-                    print('___MEGqc___: ', "Finished Muscle artifacts calculation. --- Execution %s seconds ---" % (time.time() - start_time))
-
-                
-                report_strings = {
-                'INITIAL_INFO': m_or_g_skipped_str+resample_str+epoching_str+shielding_str+lobes_color_coding_str,
-                'STD': std_str,
-                'PSD': psd_str,
-                'PTP_MANUAL': pp_manual_str,
-                'PTP_AUTO': pp_auto_str,
-                'ECG': ecg_str,
-                'EOG': eog_str,
-                'HEAD': head_str,
-                'MUSCLE': muscle_str,
-                'STIMULUS': 'If the data was cropped for this calculation, the stimulus data is also cropped.'}
-
-                # Save report strings as json to read it back in when plotting:
-                report_str_derivs=[QC_derivative(report_strings, 'ReportStrings', 'json')]
-                
-
-                QC_derivs={
-                'Raw info': info_derivs,
-                'Stimulus channels': stim_deriv,
-                'Report_strings': report_str_derivs,
-                'Sensors locations': sensors_derivs,
-                'Standard deviation of the data': std_derivs, 
-                'Frequency spectrum': psd_derivs, 
-                'Peak-to-Peak manual': pp_manual_derivs, 
-                'Peak-to-Peak auto from MNE': pp_auto_derivs, 
-                'ECG': ecg_derivs, 
-                'EOG': eog_derivs,
-                'Head movement artifacts': head_derivs,
-                'High frequency (Muscle) artifacts': muscle_derivs}
-
-                QC_simple={
-                'STD': simple_metrics_std, 
-                'PSD': simple_metrics_psd,
-                'PTP_MANUAL': simple_metrics_pp_manual, 
-                'PTP_AUTO': simple_metrics_pp_auto,
-                'ECG': simple_metrics_ecg, 
-                'EOG': simple_metrics_eog,
-                'HEAD': simple_metrics_head,
-                'MUSCLE': simple_metrics_muscle}  
-
-                #Collect all simple metrics into a dictionary and add to QC_derivs:
-                QC_derivs['Simple_metrics']=[QC_derivative(QC_simple, 'SimpleMetrics', 'json')]
-
-                #if there are any derivs calculated in this section:
-                for section in (section for section in QC_derivs.values() if section):
-                    # loop over section where deriv.content_type is not 'matplotlib' or 'plotly' or 'report'
-                    for deriv in (deriv for deriv in section if deriv.content_type != 'matplotlib' and deriv.content_type != 'plotly' and deriv.content_type != 'report'):
-
-                        # This is how you would save matplotlib, plotly and reports separately with ancpbids:
-
-                        # print('___MEGqc___: ', 'writing deriv: ', d)
-                        # print('___MEGqc___: ', deriv)
-
-                        # if deriv.content_type == 'matplotlib':
-                        #     continue
-                        #     meg_artifact.extension = '.png'
-                        #     meg_artifact.content = lambda file_path, cont=deriv.content: cont.savefig(file_path) 
-
-                        # elif deriv.content_type == 'plotly':
-                        #     continue
-                        #     meg_artifact.content = lambda file_path, cont=deriv.content: cont.write_html(file_path)
-
-                        # elif deriv.content_type == 'report':
-                        #     def html_writer(file_path, cont=deriv.content):
-                        #         with open(file_path, "w") as file:
-                        #             file.write(cont)
-                        #         #'with'command doesnt work in lambda
-                        #     meg_artifact.content = html_writer # function pointer instead of lambda
-
-                        meg_artifact = subject_folder.create_artifact(raw=entities_per_file[file_ind]) #shell. empty derivative
-
-                        counter +=1
-                        print('___MEGqc___: ', 'counter of subject_folder.create_artifact', counter)
-
-                        meg_artifact.add_entity('desc', deriv.name) #file name
-                        meg_artifact.suffix = 'meg'
-                        meg_artifact.extension = '.html'
-
-                        if deriv.content_type == 'df':
-                            meg_artifact.extension = '.tsv'
-                            meg_artifact.content = lambda file_path, cont=deriv.content: cont.to_csv(file_path, sep='\t')
-
-                        elif deriv.content_type == 'json':
-                            meg_artifact.extension = '.json'
-                            def json_writer(file_path, cont=deriv.content):
-                                with open(file_path, "w") as file_wrapper:
-                                    json.dump(cont, file_wrapper, indent=4)
-                            meg_artifact.content = json_writer # function pointer instead of lambda
-
-                        elif deriv.content_type == 'info':
-                            meg_artifact.extension = '.fif'
-                            meg_artifact.content = lambda file_path, cont=deriv.content: mne.io.write_info(file_path, cont)
-
-                        else:
-                            print('___MEGqc___: ', meg_artifact.name)
-                            meg_artifact.content = 'dummy text'
-                            meg_artifact.extension = '.txt'
-                        # problem with lambda explained:
-                        # https://docs.python.org/3/faq/programming.html#why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
 
+        if writer is not None:
+            for future in pending_writes:
+                future.result()
+            writer.shutdown()
 
         #Save config file used for this run as a derivative:
         if reuse_config_file_path is None:
@@ -811,7 +1264,7 @@ def make_derivative_meg_qc(default_config_file_path: str, internal_config_file_p
 
         ancpbids.write_derivative(dataset, derivative) 
 
-        if raw is None:
+        if n_processed_files == 0:
             print('___MEGqc___: ', 'No data files could be processed.')
             return
 
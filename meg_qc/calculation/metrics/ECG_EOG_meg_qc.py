@@ -3,14 +3,16 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from scipy.signal import find_peaks
+from numpy.lib.stride_tricks import sliding_window_view
 #import matplotlib #this is in case we will need to suppress mne matplotlib plots
 import copy
-from scipy.ndimage import gaussian_filter
-from scipy.stats import pearsonr
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
+from scipy.stats import t as t_distribution
 from typing import List, Union
 from meg_qc.plotting.universal_html_report import simple_metric_basic
 from meg_qc.plotting.universal_plots import QC_derivative, get_tit_and_unit
-from meg_qc.calculation.initial_meg_qc import chs_dict_to_csv
+from meg_qc.calculation.objects import ChannelTable
+from meg_qc.calculation.initial_meg_qc import channel_table_to_csv
 
 
 def check_3_conditions(ch_data: Union[List, np.ndarray], fs: int, ecg_or_eog: str, n_breaks_bursts_allowed_per_10min: int, allowed_range_of_peaks_stds: float, height_multiplier: float):
@@ -626,7 +628,422 @@ class Avg_artif:
         return self.artif_over_threshold_smoothed
 
 
-def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: List, mean_magnitude_peak: float, t: np.ndarray, t0_actual: float, window_size_for_mean_threshold_method: float, mean_magnitude_peak_smoothed: float = None, t0_actual_smoothed: float = None):
+class Avg_artif_channels:
+
+    """
+    Average ECG/EOG epochs of all channels of one type (mag or grad), stored as arrays: one row (or element) per channel.
+    Does the same as a list of Avg_artif objects (one per channel), but peaks, flipping, smoothing and scores
+    are calculated for all channels at once.
+
+    Peaks of all channels are kept one after another in flat arrays:
+    peaks of channel i are peak_loc[peak_offsets[i]:peak_offsets[i+1]] (positive peaks first, then negative, as in Avg_artif).
+
+    For plotting and other code which works with single channels, Avg_artif objects can be taken from it:
+    artif_per_ch[i] or artif_per_ch.to_avg_artif_list(). They are thin views: their data arrays are rows of the arrays here.
+
+
+    Attributes
+    ----------
+    names : List
+        channel names
+    name_index : dict
+        channel name -> index of the channel (row) in the arrays
+    artif_data : np.ndarray
+        average ecg/eog epoch for every channel, shape (n_channels, n_times)
+    artif_data_smoothed : np.ndarray
+        same smoothed with Gaussian filter, shape (n_channels, n_times)
+    peak_loc : np.ndarray
+        locations of peaks inside the artifact epoch, all channels one after another
+    peak_magnitude : np.ndarray
+        magnitudes of these peaks
+    peak_offsets : np.ndarray
+        index of the first peak of every channel in peak_loc, shape (n_channels+1)
+    wave_shape : np.ndarray
+        True for channels which have typical wave shape (few peaks), False otherwise
+    peak_loc_smoothed, peak_magnitude_smoothed, peak_offsets_smoothed, wave_shape_smoothed : np.ndarray
+        same as above, calculated on smoothed data
+    artif_over_threshold : np.ndarray
+        True for channels with main peak over the threshold
+    artif_over_threshold_smoothed : np.ndarray
+        same as above, calculated on smoothed data
+    main_peak_loc : np.ndarray
+        location of the main peak of every channel, -1 if there is no main peak
+    main_peak_magnitude : np.ndarray
+        magnitude of the main peak of every channel, NaN if there is no main peak
+    corr_coef : np.ndarray
+        correlation coefficient between the ECG/EOG channels data and average data of every channel
+    p_value : np.ndarray
+        p-values of the correlation coefficients
+    amplitude_ratio : np.ndarray
+        relation of the amplitude of every channel to all other channels
+    similarity_score : np.ndarray
+        similarity_score = corr_coef * amplitude_ratio
+    lobe : List
+        which lobe every channel belongs to
+    color : List
+        color code for every channel according to the lobe it belongs to
+
+    Attributes which were not calculated yet are None.
+
+    """
+
+    def __init__(self, names: List, artif_data: np.ndarray):
+
+        """Constructor"""
+
+        self.names = list(names)
+        self.name_index = {name: ch_n for ch_n, name in enumerate(self.names)}
+        self.artif_data = np.array(artif_data, dtype=np.float64)
+        self.artif_data_smoothed = None
+        self.peak_loc, self.peak_magnitude, self.peak_offsets, self.wave_shape = None, None, None, None
+        self.peak_loc_smoothed, self.peak_magnitude_smoothed, self.peak_offsets_smoothed, self.wave_shape_smoothed = None, None, None, None
+        self.artif_over_threshold = None
+        self.artif_over_threshold_smoothed = None
+        self.main_peak_loc = None
+        self.main_peak_magnitude = None
+        self.corr_coef = None
+        self.p_value = None
+        self.amplitude_ratio = None
+        self.similarity_score = None
+        self.lobe = [None] * len(self.names)
+        self.color = [None] * len(self.names)
+
+
+    def __repr__(self):
+
+        return 'Mean artifacts for ' + str(len(self.names)) + ' channels, epoch length: ' + str(self.artif_data.shape[1])
+
+
+    def __len__(self):
+
+        return len(self.names)
+
+
+    def __getitem__(self, ch_n: int):
+
+        """
+        Avg_artif object for one channel, sharing the data with this object.
+
+        """
+
+        def value(array):
+            return None if array is None else array[ch_n]
+
+        def peaks(values, offsets):
+            return None if values is None else values[offsets[ch_n]:offsets[ch_n+1]]
+
+        main_peak_loc, main_peak_magnitude = None, None
+        if self.main_peak_loc is not None and self.main_peak_loc[ch_n] >= 0:
+            main_peak_loc, main_peak_magnitude = self.main_peak_loc[ch_n], self.main_peak_magnitude[ch_n]
+
+        return Avg_artif(name=self.names[ch_n], artif_data=self.artif_data[ch_n],
+            peak_loc=peaks(self.peak_loc, self.peak_offsets), peak_magnitude=peaks(self.peak_magnitude, self.peak_offsets), wave_shape=value(self.wave_shape),
+            artif_over_threshold=value(self.artif_over_threshold), main_peak_loc=main_peak_loc, main_peak_magnitude=main_peak_magnitude,
+            artif_data_smoothed=value(self.artif_data_smoothed),
+            peak_loc_smoothed=peaks(self.peak_loc_smoothed, self.peak_offsets_smoothed), peak_magnitude_smoothed=peaks(self.peak_magnitude_smoothed, self.peak_offsets_smoothed), wave_shape_smoothed=value(self.wave_shape_smoothed),
+            artif_over_threshold_smoothed=value(self.artif_over_threshold_smoothed),
+            corr_coef=value(self.corr_coef), p_value=value(self.p_value), amplitude_ratio=value(self.amplitude_ratio), similarity_score=value(self.similarity_score),
+            lobe=self.lobe[ch_n], color=self.color[ch_n])
+
+
+    def __iter__(self):
+
+        return iter(self.to_avg_artif_list())
+
+
+    def to_avg_artif_list(self):
+
+        """
+        List of Avg_artif objects, one for every channel (for plotting and other code which works with single channels).
+
+        Returns
+        -------
+        List
+            List of Avg_artif objects.
+
+        """
+
+        return [self[ch_n] for ch_n in range(len(self.names))]
+
+
+    def get_peaks_wave(self, max_n_peaks_allowed: int, thresh_lvl_peakfinder: float):
+
+        """
+        Find peaks in the average artifact epoch of every channel and decide if the epoch has wave shape:
+        few peaks (different number allowed for ECG and EOG) - wave shape, many or no peaks - not.
+        Function for non smoothed data. See Avg_artif.get_peaks_wave().
+
+        Parameters
+        ----------
+        max_n_peaks_allowed : int
+            maximum number of peaks allowed in the average artifact epoch
+        thresh_lvl_peakfinder : float
+            threshold for peakfinder function.
+
+        """
+
+        self.peak_loc, self.peak_magnitude, self.peak_offsets = find_epoch_peaks_all_channels(self.artif_data, thresh_lvl_peakfinder)
+        n_peaks = np.diff(self.peak_offsets)
+        self.wave_shape = (n_peaks >= 1) & (n_peaks <= max_n_peaks_allowed)
+
+
+    def get_peaks_wave_smoothed(self, gaussian_sigma: int, max_n_peaks_allowed: int, thresh_lvl_peakfinder: float):
+
+        """
+        Same as get_peaks_wave() for smoothed data. If it was not smoothed yet - it will be smoothed here using gaussian filter.
+
+        Parameters
+        ----------
+        gaussian_sigma : int
+            sigma for gaussian smoothing
+        max_n_peaks_allowed : int
+            maximum number of peaks allowed in the average artifact epoch
+        thresh_lvl_peakfinder : float
+            threshold for peakfinder function.
+
+        """
+
+        if self.artif_data_smoothed is None:
+            self.smooth_artif(gaussian_sigma)
+
+        self.peak_loc_smoothed, self.peak_magnitude_smoothed, self.peak_offsets_smoothed = find_epoch_peaks_all_channels(self.artif_data_smoothed, thresh_lvl_peakfinder)
+        n_peaks = np.diff(self.peak_offsets_smoothed)
+        self.wave_shape_smoothed = (n_peaks >= 1) & (n_peaks <= max_n_peaks_allowed)
+
+
+    def smooth_artif(self, gauss_sigma: int):
+
+        """
+        Smooth the artifact epochs of all channels using gaussian filter (one call for all channels, same filter as Avg_artif.smooth_artif()).
+
+        Parameters
+        ----------
+        gauss_sigma : int
+            sigma of the gaussian filter
+
+        Returns
+        -------
+        self
+            with smoothed artifact epochs in self.artif_data_smoothed
+
+        """
+
+        self.artif_data_smoothed = gaussian_filter1d(self.artif_data, gauss_sigma, axis=1)
+
+        return self
+
+
+    def flip_artif(self, flip_mask: np.ndarray):
+
+        """
+        Flip the artifact epochs of chosen channels upside down, both original and smoothed data (if present) and their peak magnitudes.
+
+        Parameters
+        ----------
+        flip_mask : np.ndarray
+            True for the channels to flip.
+
+        Returns
+        -------
+        self
+            with flipped artifact epochs
+
+        """
+
+        flip_sign = np.where(flip_mask, -1.0, 1.0)
+
+        self.artif_data = self.artif_data * flip_sign[:, None]
+        if self.peak_magnitude is not None:
+            self.peak_magnitude = self.peak_magnitude * np.repeat(flip_sign, np.diff(self.peak_offsets))
+
+        if self.artif_data_smoothed is not None:
+            self.artif_data_smoothed = self.artif_data_smoothed * flip_sign[:, None]
+            if self.peak_magnitude_smoothed is not None:
+                self.peak_magnitude_smoothed = self.peak_magnitude_smoothed * np.repeat(flip_sign, np.diff(self.peak_offsets_smoothed))
+
+        return self
+
+
+    def get_highest_peak(self, t: np.ndarray, before_t0: float, after_t0: float):
+
+        """
+        Find the highest peak of the artifact epoch of every channel inside the given time window (on original data).
+        Time window is centered around the t0 of the ecg/eog event and limited by before_t0 and after_t0.
+
+        Parameters
+        ----------
+        t : np.ndarray
+            time vector
+        before_t0 : float
+            before time limit for the peak
+        after_t0 : float
+            after time limit for the peak
+
+        Returns
+        -------
+        self.main_peak_loc : np.ndarray
+            location of the main peak of every channel, -1 if no peak is inside the window
+        self.main_peak_magnitude : np.ndarray
+            magnitude of the main peak of every channel, NaN if no peak is inside the window
+
+        """
+
+        peak_ch = np.repeat(np.arange(len(self.names)), np.diff(self.peak_offsets))
+        peak_values = self.artif_data[peak_ch, self.peak_loc]
+        in_window = (before_t0 < t[self.peak_loc]) & (t[self.peak_loc] < after_t0) & (peak_values > -1000)
+
+        # the first of the highest peaks inside the window, like the loop in Avg_artif.get_highest_peak():
+        main_peak = first_max_per_channel(np.where(in_window, peak_values, -np.inf), peak_ch, len(self.names), in_window)
+
+        self.main_peak_loc = np.where(main_peak >= 0, self.peak_loc[main_peak], -1)
+        self.main_peak_magnitude = np.where(main_peak >= 0, peak_values[main_peak], np.nan)
+
+        return self.main_peak_loc, self.main_peak_magnitude
+
+
+    def detect_artif_above_threshold(self, artif_threshold_lvl: float, t: np.ndarray, before_t0: float, after_t0: float):
+
+        """
+        Detect channels where the highest peak of the artifact epoch is above a given threshold (and epoch has a wave shape).
+        Time window is centered around the t0 of the ecg/eog event and limited by before_t0 and after_t0.
+
+        Parameters
+        ----------
+        artif_threshold_lvl : float
+            threshold level
+        t : np.ndarray
+            time vector
+        before_t0 : float
+            minimum time limit for the peak
+        after_t0 : float
+            maximum time limit for the peak
+
+        Returns
+        -------
+        self.artif_over_threshold : np.ndarray
+            True for channels with the highest peak above the threshold, False otherwise
+
+        """
+
+        _, main_peak_magnitude = self.get_highest_peak(t=t, before_t0=before_t0, after_t0=after_t0)
+        self.artif_over_threshold = (main_peak_magnitude > abs(artif_threshold_lvl)) & self.wave_shape
+
+        return self.artif_over_threshold
+
+
+    def detect_artif_above_threshold_smoothed(self, artif_threshold_lvl: float, t: np.ndarray, before_t0: float, after_t0: float):
+
+        """
+        Detect channels where the highest peak of the artifact epoch is above a given threshold for SMOOTHED data.
+        As in Avg_artif.detect_artif_above_threshold_smoothed(), the highest peak is searched with get_highest_peak().
+
+        Parameters
+        ----------
+        artif_threshold_lvl : float
+            threshold level
+        t : np.ndarray
+            time vector
+        before_t0 : float
+            minimum time limit for the peak
+        after_t0 : float
+            maximum time limit for the peak
+
+        Returns
+        -------
+        self.artif_over_threshold_smoothed : np.ndarray
+            True for channels with the highest peak above the threshold, False otherwise
+
+        """
+
+        if self.artif_data_smoothed is not None:
+            _, main_peak_magnitude_smoothed = self.get_highest_peak(t=t, before_t0=before_t0, after_t0=after_t0)
+            self.artif_over_threshold_smoothed = (main_peak_magnitude_smoothed > abs(artif_threshold_lvl)) & self.wave_shape_smoothed
+
+        return self.artif_over_threshold_smoothed
+
+
+
+def find_epoch_peaks_all_channels(data: np.ndarray, thresh_lvl_peakfinder: float):
+
+    """
+    Find positive and negative peaks of every channel, same as find_epoch_peaks() does for one channel.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        data of all channels, shape (n_channels, n_times)
+    thresh_lvl_peakfinder : float
+        The threshold for the peakfinder algorithm.
+
+    Returns
+    -------
+    peak_loc : np.ndarray
+        locations of the peaks of all channels one after another: for every channel first positive, then negative peaks.
+    peak_magnitude : np.ndarray
+        magnitudes of the peaks.
+    peak_offsets : np.ndarray
+        index of the first peak of every channel in peak_loc, shape (n_channels+1).
+
+    """
+
+    thresh_mean = (np.max(data, axis=1) - np.min(data, axis=1)) / thresh_lvl_peakfinder
+
+    peak_locs = []
+    for ch_n, ch_data in enumerate(data):
+        peak_locs.append(find_peaks(ch_data, prominence=thresh_mean[ch_n])[0])
+        peak_locs.append(find_peaks(-ch_data, prominence=thresh_mean[ch_n])[0])
+
+    n_peaks = np.array([len(peak_locs[2*ch_n]) + len(peak_locs[2*ch_n+1]) for ch_n in range(len(data))], dtype=int)
+    peak_offsets = np.concatenate(([0], np.cumsum(n_peaks)))
+
+    peak_loc = np.concatenate(peak_locs + [np.zeros(0, dtype=int)]).astype(int)
+    peak_magnitude = data[np.repeat(np.arange(len(data)), n_peaks), peak_loc]
+
+    return peak_loc, peak_magnitude, peak_offsets
+
+
+def first_max_per_channel(values: np.ndarray, peak_ch: np.ndarray, n_channels: int, valid: np.ndarray = None):
+
+    """
+    For peaks of many channels kept in one flat array: index of the first peak with the highest value in every channel
+    (same as np.argmax on the peaks of one channel).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values to compare, one per peak.
+    peak_ch : np.ndarray
+        channel of every peak (sorted).
+    n_channels : int
+        number of channels.
+    valid : np.ndarray, optional
+        True for peaks which can be chosen. If None, all peaks can be chosen.
+
+    Returns
+    -------
+    np.ndarray
+        index of the chosen peak for every channel, -1 for channels without (valid) peaks.
+
+    """
+
+    if valid is None:
+        valid = np.ones(len(values), dtype=bool)
+
+    valid_idx = np.flatnonzero(valid)
+    # sorted by channel, then by value (highest first), then by position (first first):
+    order = valid_idx[np.lexsort((valid_idx, -values[valid_idx], peak_ch[valid_idx]))]
+
+    first_in_channel = np.searchsorted(peak_ch[order], np.arange(n_channels), side='left')
+    has_peak = first_in_channel < len(order)
+    has_peak[has_peak] = peak_ch[order[first_in_channel[has_peak]]] == np.arange(n_channels)[has_peak]
+
+    chosen = np.full(n_channels, -1, dtype=int)
+    chosen[has_peak] = order[first_in_channel[has_peak]]
+
+    return chosen
+
+
+def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: Avg_artif_channels, mean_magnitude_peak: float, t: np.ndarray, t0_actual: float, window_size_for_mean_threshold_method: float, mean_magnitude_peak_smoothed: float = None, t0_actual_smoothed: float = None):
 
     """
     Find the channels which got average artifact amplitude higher than the average over all channels*norm_lvl.
@@ -635,8 +1052,8 @@ def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: List, me
     ----------
     norm_lvl : float
         The norm level is the scaling factor for the threshold. The mean artifact amplitude over all channels is multiplied by the norm_lvl to get the threshold.
-    list_mean_artif_epochs : List
-        List of MeanArtifactEpoch objects, each hold the information about mean artifact for one channel.
+    list_mean_artif_epochs : Avg_artif_channels
+        Mean artifacts of all channels.
     mean_magnitude_peak : float
         The magnitude the mean artifact amplitude over all channels.
     t : np.ndarray
@@ -654,9 +1071,9 @@ def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: List, me
     Returns
     -------
     affected_orig : List
-        List of channels which got average artifact amplitude higher than the average over all channels*norm_lvl.
+        List of channels (Avg_artif objects) which got average artifact amplitude higher than the average over all channels*norm_lvl.
     not_affected_orig : List
-        List of channels which got average artifact amplitude lower than the average over all channels*norm_lvl.
+        List of channels (Avg_artif objects) which got average artifact amplitude lower than the average over all channels*norm_lvl.
     artif_threshold_lvl : float
         The threshold level for the artifact amplitude.
     affected_smoothed : List
@@ -687,17 +1104,17 @@ def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: List, me
         before_t0_smoothed=-window_size_for_mean_threshold_method+t0_actual_smoothed
         after_t0_smoothed=window_size_for_mean_threshold_method+t0_actual_smoothed
 
-    # Detect which channels are affected by the artifact based on the threshold:
-    for potentially_affected in list_mean_artif_epochs:
+    # Detect which channels are affected by the artifact based on the threshold (all channels at once):
+    result = list_mean_artif_epochs.detect_artif_above_threshold(artif_threshold_lvl, t, before_t0, after_t0)
+    result_smoothed = list_mean_artif_epochs.detect_artif_above_threshold_smoothed(artifact_lvl_smoothed, t, before_t0_smoothed, after_t0_smoothed)
 
-        result = potentially_affected.detect_artif_above_threshold(artif_threshold_lvl, t, before_t0, after_t0)
-        if result is True:
+    for ch_n, potentially_affected in enumerate(list_mean_artif_epochs.to_avg_artif_list()):
+        if result[ch_n]:
             affected_orig.append(potentially_affected)
         else:
             not_affected_orig.append(potentially_affected)
-        
-        result_smoothed = potentially_affected.detect_artif_above_threshold_smoothed(artifact_lvl_smoothed, t, before_t0_smoothed, after_t0_smoothed)
-        if result_smoothed is True:
+
+        if result_smoothed[ch_n]:
             affected_smoothed.append(potentially_affected)
         else:
             not_affected_smoothed.append(potentially_affected)
@@ -705,7 +1122,7 @@ def detect_channels_above_norm(norm_lvl: float, list_mean_artif_epochs: List, me
     return affected_orig, not_affected_orig, artif_threshold_lvl, affected_smoothed, not_affected_smoothed, artifact_lvl_smoothed
 
 
-def flip_channels(artif_per_ch_nonflipped: List, tmin: float, tmax: float, sfreq: int, params_internal: dict):
+def flip_channels(artif_per_ch_nonflipped: Avg_artif_channels, tmin: float, tmax: float, sfreq: int, params_internal: dict):
 
     """
     Flip the channels if the peak of the artifact is negative and located close to the estimated t0.
@@ -725,8 +1142,8 @@ def flip_channels(artif_per_ch_nonflipped: List, tmin: float, tmax: float, sfreq
     
     Parameters
     ----------
-    avg_artif_nonflipped : List
-        List of Avg_artif objects with not flipped data.
+    avg_artif_nonflipped : Avg_artif_channels
+        Mean artifacts of all channels with not flipped data.
     tmin : float
         time in sec before the peak of the artifact (negative number).
     tmax : float
@@ -739,8 +1156,8 @@ def flip_channels(artif_per_ch_nonflipped: List, tmin: float, tmax: float, sfreq
 
     Returns
     -------
-    artifacts_flipped : List
-        The list of the ecg epochs.
+    artifacts_flipped : Avg_artif_channels
+        Mean artifacts of all channels, flipped where needed.
     artif_time_vector : np.ndarray
         The time vector for the ecg epoch (for plotting further).
 
@@ -751,29 +1168,25 @@ def flip_channels(artif_per_ch_nonflipped: List, tmin: float, tmax: float, sfreq
 
     _, t0_estimated_ind, t0_estimated_ind_start, t0_estimated_ind_end = estimate_t0(artif_per_ch_nonflipped, artif_time_vector, params_internal)
 
-    artifacts_flipped=[]
-
-    for ch_artif in artif_per_ch_nonflipped: #for each channel:
+    n_channels = len(artif_per_ch_nonflipped)
+    peak_loc = artif_per_ch_nonflipped.peak_loc
+    peak_ch = np.repeat(np.arange(n_channels), np.diff(artif_per_ch_nonflipped.peak_offsets))
 
-        if ch_artif.peak_loc.size>0: #if there are any peaks - find peak_locs which is located the closest to t0_estimated_ind:
-            peak_loc_closest_to_t0=ch_artif.peak_loc[np.argmin(np.abs(ch_artif.peak_loc-t0_estimated_ind))]
+    #for channels with any peaks - find peak_locs which is located the closest to t0_estimated_ind:
+    closest_peak = first_max_per_channel(-np.abs(peak_loc-t0_estimated_ind), peak_ch, n_channels)
+    has_peaks = closest_peak >= 0
+    peak_loc_closest_to_t0 = peak_loc[closest_peak[has_peaks]]
 
-            #if peak_loc_closest_t0 is negative and is located in the estimated time window of the wave - flip the data:
-            if (ch_artif.artif_data[peak_loc_closest_to_t0]<0) & (peak_loc_closest_to_t0>t0_estimated_ind_start) & (peak_loc_closest_to_t0<t0_estimated_ind_end):
-                ch_artif.flip_artif()
-                if ch_artif.artif_data_smoothed is not None: #if there is also smoothed data present - flip it as well:
-                    ch_artif.flip_artif_smoothed()
-            else:
-                pass
-        else:
-            pass
+    #if peak_loc_closest_t0 is negative and is located in the estimated time window of the wave - flip the data (smoothed data as well):
+    flip_mask = np.zeros(n_channels, dtype=bool)
+    flip_mask[has_peaks] = (artif_per_ch_nonflipped.artif_data[has_peaks, peak_loc_closest_to_t0]<0) & (peak_loc_closest_to_t0>t0_estimated_ind_start) & (peak_loc_closest_to_t0<t0_estimated_ind_end)
 
-        artifacts_flipped.append(ch_artif)
+    artifacts_flipped = artif_per_ch_nonflipped.flip_artif(flip_mask)
 
     return artifacts_flipped, artif_time_vector
 
 
-def estimate_t0(artif_per_ch_nonflipped: List, t: np.ndarray, params_internal: dict):
+def estimate_t0(artif_per_ch_nonflipped: Avg_artif_channels, t: np.ndarray, params_internal: dict):
     
     """ 
     Estimate t0 for the artifact. MNE has it s own estimation of t0, but it is often not accurate.
@@ -792,8 +1205,8 @@ def estimate_t0(artif_per_ch_nonflipped: List, t: np.ndarray, params_internal: d
     ----------
     ecg_or_eog : str
         The type of the artifact: 'ECG' or 'EOG'.
-    avg_ecg_epoch_data_nonflipped : np.ndarray
-        The data of the channels.
+    artif_per_ch_nonflipped : Avg_artif_channels
+        Mean artifacts of all channels, not flipped.
     t : np.ndarray
         The time vector.
     params_internal : dict
@@ -817,8 +1230,7 @@ def estimate_t0(artif_per_ch_nonflipped: List, t: np.ndarray, params_internal: d
     before_t0 = params_internal['before_t0']
     after_t0 = params_internal['after_t0']
 
-    #collect artif data for each channel into nd array:
-    avg_ecg_epoch_data_nonflipped = np.array([ch.artif_data for ch in artif_per_ch_nonflipped]) 
+    avg_ecg_epoch_data_nonflipped = artif_per_ch_nonflipped.artif_data
 
     #find indexes of t where t is between before_t0 and after_t0 (limits where R wave typically is detected by mne):
     t_event_ind=np.argwhere((t>before_t0) & (t<after_t0))
@@ -852,7 +1264,7 @@ def estimate_t0(artif_per_ch_nonflipped: List, t: np.ndarray, params_internal: d
 
 
 
-def calculate_artifacts_on_channels(artif_epochs: mne.Epochs, channels: List, chs_by_lobe: dict, thresh_lvl_peakfinder: float, tmin: float, tmax: float, params_internal: dict, gaussian_sigma: int):
+def calculate_artifacts_on_channels(artif_epochs: mne.Epochs, channels: List, channel_table: ChannelTable, thresh_lvl_peakfinder: float, tmin: float, tmax: float, params_internal: dict, gaussian_sigma: int):
 
     """
     Find channels that are affected by ECG or EOG events.
@@ -865,8 +1277,8 @@ def calculate_artifacts_on_channels(artif_epochs: mne.Epochs, channels: List, ch
         ECG epochs.
     channels : List
         List of channels to use.
-    chs_by_lobe : dict
-        dictionary with channel objects sorted by lobe
+    channel_table : ChannelTable
+        table with all channels, used to get lobes of the channels
     thresh_lvl_peakfinder : float
         Threshold level for peakfinder.
     tmin : float
@@ -881,8 +1293,8 @@ def calculate_artifacts_on_channels(artif_epochs: mne.Epochs, channels: List, ch
         
     Returns 
     -------
-    all_artifs_nonflipped : List
-        List of channels with Avg_artif objects, data in these is not flipped yet.
+    all_artifs_nonflipped : Avg_artif_channels
+        Mean artifacts of all channels, data is not flipped yet.
         
     """
 
@@ -903,16 +1315,13 @@ def calculate_artifacts_on_channels(artif_epochs: mne.Epochs, channels: List, ch
 
     avg_artif_data_nonflipped=avg_epochs.data #shape (n_channels, n_times)
 
-    # 4. detect peaks on channels 
-    all_artifs_nonflipped = []
-    for i, ch_data in enumerate(avg_artif_data_nonflipped):  # find peaks and estimate detect wave shape on all channels
-        artif_nonflipped = Avg_artif(name=channels[i], artif_data=ch_data)
-        artif_nonflipped.get_peaks_wave(max_n_peaks_allowed=max_n_peaks_allowed, thresh_lvl_peakfinder=thresh_lvl_peakfinder)
-        artif_nonflipped.get_peaks_wave_smoothed(gaussian_sigma = gaussian_sigma, max_n_peaks_allowed=max_n_peaks_allowed, thresh_lvl_peakfinder=thresh_lvl_peakfinder)
-        all_artifs_nonflipped.append(artif_nonflipped)
+    # 4. detect peaks and estimate wave shape on all channels
+    all_artifs_nonflipped = Avg_artif_channels(names=channels, artif_data=avg_artif_data_nonflipped)
+    all_artifs_nonflipped.get_peaks_wave(max_n_peaks_allowed=max_n_peaks_allowed, thresh_lvl_peakfinder=thresh_lvl_peakfinder)
+    all_artifs_nonflipped.get_peaks_wave_smoothed(gaussian_sigma = gaussian_sigma, max_n_peaks_allowed=max_n_peaks_allowed, thresh_lvl_peakfinder=thresh_lvl_peakfinder)
 
     # assign lobe to each channel right away (for plotting)
-    all_artifs_nonflipped = assign_lobe_to_artifacts(all_artifs_nonflipped, chs_by_lobe)
+    all_artifs_nonflipped = assign_lobe_to_artifacts(all_artifs_nonflipped, channel_table)
 
     return all_artifs_nonflipped
 
@@ -940,25 +1349,19 @@ def find_mean_rwave_blink(ch_data: Union[List, np.ndarray], event_indexes: np.nd
     Returns
     -------
     mean_rwave : np.ndarray
-        Mean R wave (1 dimentional).
+        Mean R wave (1 dimentional). Events too close to the start or end of the data for a full epoch are not used.
     
     """
 
-    # Initialize an empty array to store the extracted epochs
-    epochs = np.zeros((len(event_indexes), int((tmax-tmin)*sfreq)+1))
+    ch_data = np.asarray(ch_data)
+    epoch_len = int((tmax-tmin)*sfreq)+1
+    starts = np.round(np.asarray(event_indexes) + tmin*sfreq).astype(int)
 
-    # Loop through each ECG event and extract the corresponding epoch
-    for i, event in enumerate(event_indexes):
-        start = np.round(event + tmin*sfreq).astype(int)
-        end = np.round(event + tmax*sfreq).astype(int)+1
+    # Leave out the events which epochs do not fit into the data (not counted in the mean):
+    inside = (starts >= 0) & (starts + epoch_len <= len(ch_data))
 
-        if start < 0:
-            continue
-
-        if end > len(ch_data):
-            continue
-
-        epochs[i, :] = ch_data[start:end]
+    # Extract all the epochs at once: rows of the sliding window view starting at the events
+    epochs = sliding_window_view(ch_data, epoch_len)[starts[inside]] if len(ch_data) >= epoch_len else np.zeros((0, epoch_len))
 
     #average all epochs:
     mean_rwave=np.mean(epochs, axis=0)
@@ -966,36 +1369,34 @@ def find_mean_rwave_blink(ch_data: Union[List, np.ndarray], event_indexes: np.nd
     return mean_rwave
 
 
-def assign_lobe_to_artifacts(artif_per_ch: List, chs_by_lobe: dict):
+def assign_lobe_to_artifacts(artif_per_ch: Avg_artif_channels, channel_table: ChannelTable):
 
-    """ Loop over all channels in artif_per_ch and assign lobe and lobe color to each channel for plotting purposes.
+    """ Assign lobe and lobe color to each channel in artif_per_ch for plotting purposes.
 
     Parameters
     ----------
-    artif_per_ch : List
-        List of channels with Avg_artif objects.
-    chs_by_lobe : dict
-        Dictionary of channels grouped by lobe with color codes.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels.
+    channel_table : ChannelTable
+        Table with all channels, their lobes and color codes.
 
     Returns
     -------
-    artif_per_ch : List
-        List of channels with Avg_artif objects, now with assigned lobe and color for plotting. 
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels, now with assigned lobe and color for plotting. 
 
     """
     
-    for lobe,  ch_list in chs_by_lobe.items(): #loop over dict of channels for plotting
-        for ch_for_plot in ch_list: #same, level deeper
-            for ch_artif in artif_per_ch: #loop over list of instances of Avg_artif class
-                if ch_artif.name == ch_for_plot.name:
-                    ch_artif.lobe = ch_for_plot.lobe
-                    ch_artif.color = ch_for_plot.lobe_color
-                    break
+    for ch_n, ch_name in enumerate(artif_per_ch.names):
+        row = channel_table.name_index.get(ch_name) #row of this channel in the channel table
+        if row is not None:
+            artif_per_ch.lobe[ch_n] = channel_table.lobe[row]
+            artif_per_ch.color[ch_n] = channel_table.lobe_color[row]
 
     #Check that all channels have been assigned a lobe:
-    for ch_artif in artif_per_ch:
-        if ch_artif.lobe is None or ch_artif.color is None:
-            print('___MEGqc___: ', 'Channel ', ch_artif.name, ' has not been assigned a lobe or color for plotting. Check assign_lobe_to_artifacts().')
+    for ch_name, lobe, color in zip(artif_per_ch.names, artif_per_ch.lobe, artif_per_ch.color):
+        if lobe is None or color is None:
+            print('___MEGqc___: ', 'Channel ', ch_name, ' has not been assigned a lobe or color for plotting. Check assign_lobe_to_artifacts().')
 
     return artif_per_ch
 
@@ -1057,7 +1458,7 @@ def align_artif_data(ch_wave, mean_rwave):
     return best_aligned_ch_wave, best_time_shift, best_correlation
 
 
-def find_affected_by_correlation(mean_rwave: np.ndarray, artif_per_ch: List):
+def find_affected_by_correlation(mean_rwave: np.ndarray, artif_per_ch: Avg_artif_channels):
 
     """
     Calculate correlation coefficient and p-value between mean R wave and each channel in artif_per_ch.
@@ -1070,28 +1471,68 @@ def find_affected_by_correlation(mean_rwave: np.ndarray, artif_per_ch: List):
     ----------
     mean_rwave : np.ndarray
         Mean R wave (1 dimentional).
-    artif_per_ch : List
-        List of channels with Avg_artif objects.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels.
 
     Returns
     -------
-    artif_per_ch : List
-        List of channels with Avg_artif objects, now with assigned correlation coefficient and p-value.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels, now with assigned correlation coefficient and p-value.
     
     """
 
     
-    if len(mean_rwave) != len(artif_per_ch[0].artif_data):
+    if len(mean_rwave) != artif_per_ch.artif_data.shape[1]:
         print('___MEGqc___: ', 'mean_rwave and artif_per_ch.artif_data have different length! Both are defined by tmin and tmax in config.py and are use to cut the data. Keep in mind if changing anything with tmin and tmax')
-        print('len(mean_rwave): ', len(mean_rwave), 'len(artif_per_ch[0].artif_data): ', len(artif_per_ch[0].artif_data))
+        print('len(mean_rwave): ', len(mean_rwave), 'len(artif_per_ch[0].artif_data): ', artif_per_ch.artif_data.shape[1])
         return
 
-    for ch in artif_per_ch:
-        ch.corr_coef, ch.p_value = pearsonr(ch.artif_data_smoothed, mean_rwave)
+    artif_per_ch.corr_coef, artif_per_ch.p_value = pearson_corr_all_channels(artif_per_ch.artif_data_smoothed, mean_rwave)
     
     return artif_per_ch
 
 
+def pearson_corr_all_channels(artif_data: np.ndarray, wave: np.ndarray):
+
+    """
+    Pearson correlation coefficient and two-sided p-value between every channel and the wave, for all channels at once
+    (same as scipy.stats.pearsonr for every channel, up to rounding errors).
+
+    Parameters
+    ----------
+    artif_data : np.ndarray
+        Data of the channels, shape (n_channels, n_times).
+    wave : np.ndarray
+        The wave (1 dimentional, n_times).
+
+    Returns
+    -------
+    corr_coef : np.ndarray
+        Correlation coefficients, one for each channel. NaN for flat channels (or flat wave), like in pearsonr.
+    p_value : np.ndarray
+        P-values (from t-distribution with n_times-2 degrees of freedom), one for each channel. NaN where corr_coef is NaN.
+
+    """
+
+    n_times = len(wave)
+    data_centered = artif_data - np.mean(artif_data, axis=1, keepdims=True)
+    wave_centered = wave - np.mean(wave)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data_normalized = data_centered / np.linalg.norm(data_centered, axis=1, keepdims=True)
+        corr_coef = np.clip(data_normalized @ (wave_centered / np.linalg.norm(wave_centered)), -1, 1)
+
+    # constant channels (or constant wave) give NaN, same as in pearsonr:
+    constant = np.all(artif_data == artif_data[:, :1], axis=1) | np.all(wave == wave[0])
+    corr_coef[constant] = np.nan
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_stat = np.abs(corr_coef) * np.sqrt((n_times - 2) / (1 - corr_coef**2))
+    p_value = 2 * t_distribution.sf(t_stat, n_times - 2)
+
+    return corr_coef, p_value
+
+
 def rms_amplitude(wave):
 
     """
@@ -1131,7 +1572,7 @@ def minmax_amplitude(wave):
     return np.max(wave) - np.min(wave)
 
 
-def find_affected_by_amplitude_ratio(artif_per_ch: List):
+def find_affected_by_amplitude_ratio(artif_per_ch: Avg_artif_channels):
 
     """
     Calculate the amplitude ratio for each channel.
@@ -1146,30 +1587,29 @@ def find_affected_by_amplitude_ratio(artif_per_ch: List):
     For each channel, calculate the ratio between the channel's peak-to-peak amplitude (minmax_amplitude(ch.artif_data_smoothed)) and 
     the mean peak-to-peak amplitude across all channels (ptp_all_comp_waves).
     
-    This ratio is stored as an attribute (amplitude_ratio) in the Avg_artif object for each channel.
+    This ratio is stored in artif_per_ch.amplitude_ratio (one value per channel).
     
 
     Parameters
     ----------
-    artif_per_ch : List
-        List of channels with Avg_artif objects.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels.
         
     Returns
     -------
-    artif_per_ch : List
-        List of channels with Avg_artif objects, now with assigned amplitude ratio.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels, now with assigned amplitude ratio.
         
     """
 
     #Find MEAN peak to peak amlitude over all waves we have:
-    ptp_all_comp_waves = np.mean([minmax_amplitude(ch.artif_data_smoothed) for ch in artif_per_ch])    
+    ptp_per_ch = np.max(artif_per_ch.artif_data_smoothed, axis=1) - np.min(artif_per_ch.artif_data_smoothed, axis=1) #same as minmax_amplitude() for every channel
+    ptp_all_comp_waves = np.mean(ptp_per_ch)
 
     # Find amplitude ratio for each channel: 
     # dibvide the peak to peak amplitude of the channel by the MEAN peak to peak amplitude of all channels
     # So we see which of the channles have higher amplutude than the average over all channels
-    for ch in artif_per_ch:
-        #ch.amplitude_ratio = rms_amplitude(ch.artif_data_smoothed) / rms_all_comp_waves
-        ch.amplitude_ratio = minmax_amplitude(ch.artif_data_smoothed) / ptp_all_comp_waves
+    artif_per_ch.amplitude_ratio = ptp_per_ch / ptp_all_comp_waves
 
 
     #TODO: tried to normalize here, but maybe we dont need that? cos without it will give raw results
@@ -1183,25 +1623,24 @@ def find_affected_by_amplitude_ratio(artif_per_ch: List):
     return artif_per_ch
 
 
-def find_affected_by_similarity_score(artif_per_ch: List):
+def find_affected_by_similarity_score(artif_per_ch: Avg_artif_channels):
 
     """
     Combine the two metrics like: similarity_score = correlation * amplitude_ratio
 
     Parameters
     ----------
-    artif_per_ch : List
-        List of channels with Avg_artif objects.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels.
 
     Returns
     -------
-    artif_per_ch : List
-        List of channels with Avg_artif objects, now with assigned similarity score.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels, now with assigned similarity score.
 
     """
 
-    for ch in artif_per_ch:
-        ch.similarity_score = abs(ch.corr_coef) * abs(ch.amplitude_ratio)
+    artif_per_ch.similarity_score = np.abs(artif_per_ch.corr_coef) * np.abs(artif_per_ch.amplitude_ratio)
 
     return artif_per_ch
 
@@ -1260,7 +1699,7 @@ def split_correlated_artifacts_into_3_groups(artif_per_ch):
     return most_correlated, middle_correlated, least_correlated, corr_val_of_last_most_correlated, corr_val_of_last_middle_correlated, corr_val_of_last_least_correlated
 
 
-def find_affected_over_mean(artif_per_ch: List, ecg_or_eog: str, params_internal: dict, thresh_lvl_peakfinder: float, m_or_g: str, norm_lvl: float, flip_data: bool, gaussian_sigma: float, artif_time_vector: np.ndarray):
+def find_affected_over_mean(artif_per_ch: Avg_artif_channels, ecg_or_eog: str, params_internal: dict, thresh_lvl_peakfinder: float, m_or_g: str, norm_lvl: float, flip_data: bool, gaussian_sigma: float, artif_time_vector: np.ndarray):
     
     """
     1. Calculate average ECG epoch on the epochs from all channels. Check if average has a wave shape. 
@@ -1285,8 +1724,8 @@ def find_affected_over_mean(artif_per_ch: List, ecg_or_eog: str, params_internal
 
     Parameters
     ----------
-    artif_per_ch : List 
-        list of Avg_artif objects
+    artif_per_ch : Avg_artif_channels
+        mean artifacts of all channels
     ecg_or_eog : str
         'ECG' or 'EOG'
     params_internal : dict
@@ -1322,8 +1761,7 @@ def find_affected_over_mean(artif_per_ch: List, ecg_or_eog: str, params_internal
     max_n_peaks_allowed_for_avg = params_internal['max_n_peaks_allowed_for_avg']
     window_size_for_mean_threshold_method = params_internal['window_size_for_mean_threshold_method']
 
-    artif_per_ch_only_data = [ch.artif_data for ch in artif_per_ch] # USE NON SMOOTHED data. If needed, can be changed to smoothed data
-    avg_overall=np.mean(artif_per_ch_only_data, axis=0) 
+    avg_overall=np.mean(artif_per_ch.artif_data, axis=0) # USE NON SMOOTHED data. If needed, can be changed to smoothed data
     # will show if there is ecg artifact present  on average. should have wave shape if yes. 
     # otherwise - it was not picked up/reconstructed correctly
 
@@ -1422,6 +1860,71 @@ def make_dict_global_ECG_EOG(channels_ranked: List, use_method: str):
     return metric_global_content
 
 
+def make_artif_channel_derivs(ecg_or_eog: str, ch_name: str, ch_data: np.ndarray, event_indexes: Union[List, np.ndarray], sfreq: float, use_method: str, n_events: int, events_rate_per_min: float, mean_wave: np.ndarray = None, mean_wave_time: np.ndarray = None, mean_wave_shifted: np.ndarray = None):
+
+    """
+    Make derivatives of the ECG or EOG channel to be exported and plotted later. 
+    Arrays of different lengths are kept in separate derivatives, so none of them is padded to the length of the recording:
+    
+    * <ECG/EOG>channel: signal of the channel (1 column, 1 row per sample)
+    * <ECG/EOG>events: indexes of detected events (R waves or blinks) in samples
+    * <ECG/EOG>meanwave: mean R wave or blink with its time vector (and shifted mean R wave for ECG), only if the mean wave was calculated
+    * <ECG/EOG>info: sampling frequency, channel name, method and number of events (json)
+
+    Parameters
+    ----------
+    ecg_or_eog : str
+        'ECG' or 'EOG'
+    ch_name : str
+        Name of the ECG or EOG channel.
+    ch_data : np.ndarray
+        Data of the ECG or EOG channel.
+    event_indexes : List or np.ndarray
+        Indexes of detected events in samples.
+    sfreq : float
+        Sampling frequency.
+    use_method : str
+        Method used to find affected channels: recorded or reconstructed channel, etc.
+    n_events : int
+        Number of detected events.
+    events_rate_per_min : float
+        Number of events per minute.
+    mean_wave : np.ndarray
+        Mean R wave or blink. None or empty if not calculated.
+    mean_wave_time : np.ndarray
+        Time vector of the mean wave.
+    mean_wave_shifted : np.ndarray
+        Mean R wave shifted to align with the artifact on MEG channels. None if not calculated.
+
+    Returns
+    -------
+    ch_derivs : List
+        List of QC_derivative objects with data frames and json.
+
+    """
+
+    ch_derivs = [
+        QC_derivative(content=pd.DataFrame({ch_name: np.asarray(ch_data, dtype=np.float64)}), name=ecg_or_eog+'channel', content_type = 'df'),
+        QC_derivative(content=pd.DataFrame({'event_indexes': np.asarray(event_indexes, dtype=np.int64)}), name=ecg_or_eog+'events', content_type = 'df')]
+
+    if mean_wave is not None and np.size(mean_wave) > 0:
+        mean_wave_df = pd.DataFrame({'mean_rwave_time': mean_wave_time, 'mean_rwave': mean_wave})
+        if mean_wave_shifted is not None:
+            mean_wave_df['mean_rwave_shifted'] = mean_wave_shifted
+        ch_derivs += [QC_derivative(content=mean_wave_df, name=ecg_or_eog+'meanwave', content_type = 'df')]
+
+    ch_info = {
+        'ch_name': ch_name,
+        'fs': float(sfreq),
+        'recorded_or_reconstructed': use_method,
+        'n_events': int(n_events),
+        'events_rate_per_min': float(events_rate_per_min)}
+
+    ch_derivs += [QC_derivative(content=ch_info, name=ecg_or_eog+'info', content_type = 'json')]
+
+    return ch_derivs
+
+
 def make_simple_metric_ECG_EOG(channels_ranked: dict, m_or_g_chosen: List, ecg_or_eog: str, avg_artif_str: dict, use_method: str):
     
     """
@@ -1846,7 +2349,7 @@ def find_t0_highest(ch_data: np.ndarray):
     return t0
 
 
-def find_t0_channels(artif_per_ch: List, tmin: float, tmax: float):
+def find_t0_channels(artif_per_ch: Avg_artif_channels, tmin: float, tmax: float):
 
     """ 
     Run peak detection on all channels and find the 10 channels with the highest peaks.
@@ -1857,8 +2360,8 @@ def find_t0_channels(artif_per_ch: List, tmin: float, tmax: float):
 
     Parameters
     ----------
-    artif_per_ch : List
-        List of Avg_artif objects, one for each channel.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels.
     tmin : float
         Start time of epoch.
     tmax : float
@@ -1875,8 +2378,7 @@ def find_t0_channels(artif_per_ch: List, tmin: float, tmax: float):
     chosen_t0 = []
     chosen_t0_magnitudes = []
 
-    for ch in artif_per_ch:
-        data = ch.artif_data_smoothed
+    for data in artif_per_ch.artif_data_smoothed:
         
         #potential_t0 = find_t0_1ch(data)
         ch_t0 = find_t0_highest(data)
@@ -1896,7 +2398,7 @@ def find_t0_channels(artif_per_ch: List, tmin: float, tmax: float):
 
 
     #find the distance between 10 chosen peaks:
-    t = np.linspace(tmin, tmax, len(artif_per_ch[0].artif_data_smoothed))
+    t = np.linspace(tmin, tmax, artif_per_ch.artif_data_smoothed.shape[1])
     time_max = t[np.max(chosen_t0_sorted)]
     time_min = t[np.min(chosen_t0_sorted)]
 
@@ -1947,7 +2449,7 @@ def shift_mean_wave(mean_rwave: np.ndarray, ind_t0_channels: int, ind_t0_mean: i
     return mean_rwave_shifted
 
 
-def align_mean_rwave(mean_rwave: np.ndarray, artif_per_ch: List, tmin: float, tmax: float):
+def align_mean_rwave(mean_rwave: np.ndarray, artif_per_ch: Avg_artif_channels, tmin: float, tmax: float):
 
     """ Aligns the mean ECG wave with the ECG artifacts found on meg channels.
     1) The average highest point of 10 most prominent meg channels is used as refernce.
@@ -1962,8 +2464,8 @@ def align_mean_rwave(mean_rwave: np.ndarray, artif_per_ch: List, tmin: float, tm
     ----------
     mean_rwave : np.array
         The mean ECG wave (resulting from recorded or recosntructed ECG signal).
-    artif_per_ch : List
-        List of Avg_artif objects, each of which contains the ECG artifact from one MEG channel.
+    artif_per_ch : Avg_artif_channels
+        ECG artifacts of all MEG channels.
     tmin : float
         The start time of the ECG artifact, set in config
     tmax : float
@@ -2006,8 +2508,172 @@ def align_mean_rwave(mean_rwave: np.ndarray, artif_per_ch: List, tmin: float, tm
     return mean_rwave_shifted_variations
 
 
+def correlate_shifted_wave(artif_data: np.ndarray, wave: np.ndarray, shifts: Union[List, np.ndarray]):
+
+    """
+    Pearson correlation of every channel with the wave circularly shifted (like np.roll) by every given shift.
+    All shifts for all channels are calculated at once by FFT cross-correlation:
+    shifting does not change the mean and the std of the wave, so only the cross-product of the centered signals
+    depends on the shift, and circular cross-correlation gives it for all shifts in one pass.
+
+    Parameters
+    ----------
+    artif_data : np.ndarray
+        Data of the channels, shape (n_channels, n_times).
+    wave : np.ndarray
+        The wave to shift (1 dimentional, n_times).
+    shifts : List or np.ndarray
+        Shifts in samples, as used in np.roll(wave, shift).
+
+    Returns
+    -------
+    corr : np.ndarray
+        Correlation coefficients, shape (n_channels, n_shifts). NaN for flat channels (or flat wave), like in pearsonr.
+        Equal to pearsonr up to rounding errors.
+
+    """
+
+    n_times = len(wave)
+    data_centered = artif_data - np.mean(artif_data, axis=1, keepdims=True)
+    wave_centered = wave - np.mean(wave)
+
+    # cross_prod[:, k] = sum over n of data_centered[:, n] * wave_centered[n-k] = dot product with np.roll(wave_centered, k):
+    cross_prod = np.fft.irfft(np.fft.rfft(data_centered, axis=1) * np.conj(np.fft.rfft(wave_centered)), n=n_times, axis=1)
+    norm = np.linalg.norm(data_centered, axis=1) * np.linalg.norm(wave_centered)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = cross_prod[:, np.mod(shifts, n_times)] / norm[:, None]
+
+    # constant channels (or constant wave) give NaN, same as in pearsonr:
+    constant = np.all(artif_data == artif_data[:, :1], axis=1) | np.all(wave == wave[0])
+    corr[constant, :] = np.nan
+
+    return np.clip(corr, -1, 1)
+
+
+def mean_of_highest_corr(corr_coef: np.ndarray):
+
+    """
+    Mean of the 10 highest absolute correlation coefficients. Used to compare shifts of the mean ECG wave.
+
+    Here use nanmean, not just mean, because in rare cases pearson calculates nan which can mess up all further calculations.
+    This can happen if all values of the wave are the same, flat channel or if they contain nan values.
+
+    Parameters
+    ----------
+    corr_coef : np.ndarray
+        Correlation coefficients of all channels.
+
+    Returns
+    -------
+    mean_corr : float
+        Mean of the 10 highest absolute correlations.
+
+    """
+
+    all_corr_values = sorted(np.abs(corr_coef), reverse=True)
+
+    return np.nanmean(all_corr_values[0:10])
+
+
+def find_best_mean_rwave_shift(mean_rwave: np.ndarray, artif_per_ch: Avg_artif_channels, tmin: float, tmax: float):
+
+    """
+    Find the shift of the mean ECG wave which aligns it best with the ECG artifacts found on meg channels.
+    Same result as checking every variation from align_mean_rwave with find_affected_by_correlation:
+    the variation with the highest mean of the 10 highest absolute correlations is chosen (the first one if equal).
+
+    Correlations of all channels with all variations are calculated at once with correlate_shifted_wave (FFT).
+    Variations which are as good as the best one up to rounding errors are checked again with pearson_corr_all_channels, 
+    so the choice is exactly the same as with find_affected_by_correlation for every variation.
+
+    Parameters
+    ----------
+    mean_rwave : np.ndarray
+        The mean ECG wave (resulting from recorded or recosntructed ECG signal).
+    artif_per_ch : Avg_artif_channels
+        ECG artifacts of all MEG channels.
+    tmin : float
+        The start time of the ECG artifact, set in config
+    tmax : float
+        The end time of the ECG artifact, set in config
+
+    Returns
+    -------
+    best_mean_rwave_shifted : np.ndarray
+        The best shifted variation of the mean ECG wave. None if no variation has correlation above 0.
+    best_mean_corr : float
+        Mean of the 10 highest absolute correlations for the best variation (0 if none).
+
+    """
+
+    if len(mean_rwave) != artif_per_ch.artif_data_smoothed.shape[1]:
+        raise ValueError('mean_rwave and artif_per_ch.artif_data have different length: ' + str(len(mean_rwave)) + ' and ' + str(artif_per_ch.artif_data_smoothed.shape[1]) + '. Both are defined by tmin and tmax in config and are use to cut the data.')
+
+    t0_channels = find_t0_channels(artif_per_ch, tmin, tmax)
+    shifts = [t0_channels - t0_m for t0_m in find_t0_mean(mean_rwave)] #same shifts as in align_mean_rwave/shift_mean_wave
+
+    corr = correlate_shifted_wave(artif_per_ch.artif_data_smoothed, mean_rwave, shifts)
+    mean_corr_fft = np.array([mean_of_highest_corr(corr[:, i]) for i in range(len(shifts))])
+
+    if np.all(np.isnan(mean_corr_fft)):
+        return None, 0
+
+    # variations which can be the best one within rounding errors of FFT, checked again exactly (in original order):
+    candidates = np.flatnonzero(mean_corr_fft >= np.nanmax(mean_corr_fft) - 1e-9)
+
+    best_mean_corr = 0
+    best_mean_rwave_shifted = None
+    for i in candidates:
+        mean_shifted = np.roll(mean_rwave, shifts[i])
+        mean_corr = mean_of_highest_corr(pearson_corr_all_channels(artif_per_ch.artif_data_smoothed, mean_shifted)[0])
+
+        #if mean corr is better than the previous one - save it:
+        if mean_corr > best_mean_corr:
+            best_mean_corr = mean_corr
+            best_mean_rwave_shifted = mean_shifted
+
+    return best_mean_rwave_shifted, best_mean_corr
+
+
 #%%
-def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, channels: List, chs_by_lobe_orig: dict, m_or_g_chosen: List):
+def add_artifacts_to_channel_table(channel_table: ChannelTable, artif_per_ch: Avg_artif_channels, artif_time_vector: np.ndarray, ecg_or_eog: str):
+
+    """
+    Add mean artifacts and their scores of all channels of one type to the channel table (for extraction into TSV).
+
+    Parameters
+    ----------
+    channel_table : ChannelTable
+        Table with all channels.
+    artif_per_ch : Avg_artif_channels
+        Mean artifacts of all channels of this type.
+    artif_time_vector : np.ndarray
+        Time vector of the artifact.
+    ecg_or_eog : str
+        'ecg' or 'eog'
+
+    Returns
+    -------
+    channel_table : ChannelTable
+        New channel table with added artifacts of these channels.
+
+    """
+
+    names = artif_per_ch.names
+    channel_table = channel_table.with_metric('mean_'+ecg_or_eog, names, artif_per_ch.artif_data, labels=artif_time_vector)
+
+    # scores which were not calculated stay as empty columns:
+    metrics = {'mean_'+ecg_or_eog+'_smoothed': artif_per_ch.artif_data_smoothed, ecg_or_eog+'_corr_coeff': artif_per_ch.corr_coef, ecg_or_eog+'_pval': artif_per_ch.p_value, 
+        ecg_or_eog+'_amplitude_ratio': artif_per_ch.amplitude_ratio, ecg_or_eog+'_similarity_score': artif_per_ch.similarity_score}
+    for attr, values in metrics.items():
+        if values is not None:
+            channel_table = channel_table.with_metric(attr, names, values, labels=artif_time_vector if np.ndim(values) == 2 else None)
+
+    return channel_table
+
+
+def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, channels: List, channel_table: ChannelTable, m_or_g_chosen: List):
     
     """
     Main ECG function. Calculates average ECG artifact and finds affected channels.
@@ -2022,8 +2688,8 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
         Raw data.
     channels : dict
         Dictionary with listds of channels for each channel type (mag and grad).
-    chs_by_lobe : dict
-        Dictionary with lists of channels by lobe.
+    channel_table : ChannelTable
+        Table with all channels. Not changed here: results are added to a new table made from it.
     m_or_g_chosen : List
         List of channel types chosen for the analysis.
         
@@ -2041,10 +2707,6 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
 
     """
 
-    chs_by_lobe = copy.deepcopy(chs_by_lobe_orig) 
-    #in case we will change this variable in any way. If not copied it might introduce errors in parallel processing. 
-    # This variable is used in all modules
-
     sfreq=raw.info['sfreq']
     tmin=ecg_params_internal['ecg_epoch_tmin']
     tmax=ecg_params_internal['ecg_epoch_tmax']
@@ -2073,21 +2735,10 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
         simple_metric_ECG = {'description': ecg_str}
         ecg_str += n_events_str
 
-        #Still Create df to be exported to tsv, with some missing data:
+        #Still export the channel, without the mean wave:
         #(We dont calculate mean ECG when the data is bad - cant find the properly looking mean wave)
 
-        ecg_ch_df = pd.DataFrame({
-            ecg_ch_name: ecg_data,
-            'event_indexes': event_indexes.tolist() + [None] * (len(ecg_data) - len(event_indexes)),
-            'fs': [raw.info['sfreq']] + [None] * (len(ecg_data) - 1),
-            'mean_rwave': [None] * len(ecg_data),
-            'mean_rwave_time': [None] * len(ecg_data),
-            'recorded_or_reconstructed': [use_method] + [None] * (len(ecg_data) - 1),
-            'mean_rwave_shifted' : [None] * len(ecg_data),
-            'n_events' : [n_events] + [None] * (len(ecg_data) - 1),
-            'events_rate_per_min' : [events_rate_per_min] + [None] * (len(ecg_data) - 1)})
-
-        ecg_derivs += [QC_derivative(content=ecg_ch_df, name='ECGchannel', content_type = 'df')]
+        ecg_derivs += make_artif_channel_derivs('ECG', ecg_ch_name, ecg_data, event_indexes, raw.info['sfreq'], use_method, n_events, events_rate_per_min)
 
         return ecg_derivs, simple_metric_ECG, ecg_str, []
 
@@ -2099,20 +2750,9 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
         #mean ECG wave calculsted but bad - dont continue
         simple_metric_ECG = {'description': ecg_str}
 
-        #Still Create df to be exported to tsv, except mean_rwave_shifted:
-
-        ecg_ch_df = pd.DataFrame({
-            ecg_ch_name: ecg_data,
-            'event_indexes': event_indexes.tolist() + [None] * (len(ecg_data) - len(event_indexes)),
-            'fs': [raw.info['sfreq']] + [None] * (len(ecg_data) - 1),
-            'mean_rwave': mean_rwave.tolist() + [None] * (len(ecg_data) - len(mean_rwave)),
-            'mean_rwave_time': mean_rwave_time.tolist() + [None] * (len(ecg_data) - len(mean_rwave_time)),
-            'recorded_or_reconstructed': [use_method] + [None] * (len(ecg_data) - 1),
-            'mean_rwave_shifted' : [None] * len(ecg_data),
-            'n_events' : [n_events] + [None] * (len(ecg_data) - 1),
-            'events_rate_per_min' : [events_rate_per_min] + [None] * (len(ecg_data) - 1)})
+        #Still export the channel and the mean wave, except mean_rwave_shifted:
 
-        ecg_derivs += [QC_derivative(content=ecg_ch_df, name='ECGchannel', content_type = 'df')]
+        ecg_derivs += make_artif_channel_derivs('ECG', ecg_ch_name, ecg_data, event_indexes, raw.info['sfreq'], use_method, n_events, events_rate_per_min, mean_wave=mean_rwave, mean_wave_time=mean_rwave_time)
 
         return ecg_derivs, simple_metric_ECG, ecg_str, []
 
@@ -2121,6 +2761,7 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
     best_affected_channels={}
     bad_avg_str = {}
     avg_objects_ecg =[]
+    best_mean_rwave_shifted = None #only found by correlation methods
 
     for m_or_g  in m_or_g_chosen:
 
@@ -2128,7 +2769,7 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
 
         # ecg_derivs += plot_ecg_eog_mne(ecg_epochs, m_or_g, tmin, tmax)
 
-        artif_per_ch = calculate_artifacts_on_channels(ecg_epochs, channels[m_or_g], chs_by_lobe=chs_by_lobe[m_or_g], thresh_lvl_peakfinder=thresh_lvl_peakfinder, tmin=tmin, tmax=tmax, params_internal=ecg_params_internal, gaussian_sigma=gaussian_sigma)
+        artif_per_ch = calculate_artifacts_on_channels(ecg_epochs, channels[m_or_g], channel_table=channel_table, thresh_lvl_peakfinder=thresh_lvl_peakfinder, tmin=tmin, tmax=tmax, params_internal=ecg_params_internal, gaussian_sigma=gaussian_sigma)
 
         #use_method = 'mean_threshold' 
 
@@ -2149,31 +2790,21 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
             #Our target is best_affected_channels[m_or_g] - the channels that are most correlated with the mean ECG wave, after all variations of alignemnt were checked.
             #We also get best_mean_corr and best_mean_shifted - mostely useful if we wanna plot them.
 
-            mean_rwave_shifted_variations = align_mean_rwave(mean_rwave, artif_per_ch, tmin, tmax)
-            
-            #preassign default value:
-            best_mean_corr = 0
-            
-            for mean_shifted in mean_rwave_shifted_variations:
-                affected_channels[m_or_g] = find_affected_by_correlation(mean_shifted, artif_per_ch)
-
-
-                #collect all correlation values for all channels:
-                all_corr_values = [abs(ch.corr_coef) for ch in affected_channels[m_or_g]]
-                #get 10 highest correlations:
-                all_corr_values.sort(reverse=True)
-                print(all_corr_values)
-                mean_corr = np.nanmean(all_corr_values[0:10]) #[0:10]
-                # here use nanmean, not just nan, because in rare cases 
-                # pearson calculates nan which can mess up all further calculations.
-                # this can happen if all values of the mave are the same, flat channel 
-                # or if they contain naan values.
-                
-                #if mean corr is better than the previous one - save it:
-                if mean_corr > best_mean_corr:
-                    best_mean_corr = mean_corr
-                    best_mean_rwave_shifted = mean_shifted
-                    best_affected_channels[m_or_g] = copy.deepcopy(affected_channels[m_or_g])
+            best_mean_rwave_shifted, best_mean_corr = find_best_mean_rwave_shift(mean_rwave, artif_per_ch, tmin, tmax)
+
+            if best_mean_rwave_shifted is None:
+                # no positive correlation with any alignment (for example, all channels flat) - dont continue
+                no_corr_str = 'Correlation of the mean ECG wave with the ECG artifacts on ' + m_or_g + ' channels could not be computed, affected channels were not estimated. '
+                print('___MEGqc___: ', no_corr_str)
+                ecg_str += '<br><br>' + no_corr_str
+                simple_metric_ECG = {'description': ecg_str}
+
+                #Still export the channel and the mean wave, except mean_rwave_shifted:
+                ecg_derivs += make_artif_channel_derivs('ECG', ecg_ch_name, ecg_data, event_indexes, raw.info['sfreq'], use_method, n_events, events_rate_per_min, mean_wave=mean_rwave, mean_wave_time=mean_rwave_time)
+
+                return ecg_derivs, simple_metric_ECG, ecg_str, []
+
+            best_affected_channels[m_or_g] = find_affected_by_correlation(best_mean_rwave_shifted, artif_per_ch)
 
             # Now that we found best correlation values, next step is to calculate magnitude ratios of every channel
             # Then, calculate similarity value comprised of correlation and magnitude ratio:
@@ -2190,37 +2821,25 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
             raise ValueError('use_method should be either mean_threshold or correlation_recorded or correlation_reconstructed')
         
 
-        #Create FULL df to be exported to tsv:
-        ecg_ch_df = pd.DataFrame({
-            ecg_ch_name: ecg_data,
-            'event_indexes': event_indexes.tolist() + [None] * (len(ecg_data) - len(event_indexes)),
-            'fs': [raw.info['sfreq']] + [None] * (len(ecg_data) - 1),
-            'mean_rwave': mean_rwave.tolist() + [None] * (len(ecg_data) - len(mean_rwave)),
-            'mean_rwave_time': mean_rwave_time.tolist() + [None] * (len(ecg_data) - len(mean_rwave_time)),
-            'recorded_or_reconstructed': [use_method] + [None] * (len(ecg_data) - 1),
-            'mean_rwave_shifted' : best_mean_rwave_shifted.tolist() + [None] * (len(ecg_data) - len(mean_rwave)),
-            'n_events' : [n_events] + [None] * (len(ecg_data) - 1),
-            'events_rate_per_min' : [events_rate_per_min] + [None] * (len(ecg_data) - 1)})
-
-        ecg_derivs += [QC_derivative(content=ecg_ch_df, name='ECGchannel', content_type = 'df')]
-
         #higher thresh_lvl_peakfinder - more peaks will be found on the eog artifact for both separate channels and average overall. As a result, average overll may change completely, since it is centered around the peaks of 5 most prominent channels.
         avg_objects_ecg.append(avg_overall_obj)
 
+    #Export the channel with all the data (mean R wave shifted as found for the last channel type):
+    ecg_derivs += make_artif_channel_derivs('ECG', ecg_ch_name, ecg_data, event_indexes, raw.info['sfreq'], use_method, n_events, events_rate_per_min, mean_wave=mean_rwave, mean_wave_time=mean_rwave_time, mean_wave_shifted=best_mean_rwave_shifted)
+
 
     simple_metric_ECG = make_simple_metric_ECG_EOG(best_affected_channels, m_or_g_chosen, 'ECG', bad_avg_str, use_method)
 
-    #Extract chs_by_lobe into a data frame
+    #Extract channel table with added artifacts into a data frame
     artif_time_vector = np.round(np.arange(tmin, tmax+1/sfreq, 1/sfreq), 3) #yes, you need to round
     #TODO: above we always use tmin, tmax, sfreq to create time vector in every fuction. here it s done again, maybe change above?
 
+    channel_table_ecg = channel_table
     for m_or_g  in m_or_g_chosen:
-        for lobe, lobe_channels in chs_by_lobe[m_or_g].items():
-            for lobe_ch in lobe_channels:
-                lobe_ch.add_ecg_info(best_affected_channels[m_or_g], artif_time_vector)
+        channel_table_ecg = add_artifacts_to_channel_table(channel_table_ecg, best_affected_channels[m_or_g], artif_time_vector, 'ecg')
 
 
-    ecg_csv_deriv = chs_dict_to_csv(chs_by_lobe,  file_name_prefix = 'ECGs')
+    ecg_csv_deriv = channel_table_to_csv(channel_table_ecg,  file_name_prefix = 'ECGs')
 
     ecg_derivs += ecg_csv_deriv
 
@@ -2228,7 +2847,7 @@ def ECG_meg_qc(ecg_params: dict, ecg_params_internal: dict, raw: mne.io.Raw, cha
 
 
 #%%
-def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, channels: dict, chs_by_lobe_orig: dict, m_or_g_chosen: List):
+def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, channels: dict, channel_table: ChannelTable, m_or_g_chosen: List):
     
     """
     Main EOG function. Calculates average EOG artifact and finds affected channels.
@@ -2243,8 +2862,8 @@ def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, cha
         Raw MEG data.
     channels : dict
         Dictionary with listds of channels for each channel type (mag and grad).
-    chs_by_lobe : dict
-        Dictionary with lists of channels separated by lobe.
+    channel_table : ChannelTable
+        Table with all channels. Not changed here: results are added to a new table made from it.
     m_or_g_chosen : List
         List of channel types chosen for the analysis.
         
@@ -2261,10 +2880,6 @@ def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, cha
     
     """
 
-    chs_by_lobe = copy.deepcopy(chs_by_lobe_orig) 
-    #in case we will change this variable in any way. If not copied it might introduce errors in parallel processing. 
-    # This variable is used in all modules
-
     sfreq=raw.info['sfreq']
     tmin=eog_params_internal['eog_epoch_tmin']
     tmax=eog_params_internal['eog_epoch_tmax']
@@ -2305,18 +2920,8 @@ def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, cha
     eog_str += eog_str_checked + n_events_str
 
 
-    #save to df:
-    eog_ch_df = pd.DataFrame({
-        eog_ch_name: eog_data,
-        'event_indexes': event_indexes + [None] * (len(eog_data) - len(event_indexes)),
-        'fs': [raw.info['sfreq']] + [None] * (len(eog_data) - 1),
-        'mean_rwave': mean_blink.tolist() + [None] * (len(eog_data) - len(mean_blink)),
-        'mean_rwave_time': mean_rwave_time.tolist() + [None] * (len(eog_data) - len(mean_rwave_time)),
-        'recorded_or_reconstructed': [use_method] + [None] * (len(eog_data) - 1),
-        'n_events': [n_events] + [None] * (len(eog_data) - 1),
-        'events_rate_per_min': [events_rate_per_min] + [None] * (len(eog_data) - 1)})
-    
-    eog_derivs += [QC_derivative(content=eog_ch_df, name='EOGchannel', content_type = 'df')]
+    #export the channel and the mean blink:
+    eog_derivs += make_artif_channel_derivs('EOG', eog_ch_name, eog_data, event_indexes, raw.info['sfreq'], use_method, n_events, events_rate_per_min, mean_wave=mean_blink, mean_wave_time=mean_rwave_time)
     
 
     if mean_good is False:
@@ -2335,7 +2940,7 @@ def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, cha
 
         # eog_derivs += plot_ecg_eog_mne(eog_epochs, m_or_g, tmin, tmax)
 
-        artif_per_ch = calculate_artifacts_on_channels(eog_epochs, channels[m_or_g], chs_by_lobe=chs_by_lobe[m_or_g], thresh_lvl_peakfinder=thresh_lvl_peakfinder, tmin=tmin, tmax=tmax, params_internal=eog_params_internal, gaussian_sigma=gaussian_sigma)
+        artif_per_ch = calculate_artifacts_on_channels(eog_epochs, channels[m_or_g], channel_table=channel_table, thresh_lvl_peakfinder=thresh_lvl_peakfinder, tmin=tmin, tmax=tmax, params_internal=eog_params_internal, gaussian_sigma=gaussian_sigma)
 
 
         #2 options:
@@ -2375,16 +2980,15 @@ def EOG_meg_qc(eog_params: dict, eog_params_internal: dict, raw: mne.io.Raw, cha
 
     simple_metric_EOG = make_simple_metric_ECG_EOG(best_affected_channels, m_or_g_chosen, 'EOG', bad_avg_str, use_method)
 
-    #Extract chs_by_lobe into a data frame
+    #Extract channel table with added artifacts into a data frame
     artif_time_vector = np.round(np.arange(tmin, tmax+1/sfreq, 1/sfreq), 3) #yes, you need to round
     #TODO: above we always use tmin, tmax, sfreq to create time vector in every fuction. here it s done again, maybe change above?
 
+    channel_table_eog = channel_table
     for m_or_g  in m_or_g_chosen:
-        for lobe, lobe_channels in chs_by_lobe[m_or_g].items():
-            for lobe_ch in lobe_channels:
-                lobe_ch.add_eog_info(best_affected_channels[m_or_g], artif_time_vector)
+        channel_table_eog = add_artifacts_to_channel_table(channel_table_eog, best_affected_channels[m_or_g], artif_time_vector, 'eog')
 
-    eog_csv_deriv = chs_dict_to_csv(chs_by_lobe,  file_name_prefix = 'EOGs')
+    eog_csv_deriv = channel_table_to_csv(channel_table_eog,  file_name_prefix = 'EOGs')
 
     eog_derivs += eog_csv_deriv
 
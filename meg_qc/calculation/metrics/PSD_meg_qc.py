@@ -4,12 +4,14 @@ import mne
 import plotly.graph_objects as go
 from scipy.integrate import simpson
 from scipy.signal import find_peaks, peak_widths
-import copy
 import re   
 from typing import List, Union
 
 from meg_qc.plotting.universal_plots import QC_derivative, get_tit_and_unit
-from meg_qc.calculation.initial_meg_qc import chs_dict_to_csv
+from meg_qc.calculation.objects import ChannelTable
+from meg_qc.calculation.initial_meg_qc import channel_table_to_csv
+from meg_qc.calculation.signal_store import SpectrumCache
+from meg_qc.calculation.parallel_jobs import run_on_channel_blocks
 from meg_qc.plotting.universal_html_report import simple_metric_basic
 
 
@@ -76,6 +78,127 @@ def add_log_buttons(fig: go.Figure):
     return fig
 
 
+def get_band_integration_sums(psds: np.ndarray):
+
+    """
+    Precalculate cumulative sums of the PSD matrix used by integrate_bands().
+    Done once for all channels, after that the area under the curve of any band of any channel is found without looping.
+
+    Values with even and odd indexes are summed up separately, because Simpson's rule gives them different weights.
+    Two zero columns are added in front, so the sum of an empty range is also a subtraction.
+
+    Parameters
+    ----------
+    psds : np.ndarray
+        numpy array of power spectrum dencities, shape (n_channels, n_freqs).
+
+    Returns
+    -------
+    parity_sums : np.ndarray
+        array of shape (n_channels, n_freqs+2). parity_sums[:, k+2] = psds[:, k] + psds[:, k-2] + psds[:, k-4] + ...
+
+    """
+
+    psds = np.atleast_2d(np.asarray(psds, dtype=np.float64))
+
+    parity_sums = np.zeros((psds.shape[0], psds.shape[1]+2))
+    parity_sums[:, 2::2] = np.cumsum(psds[:, 0::2], axis=1)
+    parity_sums[:, 3::2] = np.cumsum(psds[:, 1::2], axis=1)
+
+    return parity_sums
+
+
+def integrate_bands(psds: np.ndarray, parity_sums: np.ndarray, rows: np.ndarray, first_idx: np.ndarray, last_idx: np.ndarray, dx: float):
+
+    """
+    Area under the curve of many bands at once using Simpson's rule, same as scipy.integrate.simpson(psds[row, first:last+1], dx=dx)
+    (including the correction of the last interval for even number of points, which scipy uses),
+    but calculated with cumulative sums instead of a separate call for every band.
+
+    Parameters
+    ----------
+    psds : np.ndarray
+        numpy array of power spectrum dencities, shape (n_channels, n_freqs).
+    parity_sums : np.ndarray
+        cumulative sums made by get_band_integration_sums() from the same psds.
+    rows : np.ndarray
+        index of the channel (row of psds) for every band.
+    first_idx : np.ndarray
+        index of the first frequency of every band.
+    last_idx : np.ndarray
+        index of the last frequency of every band (included).
+    dx : float
+        frequency resolution.
+
+    Returns
+    -------
+    band_ampl : np.ndarray
+        area under the curve for every band. 0 for bands with less than 2 frequencies.
+
+    """
+
+    psds = np.atleast_2d(np.asarray(psds, dtype=np.float64))
+    rows, first_idx, last_idx = np.broadcast_arrays(np.asarray(rows, dtype=int), np.asarray(first_idx, dtype=int), np.asarray(last_idx, dtype=int))
+
+    n_points = last_idx - first_idx + 1
+    # bands with less than 2 frequencies give 0, indexes of empty bands are replaced so they stay inside the array:
+    first_idx = np.where(n_points < 2, 0, first_idx)
+    last_idx = np.where(n_points < 2, 0, last_idx)
+
+    # For even number of points Simpson's rule is used on all but the last point, last interval is corrected separately:
+    even = n_points % 2 == 0
+    last_simpson = np.where(even, last_idx - 1, last_idx)
+
+    def same_parity_sum(start, stop):
+        # sum of psds[rows, start], psds[rows, start+2], ..., psds[rows, stop]. 0 if stop < start.
+        return parity_sums[rows, np.maximum(stop, start-2) + 2] - parity_sums[rows, start]
+
+    f_first = psds[rows, first_idx]
+    f_last = psds[rows, last_simpson]
+
+    band_ampl = (f_first + f_last + 4.0*same_parity_sum(first_idx+1, last_simpson-1) + 2.0*same_parity_sum(first_idx+2, last_simpson-2)) * dx / 3.0
+    band_ampl = np.where(last_simpson - first_idx >= 2, band_ampl, 0)
+
+    # Correction of the last interval (Cartwright), as in scipy.integrate.simpson for evenly spaced data:
+    correction = dx * (5/12*psds[rows, last_idx] + 2/3*psds[rows, np.maximum(last_idx-1, 0)] - 1/12*psds[rows, np.maximum(last_idx-2, 0)])
+    band_ampl = np.where(even & (n_points >= 4), band_ampl + correction, band_ampl)
+
+    # 2 points: trapezoid
+    band_ampl = np.where(n_points == 2, 0.5 * dx * (psds[rows, first_idx] + psds[rows, last_idx]), band_ampl)
+    band_ampl = np.where(n_points < 2, 0, band_ampl)
+
+    return band_ampl
+
+
+def get_band_indexes(freq_bands: List, freqs: np.ndarray):
+
+    """
+    Find first and last index of frequencies inside of each band: freqs >= band[0] and freqs <= band[-1].
+
+    Parameters
+    ----------
+    freq_bands : List
+        list of lists of frequencies: [[f_low, f_high], [f_low, f_high], ...]
+    freqs : np.ndarray
+        sorted frequencies.
+
+    Returns
+    -------
+    first_idx : np.ndarray
+        index of the first frequency of every band.
+    last_idx : np.ndarray
+        index of the last frequency of every band (included).
+
+    """
+
+    freq_bands = np.asarray(freq_bands, dtype=np.float64).reshape(-1, 2) if len(freq_bands) else np.zeros((0, 2))
+
+    first_idx = np.searchsorted(freqs, freq_bands[:, 0], side='left')
+    last_idx = np.searchsorted(freqs, freq_bands[:, -1], side='right') - 1
+
+    return first_idx, last_idx
+
+
 def get_bands_amplitude_per_ch(freq_bands: List, freqs: List, psds: Union[List, np.ndarray], channels: List, bands_names: List = None):
 
     """
@@ -137,32 +260,28 @@ def get_bands_amplitude_per_ch(freq_bands: List, freqs: List, psds: Union[List,
 
     freq_res = freqs[1] - freqs[0]
 
-    total_signal_amplitude = []
+    psds = np.atleast_2d(np.asarray(psds, dtype=np.float64))
+    parity_sums = get_band_integration_sums(psds)
+    n_ch, n_freqs = psds.shape
+    ch_idx = np.arange(n_ch)
 
-    band_ampl_df = pd.DataFrame(index=channels, columns=bands_as_str)
-    band_ampl_relative_to_signal_df = pd.DataFrame(index=channels, columns=bands_as_str)
-    ampl_by_Nfreq_per_ch_list_df = pd.DataFrame(index=channels, columns=bands_as_str)
+    # Amplitude of all bands:
+    total_signal_amplitude = integrate_bands(psds, parity_sums, ch_idx, 0, n_freqs-1, freq_res)
 
-    for ch_n, _ in enumerate(psds):
-        total_signal_amplitude.append(simpson(psds[ch_n], dx=freq_res)) #amplitudeof all bands 
+    # Compute the absolute amplitude of the bands by approximating the area under the curve, all channels and bands at once:
+    first_idx, last_idx = get_band_indexes(freq_bands, np.asarray(freqs))
+    band_ampl = integrate_bands(psds, parity_sums, ch_idx[:, None], first_idx[None, :], last_idx[None, :], freq_res)
 
-        for band_n, band in enumerate(freq_bands):
+    band_ampl_df = pd.DataFrame(band_ampl, index=channels, columns=bands_as_str)
 
-            idx_band = np.logical_and(freqs >= band[0], freqs <= band[-1]) 
-            # idx_band is a list of booleans, where True means that the frequency is in the band and False means it is not.
+    #Calculate how much of the total amplitude of the average signal goes into each of the noise freqs:
+    # relative amplitude: % of this band in the total bands amplitude for this channel:
+    band_ampl_relative_to_signal_df = pd.DataFrame(band_ampl / total_signal_amplitude[:, None], index=channels, columns=bands_as_str)
 
-            # Compute the absolute amplitude of the band by approximating the area under the curve:
-
-            band_ampl = simpson(psds[ch_n][idx_band], dx=freq_res) #amplitude of chosen band
-
-            band_ampl_df.iloc[ch_n, band_n] = band_ampl
-
-            #Calculate how much of the total amplitude of the average signal goes into each of the noise freqs:
-            band_ampl_relative_to_signal_df.iloc[ch_n, band_n] = band_ampl / total_signal_amplitude[ch_n] # relative amplitude: % of this band in the total bands amplitude for this channel:
-
-            #devide the amplitude of band by the  number of frequencies in the band, to compare with RMSE later:
-            ampl_by_Nfreq_per_ch_list_df.iloc[ch_n, band_n] = band_ampl/sum(idx_band)
+    #devide the amplitude of band by the  number of frequencies in the band, to compare with RMSE later:
+    ampl_by_Nfreq_per_ch_list_df = pd.DataFrame(band_ampl / (last_idx - first_idx + 1)[None, :], index=channels, columns=bands_as_str)
 
+    total_signal_amplitude = list(total_signal_amplitude)
 
     return band_ampl_df, band_ampl_relative_to_signal_df, ampl_by_Nfreq_per_ch_list_df, total_signal_amplitude
 
@@ -689,11 +808,15 @@ def find_number_and_ampl_of_noise_freqs(ch_name: str, freqs: List, one_psd: List
 
     if noisy_bands_final: #if not empty
 
-        noise_ampl_df, noise_ampl_relative_to_signal_df, _, _ = get_bands_amplitude_per_ch(noisy_bands_final, freqs, [psd_noise_final], [ch_name])
-        #convert results to a list:
+        psd_noise_final = np.atleast_2d(np.asarray(psd_noise_final, dtype=np.float64))
+        parity_sums = get_band_integration_sums(psd_noise_final)
+        first_idx, last_idx = get_band_indexes(noisy_bands_final, np.asarray(freqs))
+
+        noise_ampl = integrate_bands(psd_noise_final, parity_sums, 0, first_idx, last_idx, freq_res)
+        total_noise_psd_amplitude = integrate_bands(psd_noise_final, parity_sums, 0, 0, psd_noise_final.shape[1]-1, freq_res)
 
-        noise_ampl = noise_ampl_df.iloc[0, :].values.tolist() #take the first and only raw, because there is only one channel calculated by this fucntion
-        noise_ampl_relative_to_signal=noise_ampl_relative_to_signal_df.iloc[0, :].values.tolist()
+        noise_ampl_relative_to_signal = (noise_ampl / total_noise_psd_amplitude).tolist()
+        noise_ampl = noise_ampl.tolist()
     else:
         noise_ampl = []
         noise_ampl_relative_to_signal = []
@@ -722,7 +845,113 @@ def find_number_and_ampl_of_noise_freqs(ch_name: str, freqs: List, one_psd: List
 
 
 
-def get_ampl_of_noisy_freqs(channels: List, freqs: List, avg_psd: List, psds: List, m_or_g: str, helper_plots: bool = False, cut_noise_from_psd: bool = False, prominence_lvl_pos_avg: int = 50, prominence_lvl_pos_channels: int = 15, simple_or_complex: str = 'simple'):
+def find_noisy_freq_bands_indexes_block(psds_block: np.ndarray, freq_res: float, prominence_lvl_pos: int, band_half_length: float):
+
+    """
+    Find noisy frequencies and the bands around them for a block of channels, same way as find_noisy_freq_bands_simple() does for one channel:
+    band of -band_half_length...+band_half_length Hz around every peak, blended bands are split at the lowest point between 2 peaks.
+    Only indexes are returned, no plotting. Used by find_noisy_freqs_all_channels().
+
+    Parameters
+    ----------
+    psds_block : np.ndarray
+        psd values, shape (n_channels_in_block, n_freqs)
+    freq_res : float
+        frequency resolution
+    prominence_lvl_pos : int
+        prominence level for peak detection. The higher the value, the more peaks will be detected.
+    band_half_length : float
+        length of the frequency band before and after the noise peak in Hz.
+
+    Returns
+    -------
+    rows : np.ndarray
+        index of the channel (row of psds_block) for every noisy frequency
+    noisy_freqs_indexes : np.ndarray
+        index of every noisy frequency
+    first_idx : np.ndarray
+        index of the first frequency of the band around every noisy frequency
+    last_idx : np.ndarray
+        index of the last frequency of the band around every noisy frequency (included)
+
+    """
+
+    n_freqs = psds_block.shape[1]
+    prominence_pos = (np.max(psds_block, axis=1) - np.min(psds_block, axis=1)) / prominence_lvl_pos
+
+    peaks_per_ch = [find_peaks(one_psd, prominence=prominence_pos[ch_n])[0] for ch_n, one_psd in enumerate(psds_block)]
+
+    rows = np.repeat(np.arange(len(peaks_per_ch)), [len(peaks) for peaks in peaks_per_ch])
+    noisy_freqs_indexes = np.concatenate(peaks_per_ch + [np.zeros(0, dtype=int)]).astype(int)
+
+    #make frequency bands around the central noise frequency (round half to even, same as round() in find_noisy_freq_bands_simple):
+    first_idx = np.clip(np.round(noisy_freqs_indexes - band_half_length/freq_res), 0, None).astype(int)
+    last_idx = np.clip(np.round(noisy_freqs_indexes + band_half_length/freq_res), None, n_freqs-1).astype(int)
+
+    # Split the blended freqs if bands of 2 neighbouring peaks of the same channel cross (see split_blended_freqs_at_the_lowest_point):
+    first_idx_split = first_idx.copy()
+    last_idx_split = last_idx.copy()
+    for i in np.flatnonzero((rows[1:] == rows[:-1]) & (first_idx[1:] <= last_idx[:-1])):
+        split_ind = noisy_freqs_indexes[i] + np.argmin(psds_block[rows[i], noisy_freqs_indexes[i]:noisy_freqs_indexes[i+1]])
+        last_idx_split[i] = split_ind
+        first_idx_split[i+1] = split_ind
+
+    return rows, noisy_freqs_indexes, first_idx_split, last_idx_split
+
+
+def find_noisy_freqs_all_channels(freqs: np.ndarray, psds: np.ndarray, prominence_lvl_pos: int, band_half_length: float = 1, n_jobs: int = 1):
+
+    """
+    Find noisy frequencies and their absolute and relative amplitudes for all channels at once.
+    Same result as find_number_and_ampl_of_noise_freqs() with the 'simple' approach called for every channel (without cutting the noise from psd),
+    but without creating lists and data frames for every channel: peaks are found in blocks of channels (in parallel if n_jobs > 1),
+    the amplitudes of all the bands are calculated together by integrate_bands().
+
+    Parameters
+    ----------
+    freqs : np.ndarray
+        frequencies
+    psds : np.ndarray
+        psd values, shape (n_channels, n_freqs)
+    prominence_lvl_pos : int
+        prominence level for peak detection. The higher the value, the more peaks will be detected.
+    band_half_length : float
+        length of the frequency band before and after the noise peak in Hz.
+    n_jobs : int
+        Number of processes to use for peak detection. 1: no parallel processing, -1: all CPU cores.
+
+    Returns
+    -------
+    rows : np.ndarray
+        index of the channel (row of psds) for every noisy frequency. Sorted: all noisy frequencies of channel 0 go first, etc.
+    noisy_freqs : np.ndarray
+        noisy frequencies
+    noise_ampl : np.ndarray
+        amplitude (area under the curve) of the band around every noisy frequency
+    noise_ampl_relative_to_signal : np.ndarray
+        noise_ampl divided by the total amplitude of the signal of this channel
+
+    """
+
+    psds = np.atleast_2d(np.asarray(psds, dtype=np.float64))
+    freqs = np.asarray(freqs)
+    freq_res = freqs[1] - freqs[0]
+    n_channels, n_freqs = psds.shape
+
+    channel_blocks, bands_blocks = run_on_channel_blocks(find_noisy_freq_bands_indexes_block, lambda block: (psds[block], freq_res, prominence_lvl_pos, band_half_length), n_channels, n_jobs)
+
+    # rows of the block -> rows of psds:
+    rows = np.concatenate([block[block_rows] for block, (block_rows, _, _, _) in zip(channel_blocks, bands_blocks)])
+    noisy_freqs_indexes, first_idx, last_idx = [np.concatenate([bands[i] for bands in bands_blocks]) for i in (1, 2, 3)]
+
+    parity_sums = get_band_integration_sums(psds)
+    total_amplitude = integrate_bands(psds, parity_sums, np.arange(n_channels), 0, n_freqs-1, freq_res)
+    noise_ampl = integrate_bands(psds, parity_sums, rows, first_idx, last_idx, freq_res)
+
+    return rows, freqs[noisy_freqs_indexes], noise_ampl, noise_ampl / total_amplitude[rows]
+
+
+def get_ampl_of_noisy_freqs(channels: List, freqs: List, avg_psd: List, psds: List, m_or_g: str, helper_plots: bool = False, cut_noise_from_psd: bool = False, prominence_lvl_pos_avg: int = 50, prominence_lvl_pos_channels: int = 15, simple_or_complex: str = 'simple', n_jobs: int = 1):
 
     """
     Find noisy frequencies, their absolute and relative amplitude for averages over all channel (mag or grad) PSD and for each separate channel.
@@ -749,6 +978,8 @@ def get_ampl_of_noisy_freqs(channels: List, freqs: List, avg_psd: List, psds: Li
         prominence level of peak detection for finding noisy frequencies in the PSD of each channel
     simple_or_complex : str
         'simple' or 'complex' - method of finding noisy frequencies. see find_number_and_ampl_of_noise_freqs() for details
+    n_jobs : int
+        Number of processes for finding noisy frequencies of separate channels. 1: no parallel processing.
 
     Returns
     -------
@@ -779,8 +1010,19 @@ def get_ampl_of_noisy_freqs(channels: List, freqs: List, avg_psd: List, psds: Li
     noise_ampl_relative_to_all_signal_local_all_ch={}
     noisy_freqs_local_all_ch={}
 
-    for ch_n, ch in enumerate(channels): #for each channel separately
-        _, noise_ampl_local_all_ch[ch], noise_ampl_relative_to_all_signal_local_all_ch[ch], noisy_freqs_local_all_ch[ch] = find_number_and_ampl_of_noise_freqs(ch, freqs, psds[ch_n,:], helper_plots, m_or_g, cut_noise_from_psd, prominence_lvl_pos_channels, simple_or_complex)
+    if simple_or_complex == 'simple' and cut_noise_from_psd is False and helper_plots is False:
+        #all channels together:
+        rows, noisy_freqs, noise_ampl, noise_ampl_relative = find_noisy_freqs_all_channels(freqs, psds, prominence_lvl_pos_channels, band_half_length=1, n_jobs=n_jobs)
+        split_at = np.searchsorted(rows, np.arange(1, len(channels)))
+
+        for ch, ch_noisy_freqs, ch_noise_ampl, ch_noise_ampl_relative in zip(channels, np.split(noisy_freqs, split_at), np.split(noise_ampl, split_at), np.split(noise_ampl_relative, split_at)):
+            noisy_freqs_local_all_ch[ch] = ch_noisy_freqs
+            noise_ampl_local_all_ch[ch] = ch_noise_ampl.tolist()
+            noise_ampl_relative_to_all_signal_local_all_ch[ch] = ch_noise_ampl_relative.tolist()
+
+    else:
+        for ch_n, ch in enumerate(channels): #for each channel separately
+            _, noise_ampl_local_all_ch[ch], noise_ampl_relative_to_all_signal_local_all_ch[ch], noisy_freqs_local_all_ch[ch] = find_number_and_ampl_of_noise_freqs(ch, freqs, psds[ch_n,:], helper_plots, m_or_g, cut_noise_from_psd, prominence_lvl_pos_channels, simple_or_complex)
 
     return noise_pie_derivative, noise_ampl_global, noise_ampl_relative_to_all_signal_global, noisy_freqs_global, noise_ampl_local_all_ch, noise_ampl_relative_to_all_signal_local_all_ch, noisy_freqs_local_all_ch
 
@@ -936,17 +1178,19 @@ def get_nfft_nperseg(raw: mne.io.Raw, psd_step_size: float):
     return nfft, nperseg
 
 
-def assign_psds_to_channels(chs_by_lobe: dict, freqs: List, psds: List):
+def assign_psds_to_channels(channel_table: ChannelTable, channels: List, freqs: List, psds: List):
 
     """
 
-    Assign std or ptp values of each epoch as list to each channel. 
+    Assign psd values to each channel. 
     This is done for extraction into TSV later and plotting. 
     
     Parameters
     ----------
-    chs_by_lobe : dict
-        dictionary with channel objects sorted by ch type and lobe
+    channel_table : ChannelTable
+        table with all channels
+    channels : List
+        names of the channels in the spectrum, in the order of rows of psds (without the bad channels, see get_psds_by_ch_type)
     freqs : List
         list of frequencies
     psds : List
@@ -954,20 +1198,121 @@ def assign_psds_to_channels(chs_by_lobe: dict, freqs: List, psds: List):
 
     Returns
     -------
-    chs_by_lobe : dict
-        dictionary with channel objects sorted by ch type and lobe with added psd and freq values
+    channel_table : ChannelTable
+        new channel table with added psd and freq values of these channels
 
     """
 
-    for lobe in chs_by_lobe:
-        for ch_n, ch in enumerate(chs_by_lobe[lobe]):
-            ch.psd = psds[ch_n]
-            ch.freq = freqs
+    channel_table = channel_table.with_metric('psd', channels, psds, labels=freqs)
+    channel_table = channel_table.with_metric('freq', channels, np.broadcast_to(freqs, (len(channels), len(freqs)))) #same frequencies for every channel
 
-    return chs_by_lobe
+    return channel_table
+
+def get_psd(raw: mne.io.Raw, picks: List, method: str, fmin: float, fmax: float, n_fft: int, n_per_seg: int, n_jobs: int = 1, psd_cache: SpectrumCache = None, data_variant: str = None, block_seconds: float = 0):
+
+    """
+    Calculate power spectrum of the data or take it from the spectrum cache shared by the metrics of this file.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        raw data
+    picks : List
+        channel names
+    method : str
+        method of spectrum estimation, like 'welch'
+    fmin : float
+        lowest frequency
+    fmax : float
+        highest frequency
+    n_fft : int
+        length of FFT, see get_nfft_nperseg
+    n_per_seg : int
+        length of each segment, see get_nfft_nperseg
+    n_jobs : int
+        number of jobs for mne compute_psd
+    psd_cache : SpectrumCache
+        spectrum cache of this file. If None, spectrum is always calculated.
+    data_variant : str
+        name of the data version the raw is (like 'raw_cropped_filtered'), used as part of the cache key.
+    block_seconds : float
+        if above 0 and method is 'welch', spectrum is accumulated over blocks of data of this length (see compute_psd_welch_blocks).
+
+    Returns
+    -------
+    psds : np.ndarray
+        power spectra, shape (n_channels, n_freqs)
+    freqs : np.ndarray
+        frequencies
+    ch_names : List
+        names of the channels in the order of rows of psds. Bad channels (raw.info['bads']) are left out by MNE.
+
+    """
+
+    if psd_cache is None:
+        psd_cache = SpectrumCache() # used only once: calculates the spectrum the same way as the shared cache does
+
+    return psd_cache.compute_psd(raw, data_variant, picks, method=method, fmin=fmin, fmax=fmax, n_fft=n_fft, n_per_seg=n_per_seg, n_jobs=n_jobs, block_seconds=block_seconds)
+
+def get_psds_by_ch_type(raw: mne.io.Raw, channels: dict, m_or_g_chosen: List, method: str, fmin: float, fmax: float, n_fft: int, n_per_seg: int, n_jobs: int = 1, psd_cache: SpectrumCache = None, data_variant: str = None, block_seconds: float = 0):
+
+    """
+    Estimate power spectrum for all chosen channel types in one pass over the data and split it by channel type afterwards.
+    Bad channels (raw.info['bads']) are not in the spectrum, so the rows are split by the channel names of the spectrum.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        raw data
+    channels : dict
+        dictionary with channel names for each channel type: 'mag' or/and 'grad'
+    m_or_g_chosen : List
+        list with chosen channel types: 'mag' or/and 'grad'
+    method : str
+        method of spectrum estimation, like 'welch'
+    fmin : float
+        lowest frequency
+    fmax : float
+        highest frequency
+    n_fft : int
+        length of FFT, see get_nfft_nperseg
+    n_per_seg : int
+        length of each segment, see get_nfft_nperseg
+    n_jobs : int
+        number of jobs for mne compute_psd
+    psd_cache : SpectrumCache
+        spectrum cache of this file. If None, spectrum is always calculated.
+    data_variant : str
+        name of the data version the raw is (like 'raw_cropped_filtered'), used as part of the cache key.
+    block_seconds : float
+        if above 0 and method is 'welch', spectrum is accumulated over blocks of data of this length (see compute_psd_welch_blocks).
+
+    Returns
+    -------
+    psds : dict
+        power spectra for each channel type, shape (n_channels, n_freqs)
+    freqs : dict
+        frequencies for each channel type
+    psd_channels : dict
+        names of the channels of each channel type in the order of rows of psds: channels without the bad ones
+
+    """
+
+    picks = [ch for m_or_g in m_or_g_chosen for ch in channels[m_or_g]]
+    psds_all, freqs_all, ch_names = get_psd(raw, picks, method=method, fmin=fmin, fmax=fmax, n_fft=n_fft, n_per_seg=n_per_seg, n_jobs=n_jobs, psd_cache=psd_cache, data_variant=data_variant, block_seconds=block_seconds)
+
+    row_of_ch = {ch: row for row, ch in enumerate(ch_names)}
+
+    psds, freqs, psd_channels = {}, {}, {}
+    for m_or_g in m_or_g_chosen:
+        psd_channels[m_or_g] = [ch for ch in channels[m_or_g] if ch in row_of_ch]
+        psds[m_or_g] = psds_all[[row_of_ch[ch] for ch in psd_channels[m_or_g]]]
+        freqs[m_or_g] = freqs_all
+
+    return psds, freqs, psd_channels
 
 #%%
-def PSD_meg_qc(psd_params: dict, psd_params_internal: dict, channels:dict, chs_by_lobe: dict, raw_orig: mne.io.Raw, m_or_g_chosen: List, helper_plots: bool):
+def PSD_meg_qc(psd_params: dict, psd_params_internal: dict, channels:dict, channel_table: ChannelTable, raw_orig: mne.io.Raw, m_or_g_chosen: List, helper_plots: bool, psd_cache: SpectrumCache = None, data_variant: str = None):
     
     """
     Main psd function. Calculates:
@@ -1003,14 +1348,18 @@ def PSD_meg_qc(psd_params: dict, psd_params_internal: dict, channels:dict, chs_b
         dictionary with internal psd parameters
     channels : dict
         dictionary with channel names for each channel type: 'mag' or/and 'grad'
-    chs_by_lobe : dict
-        dictionary with channel objects sorted by ch type and lobe
+    channel_table : ChannelTable
+        table with all channels. Not changed here: psds are added to a new table made from it.
     raw_orig : mne.io.Raw
         raw data
     m_or_g_chosen : List
         list with chosen channel types: 'mag' or/and 'grad'
     helper_plots : bool
         if True, plots with noisy freq bands for average PSD + for 3 different channels will be created (but not added to report).
+    psd_cache : SpectrumCache
+        spectrum cache of this file shared with other metrics. If None, spectrum is calculated here.
+    data_variant : str
+        name of the data version raw_orig is (like 'raw_cropped_filtered'), used as part of the cache key.
 
     Returns
     -------
@@ -1025,7 +1374,7 @@ def PSD_meg_qc(psd_params: dict, psd_params_internal: dict, channels:dict, chs_b
 
     """
     
-    raw = raw_orig.copy() # make a copy of the raw data, to make sure the original data is not changed while filtering for this metric.
+    raw = raw_orig # no copy needed: data is only read here to compute the spectrum.
 
     # these parameters will be saved into a dictionary. this allowes to calculate for mag or grad or both:
     freqs = {}
@@ -1045,34 +1394,36 @@ def PSD_meg_qc(psd_params: dict, psd_params_internal: dict, channels:dict, chs_b
 
     nfft, nperseg = get_nfft_nperseg(raw, psd_params['psd_step_size'])
 
-    chs_by_lobe_psd=copy.deepcopy(chs_by_lobe)
+    channel_table_psd = channel_table
+
+    # one pass over the data for all channel types:
+    psds, freqs, psd_channels = get_psds_by_ch_type(raw, channels, m_or_g_chosen, method=method, fmin=psd_params['freq_min'], fmax=psd_params['freq_max'], n_fft=nfft, n_per_seg=nperseg, n_jobs=psd_params['n_jobs'], psd_cache=psd_cache, data_variant=data_variant, block_seconds=psd_params['block_seconds'])
 
     for m_or_g in m_or_g_chosen:
 
-        psds[m_or_g], freqs[m_or_g] = raw.compute_psd(method=method, fmin=psd_params['freq_min'], fmax=psd_params['freq_max'], picks=channels[m_or_g], n_fft=nfft, n_per_seg=nperseg).get_data(return_freqs=True)
         psds[m_or_g]=np.sqrt(psds[m_or_g]) # amplitude of the noise in this band. without sqrt it is power.
 
-        # Add psds and freqs into chs_by_lobe dict:
-        chs_by_lobe_psd[m_or_g] = assign_psds_to_channels(chs_by_lobe_psd[m_or_g], freqs[m_or_g], psds[m_or_g])
+        # Add psds and freqs into the channel table:
+        channel_table_psd = assign_psds_to_channels(channel_table_psd, psd_channels[m_or_g], freqs[m_or_g], psds[m_or_g])
 
         avg_psd=np.mean(psds[m_or_g],axis=0) # average psd over all channels
         
         #Calculate the amplitude of alpha, beta, etc bands for each channel + average over all channels:
-        bands_pie_df_deriv, dfs_wave_bands_ampl, mean_brain_waves_dict[m_or_g] = get_ampl_of_brain_waves(channels=channels[m_or_g], m_or_g = m_or_g, freqs = freqs[m_or_g], psds = psds[m_or_g], avg_psd=avg_psd)
+        bands_pie_df_deriv, dfs_wave_bands_ampl, mean_brain_waves_dict[m_or_g] = get_ampl_of_brain_waves(channels=psd_channels[m_or_g], m_or_g = m_or_g, freqs = freqs[m_or_g], psds = psds[m_or_g], avg_psd=avg_psd)
 
         # #Calculate noise freqs for each channel + on the average psd curve over all channels together:
-        noise_pie_derivative, noise_ampl_global[m_or_g], noise_ampl_relative_to_all_signal_global[m_or_g], noisy_freqs_global[m_or_g], noise_ampl_local[m_or_g], noise_ampl_relative_to_all_signal_local[m_or_g], noisy_freqs_local[m_or_g] = get_ampl_of_noisy_freqs(channels[m_or_g], freqs[m_or_g], avg_psd, psds[m_or_g], m_or_g, helper_plots=helper_plots, cut_noise_from_psd=False, prominence_lvl_pos_avg=prominence_lvl_pos_avg, prominence_lvl_pos_channels=prominence_lvl_pos_channels, simple_or_complex='simple')
+        noise_pie_derivative, noise_ampl_global[m_or_g], noise_ampl_relative_to_all_signal_global[m_or_g], noisy_freqs_global[m_or_g], noise_ampl_local[m_or_g], noise_ampl_relative_to_all_signal_local[m_or_g], noisy_freqs_local[m_or_g] = get_ampl_of_noisy_freqs(psd_channels[m_or_g], freqs[m_or_g], avg_psd, psds[m_or_g], m_or_g, helper_plots=helper_plots, cut_noise_from_psd=False, prominence_lvl_pos_avg=prominence_lvl_pos_avg, prominence_lvl_pos_channels=prominence_lvl_pos_channels, simple_or_complex='simple', n_jobs=psd_params['n_jobs'])
         
         derivs_psd += dfs_wave_bands_ampl +[noise_pie_derivative] + bands_pie_df_deriv
 
 
     # Make a simple metric for PSD:
-    simple_metric=make_simple_metric_psd(mean_brain_waves_dict, noise_ampl_global, noise_ampl_relative_to_all_signal_global, noisy_freqs_global, noise_ampl_local, noise_ampl_relative_to_all_signal_local, noisy_freqs_local, m_or_g_chosen, freqs, channels)
+    simple_metric=make_simple_metric_psd(mean_brain_waves_dict, noise_ampl_global, noise_ampl_relative_to_all_signal_global, noisy_freqs_global, noise_ampl_local, noise_ampl_relative_to_all_signal_local, noisy_freqs_local, m_or_g_chosen, freqs, psd_channels)
 
     psd_str = '' #blank for now. maybe wil need to add notes later.
 
-    #Extract chs_by_lobe into a data frame
-    df_deriv = chs_dict_to_csv(chs_by_lobe_psd,  file_name_prefix = 'PSDs')
+    #Extract channel table into a data frame
+    df_deriv = channel_table_to_csv(channel_table_psd,  file_name_prefix = 'PSDs')
 
     derivs_psd += df_deriv
 
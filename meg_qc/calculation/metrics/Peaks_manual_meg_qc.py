@@ -6,8 +6,9 @@ from scipy.signal import find_peaks
 from meg_qc.plotting.universal_plots import assign_epoched_std_ptp_to_channels
 from meg_qc.plotting.universal_html_report import simple_metric_basic
 from meg_qc.calculation.metrics.STD_meg_qc import make_dict_global_std_ptp, make_dict_local_std_ptp, get_big_small_std_ptp_all_data, get_noisy_flat_std_ptp_epochs
-from meg_qc.calculation.initial_meg_qc import chs_dict_to_csv
-import copy
+from meg_qc.calculation.objects import ChannelTable
+from meg_qc.calculation.initial_meg_qc import channel_table_to_csv
+from meg_qc.calculation.parallel_jobs import run_on_channel_blocks
 
 #The manual PtP version. 
 
@@ -47,40 +48,123 @@ def neighbour_peak_amplitude(max_pair_dist_sec: float, sfreq: int, pos_peak_locs
         return 0, None
     
     pair_dist=max_pair_dist_sec*sfreq
-    pairs_magnitudes=[]
-    pairs_locs=[]
 
-    # Looping over all positive peaks
-    for posit_peak_ind, posit_peak_loc in enumerate(pos_peak_locs):
-        
-        # Finding the value in neg_peak_locs which is closest to posit_peak_loc
-        closest_negative_peak_index = np.abs(neg_peak_locs - posit_peak_loc).argmin()
+    # Finding for every positive peak the closest negative peak.
+    # Peak locations come from find_peaks, so they are sorted: the closest negative peak is either the first one 
+    # at or after the positive peak or the one right before it. If both are at the same distance - the earlier one is taken.
+    after_ind = np.searchsorted(neg_peak_locs, pos_peak_locs)
+    before_ind = np.maximum(after_ind - 1, 0)
+    after_ind = np.minimum(after_ind, len(neg_peak_locs) - 1)
 
-        # Check if the closest negative peak is within the given distance
-        if np.abs(neg_peak_locs[closest_negative_peak_index] - posit_peak_loc) <= pair_dist / 2:
-            pairs_locs.append([pos_peak_locs[posit_peak_ind], neg_peak_locs[closest_negative_peak_index]])
-            pairs_magnitudes.append([pos_peak_magnitudes[posit_peak_ind], neg_peak_magnitudes[closest_negative_peak_index]])
-        
+    dist_before = np.abs(neg_peak_locs[before_ind] - pos_peak_locs)
+    dist_after = np.abs(neg_peak_locs[after_ind] - pos_peak_locs)
+    closest_negative_peak_index = np.where(dist_before <= dist_after, before_ind, after_ind)
+    closest_dist = np.minimum(dist_before, dist_after)
+
+    # Pairs: positive peak + closest negative peak, if the negative peak is within the given distance
+    paired = closest_dist <= pair_dist / 2
+    pairs_pos_ind = np.flatnonzero(paired)
+    pairs_neg_ind = closest_negative_peak_index[paired]
 
     # if no positive+negative pairs were fould (no corresponding peaks at given distamce to each other) -> 
     # - give the difference between min and max value of the data + a note that no pairs were found
 
-    if len(pairs_magnitudes)==0:
-        pairs_magnitudes.append([max(pos_peak_magnitudes), min(neg_peak_magnitudes)])
+    if len(pairs_pos_ind)==0:
+        amplitude=np.array([max(pos_peak_magnitudes) - min(neg_peak_magnitudes)])
         print('___MEGqc___: ', 'No pairs found with the given distance between peaks. The amplitude is calculated as the difference between the max and min value of the entire data. \nConsider changing the distance between peaks in the config file.')
+    else:
+        amplitude=pos_peak_magnitudes[pairs_pos_ind] - neg_peak_magnitudes[pairs_neg_ind]
 
-    amplitude=np.zeros(len(pairs_magnitudes),)
-    #print('___MEGqc___: ', 'Number of peaks pairs used for for PtP calculation: ', len(pairs_magnitudes))
+    #print('___MEGqc___: ', 'Number of peaks pairs used for for PtP calculation: ', len(amplitude))
     #TODO: think of: sometimes we get only a few pairs, like 1-2-3, this is not enough for an accurate estimation of the mean amplitude.
     # Set minimum of pairs or another approach?
     
-    for i, pair in enumerate(pairs_magnitudes):
-        amplitude[i]=pair[0]-pair[1]
-
     return np.mean(amplitude), amplitude
 
 
-def get_ptp_all_data(data: mne.io.Raw, channels: List, sfreq: int, ptp_thresh_lvl: float, max_pair_dist_sec: float):
+def get_ptp_cells(data_cells: np.ndarray, thresholds: np.ndarray, sfreq: int, max_pair_dist_sec: float):
+
+    """
+    Calculate peak-to-peak amplitude for a number of data pieces (cells), 
+    like one channel in one epoch or one channel over whole data.
+
+    Parameters:
+    -----------
+    data_cells : np.ndarray
+        Array of shape (n_cells, n_times) with the data of every cell.
+    thresholds : np.ndarray
+        Array of shape (n_cells,) with the prominence threshold for peak detection of every cell.
+    sfreq : int
+        Sampling frequency of data. Attention to which data is used! original or resampled.
+    max_pair_dist_sec : float
+        Maximum distance in seconds which is allowed for negative+positive peaks to be detected as a pair
+
+    Returns:
+    --------
+    peak_ampl_cells : List
+        Peak-to-peak amplitude of every cell.
+
+    """
+
+    peak_ampl_cells = []
+    for one_cell_data, thresh in zip(data_cells, thresholds):
+
+        #mne.preprocessing.peak_finder() gives error if there are no peaks detected. We use scipy.signal.find_peaks() instead here:
+        pos_peak_locs, _ = find_peaks(one_cell_data, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
+        pos_peak_magnitudes = one_cell_data[pos_peak_locs]
+
+        neg_peak_locs, _ = find_peaks(-one_cell_data, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
+        neg_peak_magnitudes = one_cell_data[neg_peak_locs]
+
+        pp_ampl, _ = neighbour_peak_amplitude(max_pair_dist_sec, sfreq, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
+        peak_ampl_cells.append(pp_ampl)
+
+    return peak_ampl_cells
+
+
+def get_ptp_channels_cells(data: np.ndarray, sfreq: int, ptp_thresh_lvl: float, max_pair_dist_sec: float, n_jobs: int = 1):
+
+    """
+    Peak-to-peak engine: calculate peak-to-peak amplitude for every channel in every cell (epoch) at once.
+
+    Thresholds of all cells are calculated together on the whole array.
+    Peak detection is done for every cell separately, channels are split into blocks which are processed in parallel processes.
+
+    Parameters:
+    -----------
+    data : np.ndarray
+        Array of shape (n_channels, n_cells, n_times). For example all epochs of all channels, or (n_channels, 1, n_times) for not epoched data.
+    sfreq : int
+        Sampling frequency of data. Attention to which data is used! original or resampled.
+    ptp_thresh_lvl : float
+        The level definig how the PtP threshold will be scaled. Higher number will result in more peaks detected.
+        The threshold is calculated as (max - min) / ptp_thresh_lvl
+    max_pair_dist_sec : float
+        Maximum distance in seconds which is allowed for negative+positive peaks to be detected as a pair
+    n_jobs : int
+        Number of processes to use. 1: no parallel processing, -1: all CPU cores.
+
+    Returns:
+    --------
+    peak_ampl : List
+        List (for every channel) of lists (for every cell) with peak-to-peak amplitudes.
+
+    """
+
+    thresholds = (np.max(data, axis=2) - np.min(data, axis=2)) / ptp_thresh_lvl
+    #can also change the whole thresh to a single number setting
+
+    n_channels, n_cells, n_times = data.shape
+
+    _, peak_ampl_blocks = run_on_channel_blocks(get_ptp_cells, lambda block: (data[block].reshape(-1, n_times), thresholds[block].reshape(-1), sfreq, max_pair_dist_sec), n_channels, n_jobs)
+
+    # back from flat list of cells to list (for every channel) of lists (for every cell):
+    peak_ampl_cells = [peak_ampl for peak_ampl_block in peak_ampl_blocks for peak_ampl in peak_ampl_block]
+
+    return [peak_ampl_cells[i*n_cells:(i+1)*n_cells] for i in range(n_channels)]
+
+
+def get_ptp_all_data(data: mne.io.Raw, channels: List, sfreq: int, ptp_thresh_lvl: float, max_pair_dist_sec: float, n_jobs: int = 1):
 
     """ 
     Calculate peak-to-peak amplitude for all channels over whole data (not epoched).
@@ -98,6 +182,8 @@ def get_ptp_all_data(data: mne.io.Raw, channels: List, sfreq: int, ptp_thresh_lv
         The threshold is calculated as (max - min) / ptp_thresh_lvl
     max_pair_dist_sec : float
         Maximum distance in seconds which is allowed for negative+positive peaks to be detected as a pair
+    n_jobs : int
+        Number of processes to use. 1: no parallel processing, -1: all CPU cores.
 
     Returns:
     --------
@@ -108,31 +194,18 @@ def get_ptp_all_data(data: mne.io.Raw, channels: List, sfreq: int, ptp_thresh_lv
         
     data_channels=data.get_data(picks = channels)
 
-    peak_ampl_channels=[]
-    for one_ch_data in data_channels: 
-
-        thresh=(max(one_ch_data) - min(one_ch_data)) / ptp_thresh_lvl 
-        #can also change the whole thresh to a single number setting
-
-        #mne.preprocessing.peak_finder() gives error if there are no peaks detected. We use scipy.signal.find_peaks() instead here:
-        pos_peak_locs, _ = find_peaks(one_ch_data, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
-        pos_peak_magnitudes = one_ch_data[pos_peak_locs]
-
-        neg_peak_locs, _ = find_peaks(-one_ch_data, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
-        neg_peak_magnitudes = one_ch_data[neg_peak_locs]
-
-        pp_ampl, _ = neighbour_peak_amplitude(max_pair_dist_sec, sfreq, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
-        peak_ampl_channels.append(pp_ampl)
+    #whole data of every channel is one cell:
+    peak_ampl_channels = get_ptp_channels_cells(data_channels[:, np.newaxis, :], sfreq, ptp_thresh_lvl, max_pair_dist_sec, n_jobs)
 
     #add channel name for every std value:
     peak_ampl_channels_named = {}
     for i, ch in enumerate(channels):
-        peak_ampl_channels_named[ch] = peak_ampl_channels[i]
+        peak_ampl_channels_named[ch] = peak_ampl_channels[i][0]
         
     return peak_ampl_channels_named
 
 
-def get_ptp_epochs(channels: List, epochs_mg: mne.Epochs, sfreq: int, ptp_thresh_lvl: float, max_pair_dist_sec: float):
+def get_ptp_epochs(channels: List, epochs_mg: mne.Epochs, sfreq: int, ptp_thresh_lvl: float, max_pair_dist_sec: float, n_jobs: int = 1):
 
     """  
     Calculate peak-to-peak amplitude for every epoch and every channel (mag or grad).
@@ -150,6 +223,8 @@ def get_ptp_epochs(channels: List, epochs_mg: mne.Epochs, sfreq: int, ptp_thresh
         The threshold is calculated as (max - min) / ptp_thresh_lvl
     max_pair_dist_sec : float
         Maximum distance in seconds which is allowed for negative+positive peaks to be detected as a pair
+    n_jobs : int
+        Number of processes to use. 1: no parallel processing, -1: all CPU cores.
 
     Returns:
     --------
@@ -157,29 +232,15 @@ def get_ptp_epochs(channels: List, epochs_mg: mne.Epochs, sfreq: int, ptp_thresh
         Dataframe containing the mean peak-to-peak aplitude for each epoch for each channel
 
     """
-    dict_ep = {}
-
-    #get 1 epoch, 1 channel and calculate PtP on its data:
-    for ep in range(0, len(epochs_mg)):
-        peak_ampl_epoch=[]
-        for ch_name in channels: 
-            data_ch_epoch=epochs_mg[ep].get_data(picks=ch_name)[0][0]
-            #[0][0] is because get_data creats array in array in array, it expects several epochs, several channels, but we only need  one.
-            
-            thresh=(max(data_ch_epoch) - min(data_ch_epoch)) / ptp_thresh_lvl 
-            #can also change the whole thresh to a single number setting
 
+    #get all epochs for all channels at once: array of shape (n_channels, n_epochs, n_times)
+    data_epochs = epochs_mg.get_data(picks=channels).transpose(1, 0, 2)
 
-            pos_peak_locs, _ = find_peaks(data_ch_epoch, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
-            pos_peak_magnitudes = data_ch_epoch[pos_peak_locs]
+    peak_ampl = get_ptp_channels_cells(data_epochs, sfreq, ptp_thresh_lvl, max_pair_dist_sec, n_jobs)
 
-            neg_peak_locs, _ = find_peaks(-data_ch_epoch, prominence=thresh) #assume there are no peaks within 0.5 seconds from each other.
-            neg_peak_magnitudes = data_ch_epoch[neg_peak_locs]
-            
-            pp_ampl,_=neighbour_peak_amplitude(max_pair_dist_sec, sfreq, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
-            peak_ampl_epoch.append(pp_ampl)
-
-        dict_ep[ep] = peak_ampl_epoch
+    dict_ep = {}
+    for ep in range(0, len(epochs_mg)):
+        dict_ep[ep] = [peak_ampl_ch[ep] for peak_ampl_ch in peak_ampl]
 
     return pd.DataFrame(dict_ep, index=channels)
 
@@ -240,7 +301,7 @@ def make_simple_metric_ptp_manual(ptp_manual_params: dict, big_ptp_with_value_al
     return simple_metric
 
 
-def PP_manual_meg_qc(ptp_manual_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_mg: dict, data: mne.io.Raw, m_or_g_chosen: List):
+def PP_manual_meg_qc(ptp_manual_params: dict, channels: dict, channel_table: ChannelTable, dict_epochs_mg: dict, data: mne.io.Raw, m_or_g_chosen: List):
 
     """
     Main Peak to peak amplitude function. Calculates:
@@ -259,8 +320,8 @@ def PP_manual_meg_qc(ptp_manual_params: dict, channels: dict, chs_by_lobe: dict,
         Dictionary containing the parameters for the metric
     channels : dict
         Dict (mag, grad) with all channel names
-    chs_by_lobe : dict
-        dictionary with channels grouped first by ch type and then by lobe: chs_by_lobe['mag']['Left Occipital'] or chs_by_lobe['grad']['Left Occipital']
+    channel_table : ChannelTable
+        table with all channels (name, type, lobe, etc). Not changed here: ptp results are added to a new table made from it.
     dict_epochs_mg : dict
         Dict (mag, grad) with epochs for each channel. Should be the same for both channels. Used only to check if epochs are present.
     data : mne.io.Raw
@@ -289,27 +350,22 @@ def PP_manual_meg_qc(ptp_manual_params: dict, channels: dict, chs_by_lobe: dict,
     peak_ampl = {}
     noisy_flat_epochs_derivs = {}
 
-    chs_by_lobe_ptp=copy.deepcopy(chs_by_lobe)
-    # copy here, because want to keep original dict unchanged. 
-    # In principal it s good to collect all data about channel metrics there BUT if the metrics are run in parallel this might produce conflicts 
-    # (without copying  dict can be chanaged both inside+outside this function even when it is not returned.)
+    channel_table_ptp = channel_table
 
     for m_or_g in m_or_g_chosen:
 
-        peak_ampl[m_or_g] = get_ptp_all_data(data, channels[m_or_g], sfreq, ptp_thresh_lvl=ptp_manual_params['ptp_thresh_lvl'], max_pair_dist_sec=ptp_manual_params['max_pair_dist_sec'])
+        peak_ampl[m_or_g] = get_ptp_all_data(data, channels[m_or_g], sfreq, ptp_thresh_lvl=ptp_manual_params['ptp_thresh_lvl'], max_pair_dist_sec=ptp_manual_params['max_pair_dist_sec'], n_jobs=ptp_manual_params['n_jobs'])
         
-        #Add ptp data into channel object inside the chs_by_lobe dictionary:
-        for lobe in chs_by_lobe_ptp[m_or_g]:
-            for ch in chs_by_lobe_ptp[m_or_g][lobe]:
-                ch.ptp_overall = peak_ampl[m_or_g][ch.name]
+        #Add ptp data of these channels into the channel table:
+        channel_table_ptp = channel_table_ptp.with_metric('ptp_overall', channels[m_or_g], [peak_ampl[m_or_g][ch_name] for ch_name in channels[m_or_g]])
         
         big_ptp_with_value_all_data[m_or_g], small_ptp_with_value_all_data[m_or_g] = get_big_small_std_ptp_all_data(peak_ampl[m_or_g], channels[m_or_g], ptp_manual_params['std_lvl'])
 
     if dict_epochs_mg['mag'] is not None or dict_epochs_mg['grad'] is not None: #if epochs are present
         for m_or_g in m_or_g_chosen:
-            df_ptp=get_ptp_epochs(channels[m_or_g], dict_epochs_mg[m_or_g], sfreq, ptp_manual_params['ptp_thresh_lvl'], ptp_manual_params['max_pair_dist_sec'])
+            df_ptp=get_ptp_epochs(channels[m_or_g], dict_epochs_mg[m_or_g], sfreq, ptp_manual_params['ptp_thresh_lvl'], ptp_manual_params['max_pair_dist_sec'], ptp_manual_params['n_jobs'])
             
-            chs_by_lobe_ptp[m_or_g] = assign_epoched_std_ptp_to_channels(what_data='peaks', chs_by_lobe=chs_by_lobe_ptp[m_or_g], df_std_ptp=df_ptp) #for easier plotting
+            channel_table_ptp = assign_epoched_std_ptp_to_channels(what_data='peaks', channel_table=channel_table_ptp, df_std_ptp=df_ptp) #for easier plotting
 
             noisy_flat_epochs_derivs[m_or_g] = get_noisy_flat_std_ptp_epochs(df_ptp, m_or_g, 'ptp', ptp_manual_params['noisy_channel_multiplier'], ptp_manual_params['flat_multiplier'], ptp_manual_params['allow_percent_noisy_flat_epochs'])
             derivs_list += noisy_flat_epochs_derivs[m_or_g]
@@ -325,8 +381,8 @@ def PP_manual_meg_qc(ptp_manual_params: dict, channels: dict, chs_by_lobe: dict,
     
     simple_metric_ptp_manual = make_simple_metric_ptp_manual(ptp_manual_params, big_ptp_with_value_all_data, small_ptp_with_value_all_data, channels, noisy_flat_epochs_derivs, metric_local, m_or_g_chosen)
 
-    #Extract chs_by_lobe into a data frame
-    df_deriv = chs_dict_to_csv(chs_by_lobe_ptp,  file_name_prefix = 'PtPsManual')
+    #Extract channel table into a data frame
+    df_deriv = channel_table_to_csv(channel_table_ptp,  file_name_prefix = 'PtPsManual')
 
     derivs_ptp += derivs_list + df_deriv
 
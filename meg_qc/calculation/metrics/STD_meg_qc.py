@@ -1,11 +1,11 @@
 import numpy as np
 import pandas as pd
 import mne
-import copy
 from typing import List
 from meg_qc.plotting.universal_plots import QC_derivative, assign_epoched_std_ptp_to_channels
 from meg_qc.plotting.universal_html_report import simple_metric_basic
-from meg_qc.calculation.initial_meg_qc import chs_dict_to_csv
+from meg_qc.calculation.objects import ChannelTable
+from meg_qc.calculation.initial_meg_qc import channel_table_to_csv
 
 
 def get_std_all_data(data: mne.io.Raw, channels: List):
@@ -114,22 +114,14 @@ def get_std_epochs(channels: List, epochs_mg: mne.Epochs):
     pd.DataFrame
         dataframe with std values for each channel and each epoch
     """
-    
-    dict_ep = {}
-
-    #get 1 epoch, 1 channel and calculate std of its data:
-    for ep in range(0, len(epochs_mg)):
-        std_epoch=[]
-        for ch_name in channels: 
-            data_ch_epoch=epochs_mg[ep].get_data(picks=ch_name)[0][0] 
-            #[0][0] is because get_data creats array in array in array, it expects several epochs, several channels, but we only need  one.
 
-            std_ch_ep = np.std(data_ch_epoch) 
-            std_epoch.append(np.float64(std_ch_ep))
+    #get all epochs for all channels at once: array of shape (n_epochs, n_channels, n_times)
+    data_epochs = epochs_mg.get_data(picks=channels)
 
-        dict_ep[ep] = std_epoch
+    #std over time for every channel in every epoch: (n_epochs, n_channels)
+    std_epochs = np.std(data_epochs, axis=2)
 
-    return pd.DataFrame(dict_ep, index=channels)
+    return pd.DataFrame(std_epochs.T, index=channels, columns=list(range(len(epochs_mg))))
 
 
 
@@ -387,7 +379,7 @@ def make_simple_metric_std(std_params:  dict, big_std_with_value_all_data: List[
     return simple_metric
 
 #%%
-def STD_meg_qc(std_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_mg: dict, data: mne.io.Raw, m_or_g_chosen: List):
+def STD_meg_qc(std_params: dict, channels: dict, channel_table: ChannelTable, dict_epochs_mg: dict, data: mne.io.Raw, m_or_g_chosen: List):
 
     """
     Main STD function. Calculates:
@@ -402,8 +394,8 @@ def STD_meg_qc(std_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_
         dictionary with parameters for std metric, originally from config file
     channels : dict
         dictionary with channel names for each channel type: channels['mag'] or channels['grad']
-    chs_by_lobe : dict
-        dictionary with channels grouped first by ch type and then by lobe: chs_by_lobe['mag']['Left Occipital'] or chs_by_lobe['grad']['Left Occipital']
+    channel_table : ChannelTable
+        table with all channels (name, type, lobe, etc). Not changed here: std results are added to a new table made from it.
     dict_epochs_mg : dict
         dictionary with epochs for each channel type: dict_epochs_mg['mag'] or dict_epochs_mg['grad']
     data : mne.io.Raw
@@ -429,20 +421,14 @@ def STD_meg_qc(std_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_
     derivs_list = []
     noisy_flat_epochs_derivs={}
 
-    chs_by_lobe_std=copy.deepcopy(chs_by_lobe)
-    # copy here, because want to keep original dict unchanged. 
-    # In principal it s good to collect all data about channel metrics there BUT if the metrics are run in parallel this might produce conflicts 
-    # (without copying  dict can be chanaged both inside+outside this function even when it is not returned.)
+    channel_table_std = channel_table
 
     for m_or_g in m_or_g_chosen:
 
         std_all_data[m_or_g] = get_std_all_data(data, channels[m_or_g])
 
-        #Add std data into channel object inside the chs_by_lobe dictionary:
-        for lobe in chs_by_lobe_std[m_or_g]:
-            for ch in chs_by_lobe_std[m_or_g][lobe]:
-                ch.std_overall = std_all_data[m_or_g][ch.name]
-                #print(ch.__dict__) #will print all the info saved in the object, more than just simply printing the object
+        #Add std data of these channels into the channel table:
+        channel_table_std = channel_table_std.with_metric('std_overall', channels[m_or_g], [std_all_data[m_or_g][ch_name] for ch_name in channels[m_or_g]])
 
         big_std_with_value_all_data[m_or_g], small_std_with_value_all_data[m_or_g] = get_big_small_std_ptp_all_data(std_all_data[m_or_g], channels[m_or_g], std_params['std_lvl'])
 
@@ -450,7 +436,7 @@ def STD_meg_qc(std_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_
         for m_or_g in m_or_g_chosen:
             df_std = get_std_epochs(channels[m_or_g], dict_epochs_mg[m_or_g])
 
-            chs_by_lobe_std[m_or_g] = assign_epoched_std_ptp_to_channels(what_data='stds', chs_by_lobe=chs_by_lobe_std[m_or_g], df_std_ptp=df_std) #for easier plotting
+            channel_table_std = assign_epoched_std_ptp_to_channels(what_data='stds', channel_table=channel_table_std, df_std_ptp=df_std) #for easier plotting
 
             noisy_flat_epochs_derivs[m_or_g] = get_noisy_flat_std_ptp_epochs(df_std, m_or_g, 'std', std_params['noisy_channel_multiplier'], std_params['flat_multiplier'], std_params['allow_percent_noisy_flat_epochs'])
             derivs_list += noisy_flat_epochs_derivs[m_or_g]
@@ -465,8 +451,8 @@ def STD_meg_qc(std_params: dict, channels: dict, chs_by_lobe: dict, dict_epochs_
 
     simple_metric_std = make_simple_metric_std(std_params, big_std_with_value_all_data, small_std_with_value_all_data, channels, noisy_flat_epochs_derivs, metric_local, m_or_g_chosen)
 
-    #Extract chs_by_lobe into a data frame
-    df_deriv = chs_dict_to_csv(chs_by_lobe_std,  file_name_prefix = 'STDs')
+    #Extract channel table into a data frame
+    df_deriv = channel_table_to_csv(channel_table_std,  file_name_prefix = 'STDs')
 
     derivs_std += derivs_list + df_deriv
 
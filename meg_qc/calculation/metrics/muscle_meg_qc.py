@@ -29,8 +29,10 @@ import numpy as np
 from mne.preprocessing import annotate_muscle_zscore
 from typing import List
 from meg_qc.plotting.universal_plots import QC_derivative
+from meg_qc.calculation.metrics.PSD_meg_qc import get_psds_by_ch_type, get_nfft_nperseg
+from meg_qc.calculation.signal_store import SpectrumCache
 
-def find_powerline_noise_short(raw, psd_params, psd_params_internal, m_or_g_chosen, channels):
+def find_powerline_noise_short(raw, psd_params, psd_params_internal, m_or_g_chosen, channels, psd_cache: SpectrumCache = None, data_variant: str = None):
 
     """
     Find powerline noise in the data.
@@ -45,6 +47,12 @@ def find_powerline_noise_short(raw, psd_params, psd_params_internal, m_or_g_chos
         The parameters for PSD calculation originally defined in the internal config file. 
     m_or_g_chosen : List
         The channel types chosen for the analysis: 'mag' or 'grad'.
+    channels : dict
+        Channel names for each channel type.
+    psd_cache : SpectrumCache
+        Spectrum cache of this file shared with PSD_meg_qc. If None, spectrum is calculated here.
+    data_variant : str
+        Name of the data version raw is (like 'raw_cropped_filtered'), used as part of the cache key.
     
     Returns
     -------
@@ -56,20 +64,19 @@ def find_powerline_noise_short(raw, psd_params, psd_params_internal, m_or_g_chos
     method = psd_params_internal['method']
     prominence_lvl_pos_avg = psd_params_internal['prominence_lvl_pos_avg']
     psd_step_size = psd_params['psd_step_size']
-    sfreq=raw.info['sfreq']
-    nfft=int(sfreq/psd_step_size)
-    nperseg=int(sfreq/psd_step_size)
+    nfft, nperseg = get_nfft_nperseg(raw, psd_step_size)
 
+    # If PSD already estimated the same spectrum, it comes from the cache:
+    psds, freqs, _ = get_psds_by_ch_type(raw, channels, m_or_g_chosen, method=method, fmin=psd_params['freq_min'], fmax=psd_params['freq_max'], n_fft=nfft, n_per_seg=nperseg, n_jobs=psd_params['n_jobs'], psd_cache=psd_cache, data_variant=data_variant, block_seconds=psd_params['block_seconds'])
 
     noisy_freqs = {}
     for m_or_g in m_or_g_chosen:
 
-        psds, freqs = raw.compute_psd(method=method, fmin=psd_params['freq_min'], fmax=psd_params['freq_max'], picks=channels[m_or_g], n_jobs=-1, n_fft=nfft, n_per_seg=nperseg).get_data(return_freqs=True)
-        avg_psd=np.mean(psds,axis=0) # average psd over all channels
+        avg_psd=np.mean(psds[m_or_g],axis=0) # average psd over all channels
         prominence_pos=(max(avg_psd) - min(avg_psd)) / prominence_lvl_pos_avg
 
         noisy_freqs_indexes, _ = find_peaks(avg_psd, prominence=prominence_pos)
-        noisy_freqs [m_or_g] = freqs[noisy_freqs_indexes]
+        noisy_freqs [m_or_g] = freqs[m_or_g][noisy_freqs_indexes]
 
     return noisy_freqs
 
@@ -173,6 +180,33 @@ def filter_noise_before_muscle_detection(raw: mne.io.Raw, noisy_freqs_global: di
     return raw
 
 
+def pick_data_copy(raw: mne.io.Raw, m_or_g_decided: List):
+
+    """
+    Make a loaded copy of the raw data with only chosen channel type.
+    Unlike raw.copy().pick(), the data of the other channels is never copied.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The raw data (loaded or not).
+    m_or_g_decided : List
+        Channel type to keep: ['mag'] or ['grad'].
+        
+    Returns
+    -------
+    raw_picked : mne.io.Raw
+        Copy of the data with only the chosen channels.
+        
+    """
+
+    picks = mne.pick_types(raw.info, meg=m_or_g_decided[0])
+    raw_picked = mne.io.RawArray(raw.get_data(picks=picks), mne.pick_info(raw.info, picks), first_samp=raw.first_samp, verbose=False)
+    raw_picked.set_annotations(raw.annotations)
+
+    return raw_picked
+
+
 def attach_dummy_data(raw: mne.io.Raw, attach_seconds: int = 5):
 
     """
@@ -340,7 +374,7 @@ def save_muscle_to_csv(file_name_prefix: str, raw: mne.io.Raw, scores_muscle: np
     return df_deriv
 
 
-def MUSCLE_meg_qc(muscle_params: dict, psd_params: dict, psd_params_internal: dict, channels: dict, raw_orig: mne.io.Raw, noisy_freqs_global: dict, m_or_g_chosen:list, attach_dummy:bool = True, cut_dummy:bool = True):
+def MUSCLE_meg_qc(muscle_params: dict, psd_params: dict, psd_params_internal: dict, channels: dict, raw_orig: mne.io.Raw, noisy_freqs_global: dict, m_or_g_chosen:list, attach_dummy:bool = True, cut_dummy:bool = True, psd_cache: SpectrumCache = None, data_variant: str = None):
 
     """
     Detect muscle artifacts in MEG data. 
@@ -373,6 +407,10 @@ def MUSCLE_meg_qc(muscle_params: dict, psd_params: dict, psd_params_internal: di
         Whether to attach dummy data to the start and end of the recording to avoid filtering artifacts. Default is True.
     cut_dummy : bool
         Whether to cut the dummy data after filtering. Default is True.
+    psd_cache : SpectrumCache
+        Spectrum cache of this file shared with PSD_meg_qc. Used if noisy_freqs_global is None.
+    data_variant : str
+        Name of the data version raw_orig is (like 'raw_cropped_filtered'), used as part of the cache key.
 
     Returns
     -------
@@ -390,15 +428,13 @@ def MUSCLE_meg_qc(muscle_params: dict, psd_params: dict, psd_params_internal: di
     """
 
     if noisy_freqs_global is None: # if PSD was not calculated before, calculate noise frequencies now:
-        noisy_freqs_global = find_powerline_noise_short(raw_orig, psd_params, psd_params_internal, m_or_g_chosen, channels)
+        noisy_freqs_global = find_powerline_noise_short(raw_orig, psd_params, psd_params_internal, m_or_g_chosen, channels, psd_cache, data_variant)
         print('___MEGqc___: ', 'Noisy frequencies found in data at (HZ): ', noisy_freqs_global)
     else: # if PSD was calculated before, use the frequencies from the PSD step:
         pass
 
 
     muscle_freqs = muscle_params['muscle_freqs']
-   
-    raw = raw_orig.copy() # make a copy of the raw data, to make sure the original data is not changed while filtering for this metric.
 
     if 'mag' in m_or_g_chosen:
         m_or_g_decided=['mag']
@@ -415,7 +451,9 @@ def MUSCLE_meg_qc(muscle_params: dict, psd_params: dict, psd_params_internal: di
     muscle_note = "This metric shows high frequency artifacts in range between 110-140 Hz. High power in this frequency band compared to the rest of the signal is strongly correlated with muscles artifacts, as suggested by MNE. However, high frequency oscillations may also occure in this range for reasons other than muscle activity (for example, in an empty room recording). "
     muscle_str_joined=muscle_note+"<p>"+muscle_str+"</p>"
 
-    raw.load_data() #need to preload data for filtering both in notch filter and in annotate_muscle_zscore
+    # Copy only the channels used for detection, to make sure the original data is not changed while filtering for this metric.
+    # Data is preloaded for filtering both in notch filter and in annotate_muscle_zscore:
+    raw = pick_data_copy(raw_orig, m_or_g_decided)
 
     attach_sec = 3 # seconds
 
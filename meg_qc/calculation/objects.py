@@ -6,6 +6,18 @@ import numpy as np
 import pandas as pd
 from typing import List, Union
 
+
+# Attributes of the channel (MEG_channel) and names of their columns in the exported data frames (tsv files), in the order of columns:
+CHANNEL_COLUMNS = {
+    'name': 'Name', 'type': 'Type', 'lobe': 'Lobe', 'lobe_color': 'Lobe Color', 'system': 'System', 'loc': 'Sensor_location',
+    'time_series': 'Time series', 'std_overall': 'STD all', 'std_epoch': 'STD epoch', 'ptp_overall': 'PtP all', 'ptp_epoch': 'PtP epoch',
+    'psd': 'PSD', 'freq': 'Freq', 'mean_ecg': 'mean_ecg', 'mean_ecg_smoothed': 'smoothed_mean_ecg', 'mean_eog': 'mean_eog',
+    'mean_eog_smoothed': 'smoothed_mean_eog', 'ecg_corr_coeff': 'ecg_corr_coeff', 'ecg_pval': 'ecg_pval', 'ecg_amplitude_ratio': 'ecg_amplitude_ratio',
+    'ecg_similarity_score': 'ecg_similarity_score', 'eog_corr_coeff': 'eog_corr_coeff', 'eog_pval': 'eog_pval', 'eog_amplitude_ratio': 'eog_amplitude_ratio',
+    'eog_similarity_score': 'eog_similarity_score', 'muscle': 'Muscle', 'head': 'Head'
+}
+
+
 class MEG_channel:
 
     """ 
@@ -140,16 +152,8 @@ class MEG_channel:
         """
         
         data_dict = {}
-        attr_to_column = {
-            'name': 'Name', 'type': 'Type', 'lobe': 'Lobe', 'lobe_color': 'Lobe Color', 'system': 'System', 'loc': 'Sensor_location',
-            'time_series': 'Time series', 'std_overall': 'STD all', 'std_epoch': 'STD epoch', 'ptp_overall': 'PtP all', 'ptp_epoch': 'PtP epoch',
-            'psd': 'PSD', 'freq': 'Freq', 'mean_ecg': 'mean_ecg', 'mean_ecg_smoothed': 'smoothed_mean_ecg', 'mean_eog': 'mean_eog',
-            'mean_eog_smoothed': 'smoothed_mean_eog', 'ecg_corr_coeff': 'ecg_corr_coeff', 'ecg_pval': 'ecg_pval', 'ecg_amplitude_ratio': 'ecg_amplitude_ratio',
-            'ecg_similarity_score': 'ecg_similarity_score', 'eog_corr_coeff': 'eog_corr_coeff', 'eog_pval': 'eog_pval', 'eog_amplitude_ratio': 'eog_amplitude_ratio',
-            'eog_similarity_score': 'eog_similarity_score', 'muscle': 'Muscle', 'head': 'Head'
-        }
-
-        for attr, column_name in attr_to_column.items():
+
+        for attr, column_name in CHANNEL_COLUMNS.items():
             value = getattr(self, attr)
             if isinstance(value, (list, np.ndarray)):
                 if attr.lower() == 'psd':
@@ -181,60 +185,310 @@ class MEG_channel:
                 data_dict[column_name] = [value]
 
         return pd.DataFrame(data_dict)
-    
 
-    def add_ecg_info(self, Avg_artif_list: List, artif_time_vector: List):
+
+class ChannelTable:
+
+    """
+    Table of all channels (mag and grad) stored by columns: one array per channel property, one row per channel.
+    Made once in initial processing. Rows are in the same order as channels in chs_by_lobe: by channel type, then by lobe.
+
+    The table is not changed after it is made: metrics add their results with with_metric(), which returns a new table.
+    The new table shares all arrays with the old one, nothing is copied. So metrics running in parallel can use the same table.
+
+    Metric results are kept as blocks: values for some rows (for example all magnetometers) of one channel attribute (see CHANNEL_COLUMNS).
+    Values are 1 dimentional for attributes with one number per channel (like std_overall) 
+    or 2 dimentional (n_rows, n_values) for attributes with an array per channel (like psd or std_epoch).
+
+    Attributes
+    ----------
+    name : np.ndarray
+        channel names
+    type : np.ndarray
+        channel types: 'mag' or 'grad'
+    lobe : np.ndarray
+        lobe area of every channel
+    lobe_color : np.ndarray
+        color code of the lobe of every channel
+    system : np.ndarray
+        MEG system of every channel
+    loc : np.ndarray
+        location of every channel on the helmet (list of coordinates or None)
+    name_index : dict
+        channel name -> row of the channel in the table
+    metrics : dict
+        channel attribute -> tuple of blocks (rows, values, labels). 
+        labels are frequencies (psd) or times (mean_ecg, mean_eog, muscle, head) used in the column names, None for other attributes.
+
+    """
+
+    base_attributes = ['name', 'type', 'lobe', 'lobe_color', 'system', 'loc']
+
+
+    def __init__(self, name: List, type: List, lobe: List, lobe_color: List, system: List, loc: List, metrics: dict = None):
 
         """
-        Adds ECG artifact info to the channel object.
+        Constructor method
 
         Parameters
         ----------
-        Avg_artif_list : List
-            List of the average artifact objects.
-        artif_time_vector : List
-            Time vector of the artifact.
+        name, type, lobe, lobe_color, system, loc : List
+            Properties of all channels, one element per channel.
+        metrics : dict
+            Blocks of metric results, see with_metric(). Empty if None.
 
         """
 
-        for artif_ch in Avg_artif_list:
-            if artif_ch.name == self.name:
-                self.mean_ecg = artif_ch.artif_data
-                self.mean_ecg_smoothed = artif_ch.artif_data_smoothed
-                self.ecg_time = artif_time_vector
-                self.ecg_corr_coeff = artif_ch.corr_coef
-                self.ecg_pval = artif_ch.p_value
-                self.ecg_amplitude_ratio = artif_ch.amplitude_ratio
-                self.ecg_similarity_score = artif_ch.similarity_score
-                
+        for attr, values in zip(self.base_attributes, [name, type, lobe, lobe_color, system, loc]):
+            column = np.empty(len(name), dtype=object)
+            column[:] = list(values)
+            column.flags.writeable = False
+            setattr(self, attr, column)
+
+        self.name_index = {ch_name: row for row, ch_name in enumerate(self.name)}
+        self.metrics = {} if metrics is None else metrics
 
-    def add_eog_info(self, Avg_artif_list: List, artif_time_vector: List):
+
+    @classmethod
+    def from_chs_by_lobe(cls, chs_by_lobe: dict):
 
         """
-        Adds EOG artifact info to the channel object.
+        Make the table from the channel objects.
 
         Parameters
         ----------
-        Avg_artif_list : List
-            List of the average artifact objects.
-        artif_time_vector : List
-            Time vector of the artifact.
+        chs_by_lobe : dict
+            Dictionary with channel objects (MEG_channel) sorted by ch type and lobe.
+
+        Returns
+        -------
+        ChannelTable
+            Table with properties of all channels.
 
         """
 
-        for artif_ch in Avg_artif_list:
-            if artif_ch.name == self.name:
-                self.mean_eog = artif_ch.artif_data
-                self.mean_eog_smoothed = artif_ch.artif_data_smoothed
-                self.eog_time = artif_time_vector
-                self.eog_corr_coeff = artif_ch.corr_coef
-                self.eog_pval = artif_ch.p_value
-                self.eog_amplitude_ratio = artif_ch.amplitude_ratio
-                self.eog_similarity_score = artif_ch.similarity_score
-
-                #Attention: here time_vector, corr_coeff, p_val and everything get assigned to ecg or eog, 
-                # but artif_ch doesnt have this separation to ecg/eog. 
-                # Need to just make sure that the function is called in the right place.
+        chs = [ch for lobes in chs_by_lobe.values() for lobe_chs in lobes.values() for ch in lobe_chs]
+
+        return cls(*[[getattr(ch, attr) for ch in chs] for attr in cls.base_attributes])
+
+
+    def __len__(self):
+
+        return len(self.name)
+
+
+    def __repr__(self):
+
+        return 'ChannelTable with ' + str(len(self)) + ' channels, metrics: ' + ', '.join(self.metrics)
+
+
+    def rows(self, names: List):
+
+        """
+        Rows of the channels in the table.
+
+        Parameters
+        ----------
+        names : List
+            Channel names.
+
+        Returns
+        -------
+        np.ndarray
+            Row indexes, in the order of names.
+
+        """
+
+        return np.array([self.name_index[ch_name] for ch_name in names], dtype=int)
+
+
+    def with_metric(self, attr: str, names: List, values: Union[List, np.ndarray], labels: Union[List, np.ndarray] = None):
+
+        """
+        Add results of a metric for some channels. The table itself is not changed: a new table is returned,
+        which shares all the data with this one (nothing is copied). So metrics running in parallel threads
+        can all start from the same table.
+
+        Parameters
+        ----------
+        attr : str
+            Channel attribute (see CHANNEL_COLUMNS), like 'std_overall' or 'psd'.
+        names : List
+            Names of the channels the values belong to.
+        values : List or np.ndarray
+            One value per channel (1 dimentional) or one array per channel (2 dimentional: n_channels x n_values).
+        labels : List or np.ndarray
+            For 2 dimentional values: frequencies (for psd) or times (for mean_ecg, mean_eog, muscle, head) used in the column names.
+            None: columns are numbered.
+
+        Returns
+        -------
+        ChannelTable
+            New table sharing all data with this one, with the results added.
+
+        """
+
+        if attr not in CHANNEL_COLUMNS or attr in self.base_attributes:
+            raise ValueError('Unknown metric attribute of the channel: ' + str(attr))
+
+        rows = self.rows(names)
+        values = np.asarray(values)
+        if values.shape[0] != len(rows):
+            raise ValueError('Got ' + str(values.shape[0]) + ' values of ' + attr + ' for ' + str(len(rows)) + ' channels.')
+
+        metrics = dict(self.metrics)
+        metrics[attr] = metrics.get(attr, ()) + ((rows, values, labels),)
+
+        table = ChannelTable.__new__(ChannelTable)
+        table.__dict__.update(self.__dict__)
+        table.metrics = metrics
+
+        return table
+
+
+    def get_metric(self, attr: str, names: List):
+
+        """
+        Get the metric values of the channels.
+
+        Parameters
+        ----------
+        attr : str
+            Channel attribute, like 'std_overall' or 'psd'.
+        names : List
+            Channel names.
+
+        Returns
+        -------
+        List
+            Value (or array) for every channel, None for channels without this metric.
+
+        """
+
+        row_values = {}
+        for rows, values, _ in self.metrics.get(attr, ()):
+            row_values.update(zip(rows, values))
+
+        return [row_values.get(self.name_index[ch_name]) for ch_name in names]
+
+
+    def _columns_of_block(self, attr: str, values: np.ndarray, labels):
+
+        """Column names for the values of one block, same as in MEG_channel.to_df()."""
+
+        column_name = CHANNEL_COLUMNS[attr]
+
+        if values.ndim == 1:
+            return [column_name]
+        if labels is None:
+            labels = range(values.shape[1])
+        if attr == 'psd':
+            return [f'{column_name}_Hz_{label}' for label in labels]
+        if 'mean_ecg' in attr or 'mean_eog' in attr or attr in ['muscle', 'head']:
+            return [f'{column_name}_sec_{label}' for label in labels]
+
+        return [f'{column_name}_{label}' for label in labels]
+
+
+    def to_df(self):
+
+        """
+        Export the table into a data frame in one step. Same data frame (and tsv file) as concatenated MEG_channel.to_df() of all channels:
+        all channels have the same index 0, columns go in the order of CHANNEL_COLUMNS, 
+        an attribute with array values gets one column per value, attribute without values for a channel - 1 empty column.
+
+        Returns
+        -------
+        pd.DataFrame
+            Data frame with one row per channel.
+
+        """
+
+        n_rows = len(self)
+
+        # Every attribute as blocks of rows with values. Locations are lists - turn them into blocks of the same length:
+        blocks = {attr: [(np.arange(n_rows), getattr(self, attr), None)] for attr in ['name', 'type', 'lobe', 'lobe_color', 'system']}
+        loc_len = np.array([-1 if loc is None else len(loc) for loc in self.loc])
+        blocks['loc'] = [(np.flatnonzero(loc_len == n), np.array([list(loc) for loc in self.loc[loc_len == n]], dtype=float).reshape(-1, n), None) for n in np.unique(loc_len[loc_len >= 0])]
+        blocks.update({attr: list(self.metrics[attr]) for attr in CHANNEL_COLUMNS if attr in self.metrics})
+
+        # Which block every row takes for every attribute (-1: none, empty column):
+        block_of_row = np.full((n_rows, len(CHANNEL_COLUMNS)), -1)
+        for attr_n, attr in enumerate(CHANNEL_COLUMNS):
+            for block_n, (rows, _, _) in enumerate(blocks.get(attr, [])):
+                block_of_row[rows, attr_n] = block_n
+
+        # Columns of the data frame: columns of the first row, then new columns of other rows (like pd.concat):
+        _, first_rows = np.unique(block_of_row, axis=0, return_index=True)
+        columns = {}
+        for row in np.sort(first_rows):
+            for attr_n, attr in enumerate(CHANNEL_COLUMNS):
+                block_n = block_of_row[row, attr_n]
+                if block_n < 0:
+                    columns.setdefault(CHANNEL_COLUMNS[attr], None)
+                else:
+                    _, values, labels = blocks[attr][block_n]
+                    for column in self._columns_of_block(attr, values, labels):
+                        columns.setdefault(column, None)
+
+        # Columns filled only by float blocks are float arrays (NaN for rows without the value), like after pd.concat.
+        # Other columns are object arrays (None for rows without the value), their type is inferred at the end:
+        block_columns = {attr: [self._columns_of_block(attr, values, labels) for _, values, labels in blocks.get(attr, [])] for attr in CHANNEL_COLUMNS}
+        object_columns = set()
+        for attr in CHANNEL_COLUMNS:
+            for (_, values, _), block_cols in zip(blocks.get(attr, []), block_columns[attr]):
+                if values.dtype.kind != 'f':
+                    object_columns.update(block_cols)
+
+        data = {}
+        for attr in CHANNEL_COLUMNS:
+            for (rows, values, _), block_cols in zip(blocks.get(attr, []), block_columns[attr]):
+                for column, column_values in zip(block_cols, values.T if values.ndim == 2 else [values]):
+                    if column not in data:
+                        data[column] = np.full(n_rows, None, dtype=object) if column in object_columns else np.full(n_rows, np.nan)
+                    data[column][rows] = column_values
+
+        data = {column: (pd.Series(data[column]).infer_objects().to_numpy() if column in object_columns else data[column]) if column in data else np.full(n_rows, None, dtype=object) for column in columns}
+
+        return drop_placeholder_columns(pd.DataFrame(data, index=np.zeros(n_rows, dtype=int)))
+
+
+def drop_placeholder_columns(df_fin: pd.DataFrame):
+
+    """
+    Remove empty placeholder columns of channel metrics (like 'STD epoch') if the data frame also has the numbered columns
+    with values of this metric (like 'STD epoch_0', 'STD epoch_1'...). Happens when the metric was calculated only for some of the channels.
+
+    Parameters
+    ----------
+    df_fin : pd.DataFrame
+        Data frame with channels info.
+
+    Returns
+    -------
+    df_fin : pd.DataFrame
+        Same data frame without placeholder columns.
+
+    """
+
+    # if df already contains columns like 'STD epoch_' with numbers, 'STD epoch' needs to be removed from the data frame:
+    if 'STD epoch' in df_fin and any(col.startswith('STD epoch_') and col[10:].isdigit() for col in df_fin.columns):
+        # If there are, drop the 'STD epoch' column
+        df_fin = df_fin.drop(columns='STD epoch')
+    if 'PtP epoch' in df_fin and any(col.startswith('PtP epoch_') and col[10:].isdigit() for col in df_fin.columns):
+        # If there are, drop the 'PtP epoch' column
+        df_fin = df_fin.drop(columns='PtP epoch')
+    if 'PSD' in df_fin and any(col.startswith('PSD_') and col[4:].isdigit() for col in df_fin.columns):
+        # If there are, drop the 'STD epoch' column
+        df_fin = df_fin.drop(columns='PSD')
+    if 'ECG' in df_fin and any(col.startswith('ECG_') and col[4:].isdigit() for col in df_fin.columns):
+        # If there are, drop the 'STD epoch' column
+        df_fin = df_fin.drop(columns='ECG')
+    if 'EOG' in df_fin and any(col.startswith('EOG_') and col[4:].isdigit() for col in df_fin.columns):
+        # If there are, drop the 'STD epoch' column
+        df_fin = df_fin.drop(columns='EOG')
+
+    return df_fin
 
 
 class QC_derivative:
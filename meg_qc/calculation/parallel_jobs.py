@@ -0,0 +1,74 @@
+import os
+import numpy as np
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+
+
+def bounded_n_jobs(n_jobs: int, n_outer_workers: int = 1):
+
+    """
+    Get the number of processes a metric can start for itself (n_jobs of PSD and PTP_manual).
+    Metrics already run inside data file jobs (--jobs) and metric threads (metrics_n_threads):
+    every one of them starts its own processes, so the CPU cores are divided between them.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of processes from the config. -1: all CPU cores.
+    n_outer_workers : int
+        Number of data file jobs x number of metric threads running at the same time.
+
+    Returns
+    -------
+    n_jobs : int
+        Number of processes to use, at least 1.
+
+    """
+
+    n_cpus = os.cpu_count() or 1
+
+    if n_jobs < 0:
+        n_jobs = n_cpus
+
+    return max(1, min(n_jobs, n_cpus // max(n_outer_workers, 1)))
+
+
+def run_on_channel_blocks(block_function: Callable, make_block_args: Callable, n_channels: int, n_jobs: int = 1):
+
+    """
+    Split channels into n_jobs blocks and run the function on every block, in parallel processes if n_jobs > 1.
+    Used for peak detection (scipy find_peaks), which holds the GIL, so blocks are processed in separate processes, not threads.
+
+    Parameters
+    ----------
+    block_function : Callable
+        Function to run on every block. Must be defined on module level (it is pickled to the processes).
+    make_block_args : Callable
+        Function which gets the array of channel indexes of the block and returns the tuple of arguments for block_function.
+    n_channels : int
+        Number of channels.
+    n_jobs : int
+        Number of processes to use. 1: no parallel processing, -1: all CPU cores.
+
+    Returns
+    -------
+    channel_blocks : List
+        Arrays of channel indexes of every block, in the order of channels.
+    block_results : List
+        Results of block_function for every block.
+
+    """
+
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+
+    channel_blocks = [block for block in np.array_split(np.arange(n_channels), max(n_jobs, 1)) if len(block) > 0]
+    block_args = [make_block_args(block) for block in channel_blocks]
+
+    if n_jobs > 1 and len(channel_blocks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            block_results = list(executor.map(block_function, *zip(*block_args)))
+    else:
+        block_results = [block_function(*args) for args in block_args]
+
+    return channel_blocks, block_results
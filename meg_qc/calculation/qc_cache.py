@@ -0,0 +1,220 @@
+import os
+import json
+import pickle
+import hashlib
+from typing import List
+
+from meg_qc import __version__
+
+
+def file_content_hash(file_path: str, block_size: int = 2**20):
+
+    """
+    Calculate sha256 hash of the content of the data file.
+    CTF data is a directory (.ds): in this case all the files inside are hashed together with their relative paths.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the data file (fif) or CTF directory (ds).
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    str
+        Hex digest of the content hash.
+
+    """
+
+    content_hash = hashlib.sha256()
+
+    if os.path.isdir(file_path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(file_path) for f in names)
+    else:
+        files = [file_path]
+
+    for f in files:
+        content_hash.update(os.path.relpath(f, file_path).encode())
+        with open(f, 'rb') as file_wrapper:
+            for block in iter(lambda: file_wrapper.read(block_size), b''):
+                content_hash.update(block)
+
+    return content_hash.hexdigest()
+
+
+def file_size_mtime(file_path: str):
+
+    """
+    Get total size and the latest modification time of the data file (or of all files in CTF directory).
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the data file (fif) or CTF directory (ds).
+
+    Returns
+    -------
+    size : int
+        Size in bytes.
+    mtime : int
+        Latest modification time in nanoseconds.
+
+    """
+
+    if os.path.isdir(file_path):
+        stats = [os.stat(os.path.join(root, f)) for root, _, names in os.walk(file_path) for f in names]
+    else:
+        stats = [os.stat(file_path)]
+
+    size = sum(st.st_size for st in stats)
+    mtime = max([st.st_mtime_ns for st in stats], default=0)
+
+    return size, mtime
+
+
+def get_file_hash(file_path: str, cache_dir: str):
+
+    """
+    Get the content hash of the data file.
+
+    Fast path: if size and modification time of the file did not change since the hash was calculated last time,
+    the saved hash is used. Otherwise the whole content is hashed again and saved for the next run.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the data file (fif) or CTF directory (ds).
+    cache_dir : str
+        Path to the cache directory.
+
+    Returns
+    -------
+    str
+        Hex digest of the content hash.
+
+    """
+
+    file_path = os.path.abspath(file_path)
+    size, mtime = file_size_mtime(file_path)
+
+    # one small json per data file, so that parallel processes never write the same file:
+    index_path = os.path.join(cache_dir, 'files', hashlib.sha1(file_path.encode()).hexdigest() + '.json')
+
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, 'r') as file_wrapper:
+                saved = json.load(file_wrapper)
+            if saved['path'] == file_path and saved['size'] == size and saved['mtime'] == mtime:
+                return saved['hash']
+        except (ValueError, KeyError):
+            pass #broken index file - just calculate the hash again
+
+    content_hash = file_content_hash(file_path)
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    atomic_write(index_path, json.dumps({'path': file_path, 'size': size, 'mtime': mtime, 'hash': content_hash}).encode())
+
+    return content_hash
+
+
+def make_cache_key(file_hash: str, settings: List[dict]):
+
+    """
+    Make the key of the cached result: hash of the data file content, all the settings the result depends on
+    and the version of MEG QC (so the results of older versions are not reused).
+
+    Parameters
+    ----------
+    file_hash : str
+        Content hash of the data file.
+    settings : List
+        List of dictionaries with settings (sections of config) the result depends on.
+
+    Returns
+    -------
+    str
+        Hex digest used as the cache key.
+
+    """
+
+    key = json.dumps({'file': file_hash, 'settings': settings, 'version': __version__}, sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def atomic_write(file_path: str, content: bytes):
+
+    """
+    Write the file through a temporary file, so a crashed or parallel run never leaves half written file behind.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the file to write.
+    content : bytes
+        Content to write.
+
+    """
+
+    tmp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as file_wrapper:
+        file_wrapper.write(content)
+    os.replace(tmp_path, file_path)
+
+
+def load_cached_result(cache_dir: str, key: str):
+
+    """
+    Load the cached result.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache directory.
+    key : str
+        Cache key (see make_cache_key).
+
+    Returns
+    -------
+    result
+        Cached result or None if there is no result for this key.
+
+    """
+
+    result_path = os.path.join(cache_dir, key[:2], key + '.pkl')
+
+    if not os.path.isfile(result_path):
+        return None
+
+    try:
+        with open(result_path, 'rb') as file_wrapper:
+            return pickle.load(file_wrapper)
+    except Exception as e:
+        print('___MEGqc___: ', 'Could not read cached result ', result_path, ': ', e, '. It will be calculated again.')
+        return None
+
+
+def save_cached_result(cache_dir: str, key: str, result):
+
+    """
+    Save the result into the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache directory.
+    key : str
+        Cache key (see make_cache_key).
+    result
+        Any picklable result (usually tuple returned by the metric function).
+
+    """
+
+    result_path = os.path.join(cache_dir, key[:2], key + '.pkl')
+    os.makedirs(os.path.dirname(result_path), exist_ok=True)
+
+    try:
+        atomic_write(result_path, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        print('___MEGqc___: ', 'Could not save result into cache: ', e)
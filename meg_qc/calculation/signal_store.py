@@ -0,0 +1,385 @@
+import threading
+import numpy as np
+import mne
+from scipy.signal import spectrogram
+from typing import List, Callable
+
+
+class SignalStore:
+
+    """
+    Shared storage of the data versions (cropped, filtered, resampled, epoched) of one data file.
+
+    Every version is derived from its parent only when a metric asks for it for the first time,
+    then it is shared by all the metrics (read only). Metrics register which versions they need
+    and release them when they are done: a version nobody needs any more is dropped from the store,
+    so the memory is given back while the other metrics are still running.
+
+    """
+
+    def __init__(self):
+
+        """
+        Constructor method. Creates an empty store.
+
+        """
+
+        self._builders = {} # name -> (function making the version from the parent version, parent name)
+        self._signals = {} # name -> already made version
+        self._users = {} # name -> set of metrics which still need this version
+        self._lock = threading.RLock()
+
+
+    def __repr__(self):
+
+        return 'SignalStore with versions: ' + ', '.join(name + (' (made)' if name in self._signals else '') for name in self._builders)
+
+
+    def __contains__(self, name: str):
+
+        return name in self._builders
+
+
+    def add_signal(self, name: str, signal):
+
+        """
+        Add a version which already exists (for example, data loaded from the file).
+
+        Parameters
+        ----------
+        name : str
+            Name of the version, like 'raw_cropped'.
+        signal : mne.io.Raw or dict
+            The data.
+
+        """
+
+        with self._lock:
+            self._builders[name] = (None, None)
+            self._signals[name] = signal
+            make_read_only(signal)
+
+
+    def add_lazy_signal(self, name: str, build: Callable, parent: str = None):
+
+        """
+        Add a version which will be made only when some metric asks for it.
+
+        Parameters
+        ----------
+        name : str
+            Name of the version, like 'raw_cropped_filtered'.
+        build : Callable
+            Function which gets the parent version and returns the new version.
+            It must not change the parent: make a copy if the data is changed.
+            It may return the parent itself if nothing needs to be changed (for example, no filtering).
+        parent : str
+            Name of the version this one is made from.
+
+        """
+
+        with self._lock:
+            self._builders[name] = (build, parent)
+
+
+    def register(self, user: str, names: List[str]):
+
+        """
+        Register a metric as a user of the data versions: they will be kept until the metric releases them.
+
+        Parameters
+        ----------
+        user : str
+            Name of the metric.
+        names : List
+            Names of the data versions the metric will use.
+
+        """
+
+        with self._lock:
+            for name in names:
+                self._users.setdefault(name, set()).add(user)
+
+
+    def release(self, user: str):
+
+        """
+        The metric does not need the data anymore. Versions which are not needed by anyone are dropped.
+
+        Parameters
+        ----------
+        user : str
+            Name of the metric.
+
+        """
+
+        with self._lock:
+            for users in self._users.values():
+                users.discard(user)
+            self._drop_unused()
+
+
+    def build_registered(self):
+
+        """
+        Make all the versions registered metrics need right now.
+        Used before running metrics in parallel: then no version is made from a parent which is used by another metric at the same time.
+
+        """
+
+        with self._lock:
+            for name, users in list(self._users.items()):
+                if users:
+                    self[name]
+            self._drop_unused()
+
+
+    def __getitem__(self, name: str):
+
+        """
+        Get the data version, make it first if it was not made yet.
+
+        Parameters
+        ----------
+        name : str
+            Name of the version.
+
+        Returns
+        -------
+        mne.io.Raw or dict
+            The data (read only).
+
+        """
+
+        with self._lock:
+            if name in self._signals:
+                return self._signals[name]
+
+            build, parent = self._builders[name]
+            signal = build(self[parent] if parent is not None else None)
+            self._signals[name] = signal
+            # parent may have been loaded into memory while making this version:
+            for made_signal in self._signals.values():
+                make_read_only(made_signal)
+            self._drop_unused()
+
+            return signal
+
+
+    def _needed(self, name: str):
+
+        """
+        Version is needed if some metric still uses it
+        or if a version which is not made yet, but still needed, has to be made from it.
+
+        """
+
+        if self._users.get(name):
+            return True
+
+        return any(parent == name and child not in self._signals and self._needed(child) for child, (_, parent) in self._builders.items())
+
+
+    def _drop_unused(self):
+
+        for name in [name for name in self._signals if not self._needed(name)]:
+            del self._signals[name]
+
+
+
+def make_read_only(signal):
+
+    """
+    Make the data arrays of loaded Raw or Epochs objects read only, so a metric can not change the data other metrics use.
+
+    Parameters
+    ----------
+    signal : mne.io.Raw, mne.Epochs or dict of them (like epochs for mag and grad)
+
+    """
+
+    if isinstance(signal, dict):
+        for value in signal.values():
+            make_read_only(value)
+    elif isinstance(signal, (mne.io.BaseRaw, mne.BaseEpochs)) and signal.preload:
+        signal._data.flags.writeable = False
+
+
+class SpectrumCache:
+
+    """
+    Per-file cache of power spectra, shared between the metrics (PSD and Muscle both need the spectrum of the same data).
+    Spectrum of a given data version with given parameters is estimated only once.
+
+    """
+
+    def __init__(self):
+
+        """
+        Constructor method. Creates an empty cache.
+
+        """
+
+        self._spectra = {} # key -> (psds, freqs, ch_names)
+        self._key_locks = {} # key -> lock, so the same spectrum is not calculated by 2 metrics at the same time
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+
+        return 'SpectrumCache with ' + str(len(self._spectra)) + ' spectra'
+
+
+    def compute_psd(self, raw: mne.io.Raw, data_variant: str, picks: List, method: str, fmin: float, fmax: float, n_fft: int, n_per_seg: int, n_jobs: int = 1, block_seconds: float = 0):
+
+        """
+        Get the power spectrum of the data: from cache or calculate it with raw.compute_psd.
+
+        Parameters
+        ----------
+        raw : mne.io.Raw
+            The data.
+        data_variant : str
+            Name of the data version, like 'raw_cropped_filtered' (see SignalStore). Part of the cache key.
+        picks : List
+            Channel names.
+        method : str
+            Method of spectrum estimation, like 'welch'.
+        fmin : float
+            Lowest frequency.
+        fmax : float
+            Highest frequency.
+        n_fft : int
+            Length of FFT.
+        n_per_seg : int
+            Length of each segment.
+        n_jobs : int
+            Number of jobs for compute_psd, if the spectrum has to be calculated. Does not change the result.
+        block_seconds : float
+            If above 0 and method is 'welch': spectrum is accumulated over blocks of data of this length (see compute_psd_welch_blocks),
+            so the whole recording is never read into memory at once. 0: whole data at once with raw.compute_psd.
+
+        Returns
+        -------
+        psds : np.ndarray
+            Power spectra, shape (n_channels, n_freqs), read only.
+        freqs : np.ndarray
+            Frequencies, read only.
+        ch_names : List
+            Names of the channels in the order of rows of psds. Bad channels (raw.info['bads']) are left out, like in MNE.
+
+        """
+
+        key = (data_variant, tuple(picks), fmin, fmax, n_fft, n_per_seg, method, block_seconds)
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key not in self._spectra:
+                if block_seconds and method == 'welch':
+                    psds, freqs, ch_names = compute_psd_welch_blocks(raw, list(picks), fmin=fmin, fmax=fmax, n_fft=n_fft, n_per_seg=n_per_seg, block_seconds=block_seconds)
+                else:
+                    spectrum = raw.compute_psd(method=method, fmin=fmin, fmax=fmax, picks=list(picks), n_fft=n_fft, n_per_seg=n_per_seg, n_jobs=n_jobs)
+                    psds, freqs = spectrum.get_data(return_freqs=True)
+                    # data of the spectrum has no bad channels, but (depending on MNE version) they can still be in its ch_names:
+                    ch_names = [ch for ch in spectrum.ch_names if ch not in spectrum.info['bads']]
+                if len(ch_names) != len(psds):
+                    raise ValueError('Got spectrum of ' + str(len(psds)) + ' channels for ' + str(len(ch_names)) + ' channel names.')
+                psds.flags.writeable = False
+                freqs.flags.writeable = False
+                self._spectra[key] = (psds, freqs, ch_names)
+            else:
+                print('___MEGqc___: ', 'Spectrum of ' + data_variant + ' taken from the spectrum cache.')
+
+            return self._spectra[key]
+
+
+
+def compute_psd_welch_blocks(raw: mne.io.Raw, picks: List, fmin: float, fmax: float, n_fft: int, n_per_seg: int = None, n_overlap: int = 0, block_seconds: float = 60, window: str = 'hamming'):
+
+    """
+    Welch power spectrum accumulated over blocks of data, same as raw.compute_psd(method='welch') with the same parameters
+    (equal up to the order of summation), but the data is read with raw.get_data(start, stop) one block at a time.
+    Memory use depends on the block length, not on the length of the recording,
+    so it works on Raw which is not loaded (data is read from the file) or is backed by a memory mapped file.
+
+    Every block holds whole Welch segments: it starts at the beginning of a segment and ends at the end of the last segment in it.
+    With overlapping segments the next block starts where its first segment starts, so the samples shared by 2 segments
+    are read in both blocks and every segment is exactly the same as without blocks.
+    Like in MNE, data inside of 'bad' annotations is set to NaN and segments touching it are not used in the average.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The data, loaded or not.
+    picks : List
+        Channel names. Bad channels are left out, like in MNE.
+    fmin : float
+        Lowest frequency.
+    fmax : float
+        Highest frequency.
+    n_fft : int
+        Length of FFT.
+    n_per_seg : int
+        Length of each segment. If None, same as n_fft.
+    n_overlap : int
+        Number of samples of overlap between segments.
+    block_seconds : float
+        Approximate length of the block of data read at once, in seconds. At least 1 segment is always read.
+    window : str
+        Window of the segments.
+
+    Returns
+    -------
+    psds : np.ndarray
+        Power spectra, shape (n_channels, n_freqs).
+    freqs : np.ndarray
+        Frequencies.
+    ch_names : List
+        Names of the channels in the order of rows of psds, without the bad channels.
+
+    """
+
+    sfreq = raw.info['sfreq']
+    n_times = raw.n_times
+    picks = [ch for ch in picks if ch not in raw.info['bads']] # MNE leaves out bad channels too
+
+    # same checks of the segment length as in MNE:
+    if n_per_seg is None and n_fft > n_times:
+        raise ValueError('If n_per_seg is None n_fft is not allowed to be > n_times. Got n_fft of %d while signal length is %d.' % (n_fft, n_times))
+    n_per_seg = n_fft if n_per_seg is None or n_per_seg > n_fft else n_per_seg
+    n_per_seg = min(n_per_seg, n_times)
+    if n_overlap >= n_per_seg:
+        raise ValueError('n_overlap cannot be greater than n_per_seg (or n_fft). Got n_overlap of %d while n_per_seg is %d.' % (n_overlap, n_per_seg))
+
+    freqs = np.arange(n_fft // 2 + 1, dtype=float) * (sfreq / n_fft)
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    if not freq_mask.any():
+        raise ValueError('No frequencies found between fmin=%s and fmax=%s' % (fmin, fmax))
+    freqs = freqs[freq_mask]
+
+    step = n_per_seg - n_overlap
+    n_segments = (n_times - n_overlap) // step
+    segments_per_block = max(1, (int(block_seconds*sfreq) - n_per_seg) // step + 1)
+
+    psd_sum = np.zeros((len(picks), len(freqs)))
+    n_good_segments = np.zeros((len(picks), len(freqs)))
+
+    for first_segment in range(0, n_segments, segments_per_block):
+        last_segment = min(first_segment + segments_per_block, n_segments) - 1
+        start = first_segment * step
+        stop = last_segment * step + n_per_seg
+
+        data = raw.get_data(picks=picks, start=start, stop=stop, reject_by_annotation='NaN', verbose=False)
+        _, _, spect = spectrogram(data, fs=sfreq, window=window, nperseg=n_per_seg, noverlap=n_overlap, nfft=n_fft, detrend='constant', mode='psd')
+        spect = spect[:, freq_mask, :]
+
+        good = ~np.isnan(spect)
+        psd_sum += np.where(good, spect, 0).sum(axis=-1)
+        n_good_segments += good.sum(axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        psds = psd_sum / n_good_segments # NaN if all segments were bad, same as in MNE
+
+    return psds, freqs, picks
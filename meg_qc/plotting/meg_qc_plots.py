@@ -1,7 +1,7 @@
 import sys
 import os
 import ancpbids
-import json
+import copy
 from prompt_toolkit.shortcuts import checkboxlist_dialog
 from prompt_toolkit.styles import Style
 from collections import defaultdict
@@ -19,6 +19,7 @@ sys.path.append(gradparent_dir)
 
 from meg_qc.plotting.universal_plots import *
 from meg_qc.plotting.universal_html_report import make_joined_report_mne
+from meg_qc.calculation.derivative_formats import find_container, container_member_paths, read_derivative_json
 
 # IMPORTANT: keep this order of imports, first need to add parent dir to sys.path, then import from it.
 
@@ -211,10 +212,63 @@ def get_ds_entities(dataset, calculated_derivs_folder: str):
         #we only get entities of calculated derivatives here, not entire raw ds.
     except:
         raise FileNotFoundError(f'___MEGqc___: No calculated derivatives found for this ds!')
+
+    # Derivatives written into containers are not seen by ancpbids, add their names as descriptions:
+    simple_metrics_paths = dataset.query(suffix='meg', extension='json', desc='SimpleMetrics', return_type='filename', scope=calculated_derivs_folder)
+    for simple_metrics_path in simple_metrics_paths:
+        container_path = find_container(simple_metrics_path)
+        if container_path is not None:
+            entities.setdefault('description', set()).update(container_member_paths(container_path))
     
     return entities
 
 
+def query_container_derivs(dataset, entities: dict, found_paths: List):
+
+    """
+    Find derivatives written into containers (derivative_container setting) for the given query entities.
+    Containers are found next to the SimpleMetrics json of the same data file, which is always written as a separate file.
+
+    Parameters
+    ----------
+    dataset : ancpbids object
+        The dataset object.
+    entities : dict
+        Query entities as used for derivatives written as separate files, with the list of desc to find.
+    found_paths : List
+        Paths of the derivatives already found as separate files. Same derivatives inside containers are skipped.
+
+    Returns
+    -------
+    container_paths : List
+        Paths of the found derivatives inside containers.
+    container_objs : List
+        Entity objects of the SimpleMetrics json of the same data file for every found derivative,
+        used to recreate the entities of the raw file.
+
+    """
+
+    found_names = set(os.path.basename(path) for path in found_paths)
+
+    simple_metrics_entities = dict(entities, desc='SimpleMetrics', extension='json', return_type='object')
+    simple_metrics_objs = sorted(list(dataset.query(**simple_metrics_entities)), key=lambda k: k['name'])
+
+    container_paths = []
+    container_objs = []
+    for simple_metrics_obj in simple_metrics_objs:
+        container_path = find_container(simple_metrics_obj.get_absolute_path())
+        if container_path is None:
+            continue
+
+        member_paths = container_member_paths(container_path)
+        for desc in entities['desc']:
+            if desc in member_paths and os.path.basename(member_paths[desc]) not in found_names:
+                container_paths.append(member_paths[desc])
+                container_objs.append(simple_metrics_obj)
+
+    return container_paths, container_objs
+
+
 def csv_to_html_report(raw_info_path: str, metric: str, tsv_paths: List, report_str_path: str, plot_settings):
 
     """
@@ -382,8 +436,7 @@ def csv_to_html_report(raw_info_path: str, metric: str, tsv_paths: List, report_
         'STIMULUS': ''
         }
     else:
-        with open(report_str_path) as json_file:
-            report_strings = json.load(json_file)
+        report_strings = read_derivative_json(report_str_path)
 
 
     report_html_string = make_joined_report_mne(raw_info_path, QC_derivs, report_strings)
@@ -658,6 +711,11 @@ def make_plots_meg_qc(dataset_path: str):
         entities_obj = sorted(list(dataset.query(**entities)), key=lambda k: k['name'])
         tsv_entities_by_metric[metric] = entities_obj
 
+        # Add derivatives written into containers:
+        container_paths, container_objs = query_container_derivs(dataset, entities, tsv_paths)
+        tsvs_to_plot_by_metric[metric] += container_paths
+        tsv_entities_by_metric[metric] += container_objs
+
 
     # Collect all derivs into a list of Deriv_to_plot objects, combining tsv path and its entities:
     derivs_to_plot = []
@@ -671,8 +729,9 @@ def make_plots_meg_qc(dataset_path: str):
         
         for tsv_paths, deriv_entities in zip(tsv_paths, entity_vals):
         #check that every metric_value is same as file_value:
-            file_name_in_path = os.path.basename(tsv_paths).split('_meg.')[0]
-            file_name_in_obj = deriv_entities['name'].split('_meg.')[0]
+            # (derivatives inside containers come with the entities of SimpleMetrics of the same raw, so compare without desc)
+            file_name_in_path = re.sub(r'_desc-[^_]+', '', os.path.basename(tsv_paths).split('_meg.')[0])
+            file_name_in_obj = re.sub(r'_desc-[^_]+', '', deriv_entities['name'].split('_meg.')[0])
 
             if file_name_in_obj not in file_name_in_path:
                 raise ValueError('Different names in tsvs_to_plot_by_metric and entities_per_file')
@@ -742,6 +801,9 @@ def make_plots_meg_qc(dataset_path: str):
                 meg_artifact = subject_folder.create_artifact(raw=raw_entities_to_write) 
                 #meg_artifact = subject_folder.create_artifact() 
                 # create artifact, take entities from entities of the previously calculated tsv derivative
+                meg_artifact.entities[:] = [copy.copy(entity) for entity in meg_artifact.entities]
+                # ancpbids shares entity objects with the raw given, copy them so that adding desc here does not change it there
+                # (derivatives inside containers all share the entities of the same SimpleMetrics file)
 
                 meg_artifact.add_entity('desc', metric) #add metric to entities
                 meg_artifact.suffix = 'meg'
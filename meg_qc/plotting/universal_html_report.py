@@ -12,6 +12,7 @@ sys.path.append(parent_dir)
 sys.path.append(gradparent_dir)
 
 from meg_qc.plotting.universal_plots import get_tit_and_unit 
+from meg_qc.calculation.derivative_formats import read_derivative_info
 
 # Keep imports in this order! 
 
@@ -301,7 +302,7 @@ def make_joined_report_mne(raw_info_path: str, sections:dict, report_strings: di
     report = mne.Report(title=' MEG QC Report')
     # This method also accepts a path, e.g., raw=raw_path
     if raw_info_path: #if info present
-        info_loaded = mne.io.read_info(raw_info_path)
+        info_loaded = read_derivative_info(raw_info_path)
         info_html = info_loaded._repr_html_()
         # Wrap the HTML content in a centered div
         centered_info_html = f"""
@@ -6,10 +6,13 @@ import mne
 import random
 import copy
 import os
+import re
 from typing import List
 import matplotlib.pyplot as plt
 from mne.preprocessing import compute_average_dev_head_t
-from meg_qc.calculation.objects import QC_derivative, MEG_channel
+from meg_qc.calculation.objects import QC_derivative, MEG_channel, ChannelTable
+from meg_qc.calculation.derivative_formats import read_derivative_df, read_derivative_json, derivative_exists
+from meg_qc.calculation.initial_meg_qc import stim_data_to_events
 import matplotlib #this is in case we will need to suppress mne matplotlib plots
 
 
@@ -64,6 +67,67 @@ def get_tit_and_unit(m_or_g: str, psd: bool = False):
     return m_or_g_tit, unit
 
 
+def read_stim_csv(f_path: str):
+
+    """
+    Read the stimulus derivative: runs of the same value of every stimulus channel with onset and duration 
+    (see stim_data_to_events() in initial_meg_qc.py). 
+    Older derivatives had the channels sample by sample with a 'time' column: they are turned into runs as well.
+
+    Parameters
+    ----------
+    f_path : str
+        Path to the tsv file with stimulus data.
+
+    Returns
+    -------
+    stim_runs : dict
+        Channel name -> data frame with onset, duration and value of every run of this channel, in the order of time.
+
+    """
+
+    df = read_derivative_df(f_path)
+
+    if 'time' in df:
+        # older layout: channels sample by sample and time (and the index column written with the tsv)
+        ch_names = [column for column in df.columns if column != 'time' and not column.startswith('Unnamed')]
+        time = df['time'].to_numpy()
+        sfreq = 1 / (time[1] - time[0]) if len(time) > 1 else 1
+        df = stim_data_to_events(df[ch_names].to_numpy().T, ch_names, sfreq)
+        df['onset'] += time[0] if len(time) > 0 else 0
+
+    return {ch_name: ch_runs.reset_index(drop=True) for ch_name, ch_runs in df.groupby('channel', sort=False)}
+
+
+def stim_step_trace(ch_runs: pd.DataFrame):
+
+    """
+    Points of the step function of one stimulus channel, to be plotted with line_shape='hv': 
+    start of every run and end of the last run.
+
+    Parameters
+    ----------
+    ch_runs : pd.DataFrame
+        Runs of the channel with onset, duration and value.
+
+    Returns
+    -------
+    time : np.ndarray
+        Time of the points.
+    values : np.ndarray
+        Values of the channel at these points.
+
+    """
+
+    onset = ch_runs['onset'].to_numpy()
+    values = ch_runs['value'].to_numpy()
+
+    time = np.append(onset, onset[-1] + ch_runs['duration'].to_numpy()[-1])
+    values = np.append(values, values[-1])
+
+    return time, values
+
+
 def plot_stim_csv_simple(f_path: str) -> List[QC_derivative]:
     """
     Plot stimulus channels.
@@ -71,7 +135,7 @@ def plot_stim_csv_simple(f_path: str) -> List[QC_derivative]:
     Parameters
     ----------
     f_path : str
-        Path to the tsv file with PSD data.
+        Path to the tsv file with stimulus data.
 
     Returns
     -------
@@ -79,33 +143,26 @@ def plot_stim_csv_simple(f_path: str) -> List[QC_derivative]:
         List of QC_derivative objects with plotly figures as content
     """
 
-    df = pd.read_csv(f_path, sep='\t')
-
-    # Check if the first column is just indexes and remove it if necessary
-    if df.columns[0] == df.index.name or df.iloc[:, 0].equals(pd.Series(df.index)):
-        df = df.drop(df.columns[0], axis=1)
-
-    # Extract the 'time' column for the x-axis
-    time = df['time']
+    stim_runs = read_stim_csv(f_path)
 
     qc_derivatives = []
 
-    # Loop over each column (excluding 'time') and create a separate figure for each
-    for i, col in enumerate(df.columns):
-        if col != 'time':
-            fig = go.Figure()
-            fig.add_trace(go.Scatter(x=time, y=df[col], mode='lines', name=col))
-            fig.update_layout(
-                title=col,
-                title_x=0.5,  # Center the title
-                xaxis_title='Time (s)',
-                yaxis_title=col,
-                showlegend=False
-            )
+    # Loop over each channel and create a separate figure for each
+    for col, ch_runs in stim_runs.items():
+        time, y_data = stim_step_trace(ch_runs)
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=time, y=y_data, mode='lines', name=col, line_shape='hv'))
+        fig.update_layout(
+            title=col,
+            title_x=0.5,  # Center the title
+            xaxis_title='Time (s)',
+            yaxis_title=col,
+            showlegend=False
+        )
 
-            # Apply description only to the last figure
-            qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
-            qc_derivatives.append(qc_derivative)
+        # Apply description only to the last figure
+        qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
+        qc_derivatives.append(qc_derivative)
 
     return qc_derivatives
 
@@ -117,7 +174,7 @@ def plot_stim_csv_colored_leveled(f_path: str) -> List[QC_derivative]:
     Parameters
     ----------
     f_path : str
-        Path to the tsv file with PSD data.
+        Path to the tsv file with stimulus data.
 
     Returns
     -------
@@ -125,69 +182,62 @@ def plot_stim_csv_colored_leveled(f_path: str) -> List[QC_derivative]:
         List of QC_derivative objects with plotly figures as content
     """
 
-    df = pd.read_csv(f_path, sep='\t')
-
-    # Check if the first column is just indexes and remove it if necessary
-    if df.columns[0] == df.index.name or df.iloc[:, 0].equals(pd.Series(df.index)):
-        df = df.drop(df.columns[0], axis=1)
-
-    # Extract the 'time' column for the x-axis
-    time = df['time']
+    stim_runs = read_stim_csv(f_path)
 
     qc_derivatives = []
 
-    # Loop over each column (excluding 'time') and create a separate figure for each
-    for i, col in enumerate(df.columns):
-        if col != 'time':
-            y_data = df[col]
+    # Loop over each channel and create a separate figure for each
+    for col, ch_runs in stim_runs.items():
+        time, y_data = stim_step_trace(ch_runs)
+        run_values = ch_runs['value']
 
-            # Check if there are repeating values and exclude 0 values
-            unique_values = y_data[y_data > 0].unique()
-            if 1 < len(unique_values) <= 30:
-                fig = go.Figure()
+        # Check if there are repeating values and exclude 0 values
+        unique_values = run_values[run_values > 0].unique()
+        if 1 < len(unique_values) <= 30:
+            fig = go.Figure()
 
-                # Plot the entire line first
+            # Plot the entire line first
+            fig.add_trace(go.Scatter(
+                x=time, y=y_data, mode='lines', name=col, line_shape='hv',
+                line=dict(color='grey'),  # Default color for the entire line
+                hoverinfo='text',
+                text=[f'Value-{y}, time-{t}s' for y, t in zip(y_data, time)]
+            ))
+
+            # Group repeated values and assign colors, marker at the start of every run of the value
+            group_ids = {value: idx for idx, value in enumerate(unique_values)}
+            for value, group_id in group_ids.items():
+                indices = np.append(run_values.to_numpy() == value, False) #last point is the end of the last run
                 fig.add_trace(go.Scatter(
-                    x=time, y=y_data, mode='lines', name=col,
-                    line=dict(color='grey'),  # Default color for the entire line
+                    x=time[indices], y=y_data[indices], mode='markers', name=f'ID-{int(value)}',
+                    marker=dict(color=f'rgba({group_id * 50 % 255}, {group_id * 100 % 255}, {group_id * 150 % 255}, 1)'),
                     hoverinfo='text',
-                    text=[f'Value-{y}, time-{t}s' for y, t in zip(y_data, time)]
+                    text=[f'ID-{int(value)}, time-{t}s' for t in time[indices]]
                 ))
 
-                # Group repeated values and assign colors
-                group_ids = {value: idx for idx, value in enumerate(unique_values)}
-                for value, group_id in group_ids.items():
-                    indices = y_data == value
-                    fig.add_trace(go.Scatter(
-                        x=time[indices], y=y_data[indices], mode='markers', name=f'ID-{int(value)}',
-                        marker=dict(color=f'rgba({group_id * 50 % 255}, {group_id * 100 % 255}, {group_id * 150 % 255}, 1)'),
-                        hoverinfo='text',
-                        text=[f'ID-{int(value)}, time-{t}s' for t in time[indices]]
-                    ))
-
-                fig.update_layout(
-                    title=col,
-                    title_x=0.5,  # Center the title
-                    xaxis_title='Time (s)',
-                    yaxis_title='Stimulus ID',
-                    showlegend=True,
-                    legend=dict(title='Groups', x=1, y=1)
-                )
-            else:
-                # Create the figure as originally
-                fig = go.Figure()
-                fig.add_trace(go.Scatter(x=time, y=y_data, mode='lines', name=col))
-                fig.update_layout(
-                    title=col,
-                    title_x=0.5,  # Center the title
-                    xaxis_title='Time (s)',
-                    yaxis_title='Stimulus ID',
-                    showlegend=False
-                )
-
-            # Apply description only to the last figure
-            qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
-            qc_derivatives.append(qc_derivative)
+            fig.update_layout(
+                title=col,
+                title_x=0.5,  # Center the title
+                xaxis_title='Time (s)',
+                yaxis_title='Stimulus ID',
+                showlegend=True,
+                legend=dict(title='Groups', x=1, y=1)
+            )
+        else:
+            # Create the figure as originally
+            fig = go.Figure()
+            fig.add_trace(go.Scatter(x=time, y=y_data, mode='lines', name=col, line_shape='hv'))
+            fig.update_layout(
+                title=col,
+                title_x=0.5,  # Center the title
+                xaxis_title='Time (s)',
+                yaxis_title='Stimulus ID',
+                showlegend=False
+            )
+
+        # Apply description only to the last figure
+        qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
+        qc_derivatives.append(qc_derivative)
 
     return qc_derivatives
 
@@ -199,7 +249,7 @@ def plot_stim_csv(f_path: str) -> List[QC_derivative]:
     Parameters
     ----------
     f_path : str
-        Path to the tsv file with PSD data.
+        Path to the tsv file with stimulus data.
 
     Returns
     -------
@@ -207,14 +257,7 @@ def plot_stim_csv(f_path: str) -> List[QC_derivative]:
         List of QC_derivative objects with plotly figures as content
     """
 
-    df = pd.read_csv(f_path, sep='\t')
-
-    # Check if the first column is just indexes and remove it if necessary
-    if df.columns[0] == df.index.name or df.iloc[:, 0].equals(pd.Series(df.index)):
-        df = df.drop(df.columns[0], axis=1)
-
-    # Extract the 'time' column for the x-axis
-    time = df['time']
+    stim_runs = read_stim_csv(f_path)
 
     qc_derivatives = []
 
@@ -232,59 +275,59 @@ def plot_stim_csv(f_path: str) -> List[QC_derivative]:
         'rgba(0, 191, 255, 1)', 'rgba(255, 69, 0, 1)', 'rgba(50, 205, 50, 1)'
     ]
 
-    # Loop over each column (excluding 'time') and create a separate figure for each
-    for i, col in enumerate(df.columns):
-        if col != 'time':
-            y_data = df[col]
+    # Loop over each channel and create a separate figure for each
+    for col, ch_runs in stim_runs.items():
+        time, y_data = stim_step_trace(ch_runs)
+        run_values = ch_runs['value']
 
-            # Check if there are repeating values and exclude 0 values
-            unique_values = y_data[y_data > 0].unique()
-            if 1 < len(unique_values) <= 30:
-                fig = go.Figure()
-
-                # Transform y values to 0 (no stimulus) and 1 (all other stimulus IDs)
-                transformed_y = y_data.apply(lambda y: 0 if y == 0 else 1)
+        # Check if there are repeating values and exclude 0 values
+        unique_values = run_values[run_values > 0].unique()
+        if 1 < len(unique_values) <= 30:
+            fig = go.Figure()
 
-                # Plot the entire line first
+            # Transform y values to 0 (no stimulus) and 1 (all other stimulus IDs)
+            transformed_y = np.where(y_data == 0, 0, 1)
+
+            # Plot the entire line first
+            fig.add_trace(go.Scatter(
+                x=time, y=transformed_y, mode='lines', name=col, line_shape='hv',
+                line=dict(color='grey'),  # Default color for the entire line
+                hoverinfo='text',
+                text=[f'Value-{y}, time-{t}s' for y, t in zip(y_data, time)]
+            ))
+
+            # Group repeated values and assign colors, marker at the start of every run of the value
+            group_ids = {value: idx for idx, value in enumerate(unique_values)}
+            for value, group_id in group_ids.items():
+                indices = np.append(run_values.to_numpy() == value, False) #last point is the end of the last run
                 fig.add_trace(go.Scatter(
-                    x=time, y=transformed_y, mode='lines', name=col,
-                    line=dict(color='grey'),  # Default color for the entire line
+                    x=time[indices], y=transformed_y[indices], mode='markers', name=f'ID-{int(value)}',
+                    marker=dict(color=colors[group_id % len(colors)]),
                     hoverinfo='text',
-                    text=[f'Value-{y}, time-{t}s' for y, t in zip(y_data, time)]
+                    text=[f'ID-{int(value)}, time-{t}s' for t in time[indices]]
                 ))
 
-                # Group repeated values and assign colors
-                group_ids = {value: idx for idx, value in enumerate(unique_values)}
-                for value, group_id in group_ids.items():
-                    indices = y_data == value
-                    fig.add_trace(go.Scatter(
-                        x=time[indices], y=transformed_y[indices], mode='markers', name=f'ID-{int(value)}',
-                        marker=dict(color=colors[group_id % len(colors)]),
-                        hoverinfo='text',
-                        text=[f'ID-{int(value)}, time-{t}s' for t in time[indices]]
-                    ))
-
-                fig.update_layout(
-                    title=col,
-                    title_x=0.5,  # Center the title
-                    xaxis_title='Time (s)',
-                    showlegend=True,
-                    legend=dict(title='Stim IDs', x=1, y=1)
-                )
-            else:
-                # Create the figure as originally
-                fig = go.Figure()
-                fig.add_trace(go.Scatter(x=time, y=y_data, mode='lines', name=col))
-                fig.update_layout(
-                    title=col,
-                    title_x=0.5,  # Center the title
-                    xaxis_title='Time (s)',
-                    showlegend=False
-                )
-
-            # Apply description only to the last figure
-            qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
-            qc_derivatives.append(qc_derivative)
+            fig.update_layout(
+                title=col,
+                title_x=0.5,  # Center the title
+                xaxis_title='Time (s)',
+                showlegend=True,
+                legend=dict(title='Stim IDs', x=1, y=1)
+            )
+        else:
+            # Create the figure as originally
+            fig = go.Figure()
+            fig.add_trace(go.Scatter(x=time, y=y_data, mode='lines', name=col, line_shape='hv'))
+            fig.update_layout(
+                title=col,
+                title_x=0.5,  # Center the title
+                xaxis_title='Time (s)',
+                showlegend=False
+            )
+
+        # Apply description only to the last figure
+        qc_derivative = QC_derivative(content=fig, name=f'Stimulus - {col}', content_type='plotly')
+        qc_derivatives.append(qc_derivative)
 
     return qc_derivatives
 
@@ -312,7 +355,7 @@ def plot_ch_df_as_lines_by_lobe_csv(f_path: str, metric: str, x_values, m_or_g,
 
     """
     if f_path is not None:
-        df = pd.read_csv(f_path, sep='\t') #TODO: maybe remove reading csv and pass directly the df here?
+        df = read_derivative_df(f_path) #TODO: maybe remove reading csv and pass directly the df here?
     else:
         df = df
 
@@ -608,7 +651,7 @@ def plot_sensors_3d_csv(sensors_csv_path: str):
         return []
     #we will get tsv representing ECG/EOG channel itself landed here. We dont need to plot it with this func.
 
-    df = pd.read_csv(sensors_csv_path, sep='\t')
+    df = read_derivative_df(sensors_csv_path)
 
     #double check: if there are no lobes in df - skip this plot, it s not the right df:
     if 'Lobe' not in df.columns or 'System' not in df.columns:
@@ -805,7 +848,7 @@ def boxplot_epoched_xaxis_channels_csv(std_csv_path: str, ch_type: str, what_dat
         derivative containing plotly figure
     
     """
-    df = pd.read_csv(std_csv_path, sep='\t')
+    df = read_derivative_df(std_csv_path)
 
     ch_tit, unit = get_tit_and_unit(ch_type)
 
@@ -924,7 +967,7 @@ def plot_topomap_std_ptp_csv(std_csv_path: str, ch_type: str, what_data: str):
 
     #First, convert scv back into dict with MEG_channel objects:
 
-    df = pd.read_csv(std_csv_path, sep='\t')  
+    df = read_derivative_df(std_csv_path)  
 
     ch_tit, unit = get_tit_and_unit(ch_type)
 
@@ -1016,7 +1059,7 @@ def plot_3d_topomap_std_ptp_csv(sensors_csv_path: str, ch_type: str, what_data:
 
     """
     
-    df = pd.read_csv(sensors_csv_path, sep='\t')
+    df = read_derivative_df(sensors_csv_path)
 
     #take only those channels that are of right type:
     df = df[df['Type'] == ch_type]
@@ -1241,7 +1284,7 @@ def Plot_psd_csv(m_or_g:str, f_path: str, method: str):
     """
 
     # First, get the epochs from csv and convert back into object.
-    df = pd.read_csv(f_path, sep='\t') 
+    df = read_derivative_df(f_path) 
 
     if 'Name' not in df.columns:
         return []
@@ -1366,7 +1409,7 @@ def plot_pie_chart_freq_csv(tsv_pie_path: str, m_or_g: str, noise_or_waves: str)
         return []
     
     # Read the data from the TSV file into a DataFrame
-    df = pd.read_csv(tsv_pie_path, sep='\t')
+    df = read_derivative_df(tsv_pie_path)
 
     if noise_or_waves == 'noise' and 'PSDnoise' in base_name:
         #check that we input tsv file with the right data
@@ -1449,7 +1492,7 @@ def plot_pie_chart_freq_csv(tsv_pie_path: str, m_or_g: str, noise_or_waves: str)
     return qc_derivative
 
 
-def assign_epoched_std_ptp_to_channels(what_data, chs_by_lobe, df_std_ptp):
+def assign_epoched_std_ptp_to_channels(what_data: str, channel_table: ChannelTable, df_std_ptp: pd.DataFrame):
 
     """
     Assign std or ptp values of each epoch as list to each channel. 
@@ -1459,31 +1502,27 @@ def assign_epoched_std_ptp_to_channels(what_data, chs_by_lobe, df_std_ptp):
     ----------
     what_data : str
         'peaks' for peak-to-peak amplitudes or 'stds'
-    chs_by_lobe : dict
-        dictionary with channel objects sorted by lobe.
+    channel_table : ChannelTable
+        table with all channels.
     df_std_ptp : pd.DataFrame
         Data Frame containing std or ptp value for each chnnel and each epoch
     
         
     Returns
     -------
-    chs_by_lobe : dict
-        updated dictionary with channel objects sorted by lobe - with info about std or ptp of epochs.
+    channel_table : ChannelTable
+        new channel table with info about std or ptp of epochs (as 1 block: channels of the data frame x epochs).
     """
 
     if what_data=='peaks':
-        #Add the data about std of each epoch (as a list, 1 std for 1 epoch) into each channel object inside the chs_by_lobe dictionary:
-        for lobe in chs_by_lobe:
-            for ch in chs_by_lobe[lobe]:
-                ch.ptp_epoch = df_std_ptp.loc[ch.name].values
+        #Add the data about ptp of each epoch (1 ptp for 1 epoch) of each channel of the data frame:
+        channel_table = channel_table.with_metric('ptp_epoch', df_std_ptp.index, df_std_ptp.to_numpy())
     elif what_data=='stds':
-        for lobe in chs_by_lobe:
-            for ch in chs_by_lobe[lobe]:
-                ch.std_epoch = df_std_ptp.loc[ch.name].values
+        channel_table = channel_table.with_metric('std_epoch', df_std_ptp.index, df_std_ptp.to_numpy())
     else:
         print('what_data should be either peaks or stds')
 
-    return chs_by_lobe
+    return channel_table
 
 
 def boxplot_epoched_xaxis_epochs_csv(std_csv_path: str, ch_type: str, what_data: str):
@@ -1522,7 +1561,7 @@ def boxplot_epoched_xaxis_epochs_csv(std_csv_path: str, ch_type: str, what_data:
     """
 
     # First, get the epochs from csv and convert back into object.
-    df = pd.read_csv(std_csv_path, sep='\t')  
+    df = read_derivative_df(std_csv_path)  
 
     # Figure column names:
     # Create a list of columns that start with 'STD epoch_'
@@ -1641,7 +1680,7 @@ def boxplot_all_time_csv(std_csv_path: str, ch_type: str, what_data: str):
 
     #First, convert scv back into dict with MEG_channel objects:
 
-    df = pd.read_csv(std_csv_path, sep='\t')  
+    df = read_derivative_df(std_csv_path)  
 
     ch_tit, unit = get_tit_and_unit(ch_type)
 
@@ -1739,7 +1778,7 @@ def plot_muscle_csv(f_path: str):
 
     """
 
-    df = pd.read_csv(f_path, sep='\t')  
+    df = read_derivative_df(f_path)  
 
     if df['scores_muscle'].empty or df['scores_muscle'].isna().all():
         return []
@@ -1814,7 +1853,7 @@ def plot_head_pos_csv(f_path: str):
         Head positions and rotations starting from 0 instead of the mne detected starting point. Can be used for plotting.
     """
 
-    head_pos = pd.read_csv(f_path, sep='\t') 
+    head_pos = read_derivative_df(f_path) 
 
     #drop first column. cos index is being created as an extra column when transforming from csv back to df:
     head_pos.drop(columns=head_pos.columns[0], axis=1, inplace=True)
@@ -1923,6 +1962,91 @@ def make_head_annots_plot(raw: mne.io.Raw, head_pos: np.ndarray):
 
 #__________ECG/EOG__________#
 
+def derivative_sibling_path(f_path: str, desc: str, extension: str):
+
+    """
+    Path of another derivative of the same data file: same folder and entities, different desc and extension.
+
+    Parameters
+    ----------
+    f_path : str
+        Path to a derivative file, like .../sub-001_task-rest_desc-ECGchannel_meg.tsv
+    desc : str
+        desc of the other derivative, like 'ECGevents'
+    extension : str
+        Extension of the other derivative, like '.tsv'
+
+    Returns
+    -------
+    str
+        Path to the other derivative, like .../sub-001_task-rest_desc-ECGevents_meg.tsv
+
+    """
+
+    folder, base_name = os.path.split(f_path)
+    base_name = re.sub(r'desc-[^_]+_', 'desc-' + desc + '_', base_name, count=1)
+
+    return os.path.join(folder, os.path.splitext(base_name)[0] + extension)
+
+
+def read_ECG_EOG_channel_csv(f_path: str):
+
+    """
+    Read the derivatives of the ECG or EOG channel. 
+    The channel tsv only has the signal, events, mean wave and info (json) are read from the derivatives next to it 
+    (see make_artif_channel_derivs() in ECG_EOG_meg_qc.py).
+    Older derivatives kept everything in the channel tsv, padded to the length of the recording: they are read as well.
+
+    Parameters
+    ----------
+    f_path : str
+        Path to the tsv file of the ECG or EOG channel (desc-ECGchannel or desc-EOGchannel).
+
+    Returns
+    -------
+    ch_derivs : dict
+        ch_name, ch_data (signal), event_indexes (array of int), fs (sampling frequency), recorded_or_reconstructed (method),
+        mean_wave (data frame with mean_rwave_time, mean_rwave and for ECG mean_rwave_shifted columns, or None if mean wave was not calculated).
+
+    """
+
+    ecg_or_eog = 'ECG' if 'desc-ecgchannel' in os.path.basename(f_path).lower() else 'EOG'
+    info_path = derivative_sibling_path(f_path, ecg_or_eog + 'info', '.json')
+
+    if derivative_exists(info_path):
+        ch_info = read_derivative_json(info_path)
+
+        df = read_derivative_df(f_path)
+        events_df = read_derivative_df(derivative_sibling_path(f_path, ecg_or_eog + 'events', '.tsv'))
+
+        mean_wave_path = derivative_sibling_path(f_path, ecg_or_eog + 'meanwave', '.tsv')
+        mean_wave = read_derivative_df(mean_wave_path) if derivative_exists(mean_wave_path) else None
+
+        return {
+            'ch_name': ch_info['ch_name'],
+            'ch_data': df[ch_info['ch_name']].to_numpy(),
+            'event_indexes': events_df['event_indexes'].to_numpy(dtype=int),
+            'fs': ch_info['fs'],
+            'recorded_or_reconstructed': ch_info['recorded_or_reconstructed'],
+            'mean_wave': mean_wave}
+
+    # older layout: all in one tsv, column 0 is the index, column 1 is the channel
+    df = read_derivative_df(f_path, dtype={6: str})
+    ch_name = df.columns[1]
+
+    mean_wave = None
+    if not (df['mean_rwave'].empty or df['mean_rwave'].isna().all()):
+        mean_wave = df[[column for column in ['mean_rwave_time', 'mean_rwave', 'mean_rwave_shifted'] if column in df]].dropna(subset=['mean_rwave'])
+
+    return {
+        'ch_name': ch_name,
+        'ch_data': df[ch_name].values,
+        'event_indexes': df['event_indexes'].dropna().to_numpy(dtype=int),
+        'fs': df['fs'].dropna().iloc[0],
+        'recorded_or_reconstructed': df['recorded_or_reconstructed'][0],
+        'mean_wave': mean_wave}
+
+
 def plot_ECG_EOG_channel_csv(f_path):
 
     """
@@ -1946,18 +2070,16 @@ def plot_ECG_EOG_channel_csv(f_path):
     if 'ecgchannel' not in base_name.lower() and 'eogchannel' not in base_name.lower():
         return []
 
-    df = pd.read_csv(f_path, sep='\t', dtype={6: str}) 
+    ch_derivs = read_ECG_EOG_channel_csv(f_path)
 
-    #name of the first column if it starts with 'ECG' or 'EOG':
-    ch_name = df.columns[1]
-    ch_data = df[ch_name].values
+    ch_name = ch_derivs['ch_name']
+    ch_data = ch_derivs['ch_data']
 
     if not ch_data.any():  # Check if all values are falsy (0, False, or empty)
         return []
     
-    peaks = df['event_indexes'].dropna()
-    peaks = [int(x) for x in peaks]
-    fs = int(df['fs'].dropna().iloc[0])
+    peaks = ch_derivs['event_indexes']
+    fs = int(ch_derivs['fs'])
 
     time = np.arange(len(ch_data))/fs
     fig = go.Figure()
@@ -2204,26 +2326,26 @@ def plot_mean_rwave_csv(f_path: str, ecg_or_eog: str):
     if ecg_or_eog.lower() + 'channel' not in base_name.lower():
         return []
 
-    # Load the data from the .tsv file into a DataFrame
-    df = pd.read_csv(f_path, sep='\t', dtype={6: str})
+    # Load the mean wave of the channel
+    ch_derivs = read_ECG_EOG_channel_csv(f_path)
+    df = ch_derivs['mean_wave']
 
-    if df['mean_rwave'].empty or df['mean_rwave'].isna().all():
+    if df is None or df['mean_rwave'].empty or df['mean_rwave'].isna().all():
         return []
 
     # Set the plot's title and labels
-    if 'recorded' in df['recorded_or_reconstructed'][0].lower():
+    if 'recorded' in ch_derivs['recorded_or_reconstructed'].lower():
         which = ' recorded'
-    elif 'reconstructed' in df['recorded_or_reconstructed'][0].lower():
+    elif 'reconstructed' in ch_derivs['recorded_or_reconstructed'].lower():
         which = ' reconstructed'
     else:
         which = ''
     
-    #TODO: can there be the case that no shift was done and column is empty? should not be...
     # Create a scatter plot
     fig = go.Figure()
     fig.add_trace(go.Scatter (x=df['mean_rwave_time'], y=df['mean_rwave'], mode='lines', name='Original '+ ecg_or_eog.upper(),
         hovertemplate='Time: %{x} s<br>Amplitude: %{y} V<br>'))
-    if ecg_or_eog.lower() == 'ecg':
+    if ecg_or_eog.lower() == 'ecg' and 'mean_rwave_shifted' in df:
         fig.add_trace(go.Scatter (x=df['mean_rwave_time'], y=df['mean_rwave_shifted'], mode='lines', name='Shifted ' + ecg_or_eog.upper(),
         hovertemplate='Time: %{x} s<br>Amplitude: %{y} V<br>'))
 
@@ -2301,7 +2423,7 @@ def plot_artif_per_ch_3_groups(f_path: str, m_or_g: str, ecg_or_eog: str, flip_d
 
     ecg_or_eog = ecg_or_eog.lower()
 
-    df = pd.read_csv(f_path, sep='\t') #TODO: maybe remove reading csv and pass directly the df here?
+    df = read_derivative_df(f_path) #TODO: maybe remove reading csv and pass directly the df here?
     
     df = df.drop(df[df['Type'] != m_or_g].index) #remove non needed channel kind
 
@@ -2381,7 +2503,7 @@ def plot_correlation_csv(f_path: str, ecg_or_eog: str, m_or_g: str):
 
     ecg_or_eog = ecg_or_eog.lower()
 
-    df = pd.read_csv(f_path, sep='\t') #TODO: maybe remove reading csv and pass directly the df here?
+    df = read_derivative_df(f_path) #TODO: maybe remove reading csv and pass directly the df here?
     df = df.drop(df[df['Type'] != m_or_g].index) #remove non needed channel kind
 
     _, _, _, corr_val_of_last_most_correlated, corr_val_of_last_middle_correlated, corr_val_of_last_least_correlated = split_affected_into_3_groups_csv(df, ecg_or_eog, split_by='corr_coeff')
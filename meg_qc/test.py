@@ -20,6 +20,7 @@ def run_megqc():
     dataset_path_parser.add_argument("--inputdata", type=str, required=True, help="path to the root of your BIDS MEG dataset")
     dataset_path_parser.add_argument("--config", type=str, required=False, help="path to config file")
     dataset_path_parser.add_argument("--subs",nargs='+', type=str, required=False, help="List of subject identifiers that the pipeline should be run on. Default is all subjects")
+    dataset_path_parser.add_argument("--jobs", type=int, required=False, default=1, help="Number of data files processed in parallel (separate processes). Default is 1")
     args=dataset_path_parser.parse_args()
 
 
@@ -64,7 +65,7 @@ def run_megqc():
         config_file_path = args.config
 
 
-    make_derivative_meg_qc(config_file_path, internal_config_file_path, data_directory,sub_list)
+    make_derivative_meg_qc(config_file_path, internal_config_file_path, data_directory,sub_list, jobs=args.jobs)
 
     print('MEGqc has completed the calculation of metrics. Results can be found in' + data_directory +'/derivatives/MEGqc/calculation')
 
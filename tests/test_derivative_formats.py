@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from meg_qc.calculation.objects import ChannelTable, QC_derivative
+from meg_qc.calculation.derivative_formats import write_df_binary, write_derivative_container, container_member_paths, read_derivative_df, read_derivative_json, BINARY_DF_FORMATS, CONTAINER_FORMATS, CONTAINER_DESC
+
+
+def make_derivative_dfs():
+
+    # table of channels as written by channel_table_to_csv: strings, numbers, 2D metric columns and placeholders for missing values
+    names = ['MEG0111', 'MEG0112', 'MEG0113', 'MEG0121']
+    table = ChannelTable(names, ['mag', 'grad', 'grad', 'mag'], ['Left Frontal']*2 + ['Right Frontal']*2, ['#1f77b4']*4, ['OTHER']*4, [[0.1, 0.2, 0.3], None, [0.4, 0.5, 0.6], None])
+    table = table.with_metric('std_overall', ['MEG0111', 'MEG0121'], [1e-12, 2.5e-13])
+    table = table.with_metric('psd', ['MEG0112', 'MEG0113'], np.arange(6).reshape(2, 3) * 1e-13, labels=[0.5, 1., 1.5])
+
+    # small derivative with an empty column and a column of mixed types, like the noise and band tables
+    df_mixed = pd.DataFrame({'freq': [50., 100., 150.], 'empty': [None, None, None], 'mixed': ['a', 1, None], 'flag': [True, False, True]})
+    df_mixed.index.name = 'band'
+
+    return {'Sensors': table.to_df(), 'PSDnoise': df_mixed}
+
+
+def write_tsv(df: pd.DataFrame, tsv_path: str):
+
+    # same as the derivatives are written in the pipeline:
+    df.to_csv(tsv_path, sep='\t')
+
+    return pd.read_csv(tsv_path, sep='\t')
+
+
+def assert_same_as_tsv(df_read: pd.DataFrame, df_tsv: pd.DataFrame):
+
+    assert list(df_read.columns) == list(df_tsv.columns)
+    assert len(df_read) == len(df_tsv)
+
+    for column in df_tsv.columns:
+        values_tsv, values_read = df_tsv[column], df_read[column]
+        assert list(values_read.isna()) == list(values_tsv.isna()), column
+        if pd.api.types.is_numeric_dtype(values_tsv):
+            np.testing.assert_allclose(values_read.to_numpy(dtype=float), values_tsv.to_numpy(dtype=float), rtol=1e-12, err_msg=column)
+        else:
+            assert [str(value) for value in values_read[values_read.notna()]] == [str(value) for value in values_tsv[values_tsv.notna()]], column
+
+
+@pytest.mark.parametrize('binary_df_format', list(BINARY_DF_FORMATS))
+def test_binary_df_round_trip(binary_df_format, tmp_path):
+
+    pytest.importorskip('pyarrow')
+
+    for name, df in make_derivative_dfs().items():
+        tsv_path = os.path.join(tmp_path, 'sub-1_desc-' + name + '_meg.tsv')
+        df_tsv = write_tsv(df, tsv_path)
+        write_df_binary(df, os.path.splitext(tsv_path)[0] + BINARY_DF_FORMATS[binary_df_format], binary_df_format)
+
+        assert_same_as_tsv(read_derivative_df(tsv_path), df_tsv)
+
+
+@pytest.mark.parametrize('container_format', list(CONTAINER_FORMATS))
+def test_container_round_trip(container_format, tmp_path):
+
+    pytest.importorskip('h5py' if container_format == 'hdf5' else 'zarr')
+
+    dfs = make_derivative_dfs()
+    simple_metrics = {'STD': {'measurement_unit_mag': 'Tesla', 'number_of_noisy_ch': 2, 'details': [1.5, None]}}
+    derivs = [QC_derivative(df, name, 'df') for name, df in dfs.items()] + [QC_derivative(simple_metrics, 'ReportStrings', 'json')]
+
+    container_path = os.path.join(tmp_path, 'sub-1_task-rest_desc-' + CONTAINER_DESC + '_meg' + CONTAINER_FORMATS[container_format])
+    write_derivative_container(derivs, container_path, container_format)
+
+    member_paths = container_member_paths(container_path)
+    assert sorted(member_paths) == sorted(list(dfs) + ['ReportStrings'])
+
+    for name, df in dfs.items():
+        df_tsv = write_tsv(df, os.path.join(tmp_path, 'sub-1_task-rest_desc-' + name + '_meg.tsv'))
+        assert_same_as_tsv(read_derivative_df(member_paths[name]), df_tsv)
+
+    assert read_derivative_json(member_paths['ReportStrings']) == simple_metrics
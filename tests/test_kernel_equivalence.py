@@ -0,0 +1,277 @@
+"""
+Vectorised kernels compared with the loops they replaced. The old loops are kept here as they were in the repository.
+"""
+
+import numpy as np
+import pandas as pd
+import mne
+import pytest
+from scipy.integrate import simpson
+
+from meg_qc.calculation.metrics.STD_meg_qc import get_std_epochs
+from meg_qc.calculation.metrics.Peaks_manual_meg_qc import neighbour_peak_amplitude
+from meg_qc.calculation.metrics.PSD_meg_qc import get_band_integration_sums, integrate_bands, get_bands_amplitude_per_ch
+from meg_qc.calculation.metrics.ECG_EOG_meg_qc import find_mean_rwave_blink
+from meg_qc.calculation.objects import MEG_channel, ChannelTable, drop_placeholder_columns
+
+
+def get_std_epochs_loop(channels, epochs_mg):
+
+    dict_ep = {}
+
+    #get 1 epoch, 1 channel and calculate std of its data:
+    for ep in range(0, len(epochs_mg)):
+        std_epoch=[]
+        for ch_name in channels:
+            data_ch_epoch=epochs_mg[ep].get_data(picks=ch_name)[0][0]
+            std_ch_ep = np.std(data_ch_epoch)
+            std_epoch.append(np.float64(std_ch_ep))
+
+        dict_ep[ep] = std_epoch
+
+    return pd.DataFrame(dict_ep, index=channels)
+
+
+@pytest.mark.parametrize('n_epochs', [1, 7])
+def test_get_std_epochs(n_epochs):
+
+    channels = ['MEG0111', 'MEG0121', 'MEG0131']
+    info = mne.create_info(channels, 1000., ch_types='mag')
+    data = np.random.default_rng(n_epochs).standard_normal((n_epochs, len(channels), 501)) * 1e-12
+    data[:, 1, :] = 2e-12 # flat channel: std 0
+    epochs = mne.EpochsArray(data, info, verbose=False)
+
+    pd.testing.assert_frame_equal(get_std_epochs(channels, epochs), get_std_epochs_loop(channels, epochs))
+
+
+def neighbour_peak_amplitude_loop(max_pair_dist_sec, sfreq, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes):
+
+    if len(pos_peak_locs)<1 or len(neg_peak_locs)<1:
+        return 0, None
+
+    pair_dist=max_pair_dist_sec*sfreq
+    pairs_magnitudes=[]
+    pairs_locs=[]
+
+    # Looping over all positive peaks
+    for posit_peak_ind, posit_peak_loc in enumerate(pos_peak_locs):
+
+        # Finding the value in neg_peak_locs which is closest to posit_peak_loc
+        closest_negative_peak_index = np.abs(neg_peak_locs - posit_peak_loc).argmin()
+
+        # Check if the closest negative peak is within the given distance
+        if np.abs(neg_peak_locs[closest_negative_peak_index] - posit_peak_loc) <= pair_dist / 2:
+            pairs_locs.append([pos_peak_locs[posit_peak_ind], neg_peak_locs[closest_negative_peak_index]])
+            pairs_magnitudes.append([pos_peak_magnitudes[posit_peak_ind], neg_peak_magnitudes[closest_negative_peak_index]])
+
+    if len(pairs_magnitudes)==0:
+        pairs_magnitudes.append([max(pos_peak_magnitudes), min(neg_peak_magnitudes)])
+
+    amplitude=np.zeros(len(pairs_magnitudes),)
+    for i, pair in enumerate(pairs_magnitudes):
+        amplitude[i]=pair[0]-pair[1]
+
+    return np.mean(amplitude), amplitude
+
+
+def make_peaks(rng, n_times, n_pos, n_neg):
+
+    # sorted locations as given by find_peaks, first and last sample included to have peaks at the ends of the signal:
+    pos_peak_locs = np.unique(np.concatenate(([0, n_times-1], rng.integers(0, n_times, n_pos))))
+    neg_peak_locs = np.unique(np.concatenate(([0, n_times-1], rng.integers(0, n_times, n_neg))))
+
+    return pos_peak_locs, neg_peak_locs, rng.standard_normal(len(pos_peak_locs)), rng.standard_normal(len(neg_peak_locs))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_neighbour_peak_amplitude(seed):
+
+    rng = np.random.default_rng(seed)
+    pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes = make_peaks(rng, 1000, rng.integers(1, 60), rng.integers(1, 60))
+
+    for max_pair_dist_sec in [0, 0.004, 0.02, 2]: # 0: only peaks at the same sample are paired
+        mean_ampl, ampl = neighbour_peak_amplitude(max_pair_dist_sec, 1000, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
+        mean_ampl_loop, ampl_loop = neighbour_peak_amplitude_loop(max_pair_dist_sec, 1000, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
+
+        np.testing.assert_array_equal(ampl, ampl_loop)
+        assert mean_ampl == mean_ampl_loop
+
+
+@pytest.mark.parametrize('pos_peak_locs, neg_peak_locs', [
+    ([0], [999]), # one peak at each end, too far to be paired
+    ([0, 999], [0, 999]), # peaks at the ends at the same samples
+    ([5, 15], [10]), # same distance to the negative peak before and after
+    ([10], [5, 15]), # same distance to 2 negative peaks: the earlier one is taken
+    ([500], [0]), # one negative peak only
+    ([], [3]), # no positive peaks
+])
+def test_neighbour_peak_amplitude_edges(pos_peak_locs, neg_peak_locs):
+
+    pos_peak_locs, neg_peak_locs = np.array(pos_peak_locs, dtype=int), np.array(neg_peak_locs, dtype=int)
+    pos_peak_magnitudes, neg_peak_magnitudes = np.arange(1., len(pos_peak_locs)+1), -np.arange(1., len(neg_peak_locs)+1)
+
+    mean_ampl, ampl = neighbour_peak_amplitude(0.02, 1000, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
+    mean_ampl_loop, ampl_loop = neighbour_peak_amplitude_loop(0.02, 1000, pos_peak_locs, neg_peak_locs, pos_peak_magnitudes, neg_peak_magnitudes)
+
+    assert mean_ampl == mean_ampl_loop
+    if ampl_loop is None:
+        assert ampl is None
+    else:
+        np.testing.assert_array_equal(ampl, ampl_loop)
+
+
+def get_bands_amplitude_per_ch_loop(freq_bands, freqs, psds, channels):
+
+    bands_as_str=[str(band[0])+'-'+str(band[1])+'Hz' for band in freq_bands]
+    freq_res = freqs[1] - freqs[0]
+
+    total_signal_amplitude = []
+
+    band_ampl_df = pd.DataFrame(index=channels, columns=bands_as_str)
+    band_ampl_relative_to_signal_df = pd.DataFrame(index=channels, columns=bands_as_str)
+    ampl_by_Nfreq_per_ch_list_df = pd.DataFrame(index=channels, columns=bands_as_str)
+
+    for ch_n, _ in enumerate(psds):
+        total_signal_amplitude.append(simpson(psds[ch_n], dx=freq_res)) #amplitudeof all bands
+
+        for band_n, band in enumerate(freq_bands):
+
+            idx_band = np.logical_and(freqs >= band[0], freqs <= band[-1])
+            band_ampl = simpson(psds[ch_n][idx_band], dx=freq_res) #amplitude of chosen band
+            band_ampl_df.iloc[ch_n, band_n] = band_ampl
+            band_ampl_relative_to_signal_df.iloc[ch_n, band_n] = band_ampl / total_signal_amplitude[ch_n]
+            ampl_by_Nfreq_per_ch_list_df.iloc[ch_n, band_n] = band_ampl/sum(idx_band)
+
+    return band_ampl_df, band_ampl_relative_to_signal_df, ampl_by_Nfreq_per_ch_list_df, total_signal_amplitude
+
+
+@pytest.mark.parametrize('n_freqs', [8, 9])
+def test_integrate_bands(n_freqs):
+
+    psds = np.random.default_rng(n_freqs).random((3, n_freqs))
+    parity_sums = get_band_integration_sums(psds)
+
+    # every band of every channel: odd and even number of bins, bands at the start and at the end of the spectrum:
+    for row in range(psds.shape[0]):
+        for first in range(n_freqs):
+            for last in range(first+1, n_freqs):
+                band_ampl = integrate_bands(psds, parity_sums, row, first, last, 0.5)
+                np.testing.assert_allclose(band_ampl, simpson(psds[row, first:last+1], dx=0.5), rtol=1e-12, atol=0)
+
+    # band of one bin has no area:
+    assert integrate_bands(psds, parity_sums, 0, 4, 4, 0.5) == 0
+
+
+@pytest.mark.parametrize('n_freqs', [200, 201])
+def test_get_bands_amplitude_per_ch(n_freqs):
+
+    channels = ['MEG0111', 'MEG0121', 'MEG0131', 'MEG0141']
+    freqs = np.arange(n_freqs) * 0.5
+    psds = np.random.default_rng(n_freqs).random((len(channels), n_freqs)) * 1e-13
+    # brain wave bands, a band of 2 bins and a band up to the last frequency:
+    freq_bands = [[0.5, 4], [4, 8], [8, 12], [12, 30], [30, 100], [20, 20.5], [90, freqs[-1]]]
+
+    results = get_bands_amplitude_per_ch(freq_bands, freqs, psds, channels)
+    results_loop = get_bands_amplitude_per_ch_loop(freq_bands, freqs, psds, channels)
+
+    for df, df_loop in zip(results[:3], results_loop[:3]):
+        assert list(df.index) == list(df_loop.index) and list(df.columns) == list(df_loop.columns)
+        np.testing.assert_allclose(df.to_numpy(dtype=float), df_loop.to_numpy(dtype=float), rtol=1e-12, atol=0)
+    np.testing.assert_allclose(results[3], results_loop[3], rtol=1e-12, atol=0)
+
+
+def find_mean_rwave_blink_loop(ch_data, event_indexes, tmin, tmax, sfreq, skip_outside=False):
+
+    # skip_outside=False: the old loop as it was, events which epochs do not fit into the data are left as zero rows.
+    # skip_outside=True: these rows are not used in the mean, as find_mean_rwave_blink does now.
+
+    # Initialize an empty array to store the extracted epochs
+    epochs = np.zeros((len(event_indexes), int((tmax-tmin)*sfreq)+1))
+    inside = np.zeros(len(event_indexes), dtype=bool)
+
+    # Loop through each ECG event and extract the corresponding epoch
+    for i, event in enumerate(event_indexes):
+        start = np.round(event + tmin*sfreq).astype(int)
+        end = np.round(event + tmax*sfreq).astype(int)+1
+
+        if start < 0:
+            continue
+
+        if end > len(ch_data):
+            continue
+
+        epochs[i, :] = ch_data[start:end]
+        inside[i] = True
+
+    if skip_outside:
+        epochs = epochs[inside]
+
+    #average all epochs:
+    return np.mean(epochs, axis=0)
+
+
+@pytest.mark.parametrize('tmin, tmax', [(-0.08, 0.08), (-0.2, 0.4)]) # ECG and EOG epochs of settings_internal.ini
+def test_find_mean_rwave_blink(tmin, tmax):
+
+    sfreq = 1000
+    ch_data = np.random.default_rng(0).standard_normal(5000)
+    first, last = int(round(-tmin*sfreq)), len(ch_data) - 1 - int(round(tmax*sfreq)) # first and last event with a full epoch
+
+    # all epochs inside of the data, the first and the last one touching its start and end: same as the old loop
+    event_indexes = np.array([first, 1200, 2500, 3100, last])
+    np.testing.assert_array_equal(find_mean_rwave_blink(ch_data, event_indexes, tmin, tmax, sfreq), find_mean_rwave_blink_loop(ch_data, event_indexes, tmin, tmax, sfreq))
+
+    # events near the start and the end of the data, one sample too close for a full epoch, are not used in the mean:
+    event_indexes = np.array([0, first-1, first, 2500, last, last+1, len(ch_data)-1])
+    mean_rwave = find_mean_rwave_blink(ch_data, event_indexes, tmin, tmax, sfreq)
+    np.testing.assert_allclose(mean_rwave, find_mean_rwave_blink_loop(ch_data, event_indexes, tmin, tmax, sfreq, skip_outside=True), rtol=1e-12, atol=0)
+    np.testing.assert_allclose(mean_rwave, find_mean_rwave_blink_loop(ch_data, np.array([first, 2500, last]), tmin, tmax, sfreq), rtol=1e-12, atol=0)
+
+
+def test_find_mean_rwave_blink_no_epochs():
+
+    ch_data = np.random.default_rng(1).standard_normal(1000)
+
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        # no events, no event with a full epoch, data shorter than one epoch: NaN as for no events in the old loop
+        assert np.isnan(find_mean_rwave_blink(ch_data, np.array([], dtype=int), -0.08, 0.08, 1000)).all()
+        assert np.isnan(find_mean_rwave_blink(ch_data, np.array([5, 995]), -0.08, 0.08, 1000)).all()
+        assert np.isnan(find_mean_rwave_blink(ch_data[:100], np.array([50]), -0.08, 0.08, 1000)).all()
+
+
+def test_channel_table_to_df():
+
+    rng = np.random.default_rng(2)
+    mags, grads = ['MEG0111', 'MEG0121', 'MEG0131'], ['MEG0112', 'MEG0113', 'MEG0122', 'MEG0123']
+    names = mags + grads
+    base = dict(type=['mag']*3 + ['grad']*4, lobe=['Left Frontal']*4 + ['Right Frontal']*3, lobe_color=['#1f77b4']*4 + ['#ff7f0e']*3,
+        system=['OTHER']*7, loc=[[0.1, 0.2, 0.3]]*6 + [None])
+    chs = [MEG_channel(name, **{attr: values[ch_n] for attr, values in base.items()}) for ch_n, name in enumerate(names)]
+    table = ChannelTable(names, *base.values())
+
+    freqs = np.array([0.5, 1., 1.5, 2.])
+    ecg_time = np.array([-0.04, 0., 0.04])
+
+    # metrics as the pipeline adds them: per channel type, some only for a part of the channels
+    metrics = [
+        ('std_overall', names, rng.random(7), None),
+        ('std_epoch', mags, rng.random((3, 5)), None),
+        ('ptp_epoch', grads, rng.random((4, 5)), None),
+        ('psd', grads, rng.random((4, 4)), freqs),
+        ('freq', grads, np.broadcast_to(freqs, (4, 4)), None),
+        ('mean_ecg', mags, rng.random((3, 3)), ecg_time),
+        ('ecg_corr_coeff', mags[:2], rng.random(2), None),
+        ('ecg_pval', names, np.array([0.01, 0.5, None, 0.2, 0.3, None, 0.9], dtype=object), None),
+    ]
+
+    for attr, ch_names, values, labels in metrics:
+        table = table.with_metric(attr, ch_names, values, labels=labels)
+        for ch_name, value in zip(ch_names, values):
+            setattr(chs[names.index(ch_name)], attr, value)
+    for ch_name in mags:
+        chs[names.index(ch_name)].ecg_time = ecg_time
+
+    # old export: one data frame per channel, concatenated
+    df_loop = drop_placeholder_columns(pd.concat([ch.to_df() for ch in chs]))
+
+    assert table.to_df().to_csv(sep='\t') == df_loop.to_csv(sep='\t')
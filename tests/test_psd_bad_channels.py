@@ -0,0 +1,56 @@
+import numpy as np
+import mne
+import pytest
+
+from meg_qc.calculation.objects import ChannelTable
+from meg_qc.calculation.metrics.PSD_meg_qc import get_psds_by_ch_type, assign_psds_to_channels
+
+
+SFREQ = 200.
+MAGS = ['MEG0111', 'MEG0121', 'MEG0131']
+GRADS = ['MEG0112', 'MEG0113', 'MEG0122', 'MEG0123']
+
+
+def make_raw(bads):
+
+    # every channel has its own sine, so a spectrum given to the wrong channel is seen in the comparison:
+    ch_names = MAGS + GRADS
+    info = mne.create_info(ch_names, SFREQ, ch_types=['mag']*len(MAGS) + ['grad']*len(GRADS))
+    times = np.arange(int(20*SFREQ)) / SFREQ
+    rng = np.random.default_rng(0)
+    data = np.array([np.sin(2*np.pi*(5 + 7*ch_n)*times) + 0.1*rng.standard_normal(len(times)) for ch_n in range(len(ch_names))])
+
+    raw = mne.io.RawArray(data*1e-12, info, verbose=False)
+    raw.info['bads'] = list(bads)
+
+    return raw
+
+
+@pytest.mark.parametrize('block_seconds', [0, 5])
+@pytest.mark.parametrize('bads', [[], [MAGS[1]], [GRADS[2]], [MAGS[0], GRADS[3]]])
+def test_psds_are_split_by_channel_names(bads, block_seconds):
+
+    raw = make_raw(bads)
+    channels = {'mag': MAGS, 'grad': GRADS}
+    psd_args = dict(method='welch', fmin=0, fmax=100, n_fft=400, n_per_seg=400)
+
+    psds, freqs, psd_channels = get_psds_by_ch_type(raw, channels, ['mag', 'grad'], block_seconds=block_seconds, **psd_args)
+
+    table = ChannelTable(MAGS + GRADS, ['mag']*len(MAGS) + ['grad']*len(GRADS), ['Left Frontal']*7, ['#1f77b4']*7, ['OTHER']*7, [None]*7)
+
+    for m_or_g in ['mag', 'grad']:
+        assert psd_channels[m_or_g] == [ch for ch in channels[m_or_g] if ch not in bads]
+        assert psds[m_or_g].shape == (len(psd_channels[m_or_g]), len(freqs[m_or_g]))
+
+        # spectrum of every channel alone:
+        raw_good = raw.copy()
+        raw_good.info['bads'] = []
+        for ch, psd in zip(psd_channels[m_or_g], psds[m_or_g]):
+            expected = raw_good.compute_psd(picks=[ch], verbose=False, **psd_args).get_data()[0]
+            np.testing.assert_allclose(psd, expected, rtol=1e-10)
+
+        table = assign_psds_to_channels(table, psd_channels[m_or_g], freqs[m_or_g], psds[m_or_g])
+
+    # bad channels get no spectrum, all others get their own:
+    for ch, psd in zip(MAGS + GRADS, table.get_metric('psd', MAGS + GRADS)):
+        assert (psd is None) == (ch in bads)